@@ -4,14 +4,37 @@ For detailed API information, see:
 http://www.quickbase.com/api-guide/index.html
 
 """
+import bisect
+import codecs
+import collections
+import contextlib
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import mmap
 import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
 try:
-    from lxml import etree
-except ImportError:
-    print "You must install lxml and libxml2 packages before using pyQuickBase"
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
 
-import requests
-import chardet
+PY2 = sys.version_info[0] == 2
+if not PY2:
+    basestring = str
 
 
 class Error(Exception):
@@ -19,117 +42,1824 @@ class Error(Exception):
     this module. For the list of QuickBase error codes, see:
     http://www.quickbase.com/api-guide/errorcodes.html
 
+    response is the raw body (bytes) of the response the error is about, if there
+    was one: for an XMLError up to its first 64 KiB, and for a ResponseError
+    serialized from parsed, the response's root Element. A ConnectionError raised
+    for an HTTP error status has that HTTP response as http_response.
+
     """
-    def __init__(self, code, msg, response=None):
+    def __init__(self, code, msg, response=None, parsed=None, http_response=None):
         self.args = (code, msg)
         self.code = code
         self.msg = msg
         self.response = response
+        self.parsed = parsed
+        self.http_response = http_response
+
+
+class ConnectionError(Error):
+    pass
+
+
+class ResponseError(Error):
+    pass
+
+
+class QuickBaseError(Error):
+    pass
+
+
+class XMLError(Error):
+    pass
+
+
+# Bytes of a response body kept while it is parsed, for the XMLError it may raise
+_ERROR_BODY_SIZE = 64 * 1024
+_XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+_XML_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_.-]*$')
+_XML_TEXT_ESCAPES = re.compile(u'[&<>\r]')
+_XML_ATTR_ESCAPES = re.compile(u'[&<>"\n\r\t]')
+_XML_ESCAPES = {u'&': u'&amp;', u'<': u'&lt;', u'>': u'&gt;', u'"': u'&quot;',
+                u'\n': u'&#10;', u'\r': u'&#13;', u'\t': u'&#9;'}
+_XML_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff\ud800-\udfff]')
+
+
+def _xml_text(value):
+    """Return value as text for the fast request serializer. Raises ValueError if
+    lxml would reject it (non-ASCII byte strings, characters not allowed in XML).
+
+    """
+    if PY2 and isinstance(value, str):
+        value = value.decode('ascii')
+    if _XML_INVALID.search(value):
+        raise ValueError('not XML compatible')
+    return value
+
+
+def _xml_escape(value, attribute):
+    pattern = _XML_ATTR_ESCAPES if attribute else _XML_TEXT_ESCAPES
+    if pattern.search(value):
+        return pattern.sub(lambda match: _XML_ESCAPES[match.group()], value)
+    return value
+
+
+def _xml_bytes(element):
+    """Return a parsed Element, from either XML backend, serialized as UTF-8 bytes."""
+    if type(element).__module__.startswith('lxml'):
+        import lxml.etree as etree
+    else:
+        import xml.etree.ElementTree as etree
+    return etree.tostring(element, encoding='utf-8')
+
+
+class _BodyHead(object):
+    """The start of a response body, kept while the body is parsed so that an
+    XMLError raised on it can carry it as its response.
+
+    """
+    def __init__(self, size=_ERROR_BODY_SIZE):
+        self.chunks = []
+        self.left = size
+
+    def add(self, chunk):
+        if self.left > 0:
+            self.chunks.append(chunk[:self.left])
+            self.left -= len(chunk)
+
+    def attach(self, error):
+        """Give error the kept body as its response unless it has one; return error."""
+        if error.response is None:
+            error.response = b''.join(self.chunks)
+        return error
+
+
+class XMLBackend(object):
+    """The XML library used by a Client, imported on first use. A backend provides
+    incremental parsers for responses, the exception they raise on malformed XML,
+    and serialization of requests the fast serializer cannot handle. Parsed Elements
+    are only used through the ElementTree API (find, findtext, iter, get, text,
+    tail, tag and iteration over children), so every backend gives the same results.
+
+    """
+    name = None
+    modules = ()
+
+    def __init__(self):
+        self._etree = None
+
+    @property
+    def etree(self):
+        if self._etree is None:
+            for module in self.modules:
+                try:
+                    self._etree = __import__(module, fromlist=['*'])
+                    break
+                except ImportError:
+                    if module == self.modules[-1]:
+                        raise
+        return self._etree
+
+    @property
+    def error(self):
+        """Exception raised by the parsers on malformed XML."""
+        raise NotImplementedError
+
+    def parser(self, encoding=None):
+        """Return a parser with feed(data) and close(), which returns the root Element.
+        encoding overrides the document's own.
+
+        """
+        return self.etree.XMLParser(encoding=encoding)
+
+    def pull_parser(self, tags, encoding=None):
+        """Return a parser with feed(data); read_events(), which returns the ('start' or
+        'end', Element) events for the given tags since the last call; release(element),
+        which drops a finished element from the tree; and close(), which returns the
+        root Element.
+
+        """
+        raise NotImplementedError
+
+    def tostring(self, element):
+        """Serialize element as UTF-8 bytes, without an XML declaration."""
+        raise NotImplementedError
+
+    def build_request(self, request_fields):
+        """Build request XML as Client._build_request does, with an Element tree."""
+        request = self.etree.Element('qdbapi')
+        for field, values in request_fields.items():
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if isinstance(value, tuple):
+                    attrib, value = value
+                    attrib = dict((k, str(v)) for k, v in attrib.items())
+                else:
+                    attrib = {}
+                sub_element = self.etree.SubElement(request, field, **attrib)
+                if not isinstance(value, basestring):
+                    value = str(value)
+                sub_element.text = value
+        return _XML_DECLARATION + self.tostring(request)
+
+
+class LxmlBackend(XMLBackend):
+    """XML backend using lxml, the default when it is installed."""
+    name = 'lxml'
+    modules = ('lxml.etree',)
+
+    @property
+    def error(self):
+        return self.etree.XMLSyntaxError
+
+    def pull_parser(self, tags, encoding=None):
+        return _LxmlPullParser(self.etree, tags, encoding)
+
+    def tostring(self, element):
+        return self.etree.tostring(element, encoding='UTF-8', xml_declaration=False)
+
+
+class _LxmlPullParser(object):
+    def __init__(self, etree, tags, encoding=None):
+        parser = etree.XMLPullParser(events=('start', 'end'), tag=tuple(tags), encoding=encoding)
+        self.feed = parser.feed
+        self.read_events = parser.read_events
+        self.close = parser.close
+
+    @staticmethod
+    def release(element):
+        element.clear()
+        # Also drop the (already released) elements before it
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+class EtreeBackend(XMLBackend):
+    """XML backend using the standard library's ElementTree and its expat parser, for
+    when lxml is not installed.
+
+    """
+    name = 'etree'
+    modules = ('xml.etree.cElementTree', 'xml.etree.ElementTree') if PY2 else ('xml.etree.ElementTree',)
+
+    @property
+    def error(self):
+        return self.etree.ParseError
+
+    def pull_parser(self, tags, encoding=None):
+        return _EtreePullParser(self.etree, tags, encoding)
+
+    def tostring(self, element):
+        return self.etree.tostring(element, encoding='utf-8')
+
+
+class _EtreePullParser(object):
+    """Pull parser built on an ElementTree XMLParser with a target that builds the
+    tree and notes the events for the wanted tags.
+
+    """
+    def __init__(self, etree, tags, encoding=None):
+        self.target = _EtreePullTarget(etree.TreeBuilder(), tags)
+        self.parser = etree.XMLParser(target=self.target, encoding=encoding)
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def read_events(self):
+        events, self.target.events = self.target.events, []
+        return events
+
+    def release(self, element):
+        parent = self.target.parents.pop(id(element), None)
+        if parent is not None:
+            parent.remove(element)
+
+    def close(self):
+        return self.parser.close()
+
+
+class _EtreePullTarget(object):
+    def __init__(self, builder, tags):
+        self.builder = builder
+        self.tags = frozenset(tags)
+        self.events = []
+        self.stack = []
+        self.parents = {}
+
+    def start(self, tag, attrib):
+        element = self.builder.start(tag, attrib)
+        if tag in self.tags:
+            self.events.append(('start', element))
+        self.stack.append(element)
+
+    def end(self, tag):
+        element = self.builder.end(tag)
+        self.stack.pop()
+        if tag in self.tags:
+            self.events.append(('end', element))
+            if self.stack:
+                self.parents[id(element)] = self.stack[-1]
+
+    def data(self, data):
+        self.builder.data(data)
+
+    def close(self):
+        return self.builder.close()
+
+
+_xml_backends = {}
+
+
+def get_xml_backend(name=None):
+    """Return the XML backend called name, 'lxml' or 'etree'. By default that is lxml
+    if it is installed, otherwise the standard library's ElementTree.
+
+    """
+    if name is None:
+        try:
+            import lxml.etree
+            name = 'lxml'
+        except ImportError:
+            name = 'etree'
+    backend = _xml_backends.get(name)
+    if backend is None:
+        backend = _xml_backends[name] = {'lxml': LxmlBackend, 'etree': EtreeBackend}[name]()
+    return backend
+
+
+class Transport(object):
+    """HTTP transport used by a Client. Wraps a persistent requests.Session so TCP and
+    TLS connections are kept alive and reused across API calls instead of being set up
+    for every request.
+
+    pool_connections is the number of per-host connection pools to keep, pool_maxsize
+    the maximum number of connections kept open to each host, and pool_block whether
+    to wait for a free connection (rather than open an extra one) once a host is at
+    pool_maxsize. timeout is the read timeout in seconds; connect_timeout defaults to
+    the same value.
+
+    Any object with compatible get(), post() and close() methods can be passed to a
+    Client as its transport.
+
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, max_retries=0,
+                 timeout=30, connect_timeout=None, keep_alive=True, session=None):
+        import requests
+        import requests.adapters
+        self.session = session if session is not None else requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                                pool_maxsize=pool_maxsize,
+                                                pool_block=pool_block,
+                                                max_retries=max_retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        self.timeout = (connect_timeout if connect_timeout is not None else timeout, timeout)
+
+    def request(self, method, url, data=None, headers=None, stream=False):
+        """Do an HTTP request over the pooled session. Raises ConnectionError on
+        connection failures and timeouts.
+
+        """
+        import requests
+        try:
+            return self.session.request(method, url, data=data, headers=headers,
+                                        stream=stream, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ConnectionError(-2, e)
+
+    def get(self, url, headers=None, stream=False):
+        return self.request('GET', url, headers=headers, stream=stream)
+
+    def post(self, url, data, headers=None, stream=False):
+        return self.request('POST', url, data=data, headers=headers, stream=stream)
+
+    def close(self):
+        self.session.close()
+
+
+def _transfer(chunks):
+    """Yield the chunks of a streaming response body, raising ConnectionError if the
+    connection fails or times out partway through, as Transport.request does for
+    failures before the body.
+
+    """
+    import requests
+    from requests.packages.urllib3.exceptions import HTTPError
+    try:
+        for chunk in chunks:
+            yield chunk
+    except (requests.RequestException, HTTPError) as e:
+        raise ConnectionError(-2, e)
+
+
+def to_xml_name(name):
+    """Convert field name to tag-like name as used in QuickBase XML.
+    >>> to_xml_name('This is a Field')
+    'this_is_a_field'
+    >>> to_xml_name('800 Number')
+    '_800_number'
+    >>> to_xml_name('A & B')
+    'a___b'
+    >>> to_xml_name('# of Whatevers')
+    '___of_whatevers'
+    """
+    xml_name = ''.join((ch if ch.isalnum() else '_') for ch in name.lower())
+    if not xml_name[0].isalpha():
+        xml_name = '_' + xml_name
+    return xml_name
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_float(value):
+    return float(value) if value else None
+
+
+def _to_int(value):
+    return int(value) if value else None
+
+
+def _to_datetime(value):
+    """Convert milliseconds since the epoch (UTC) to a naive UTC datetime.
+
+    >>> _to_datetime('1262304000000')
+    datetime.datetime(2010, 1, 1, 0, 0)
+    """
+    return EPOCH + datetime.timedelta(milliseconds=int(value)) if value else None
+
+
+def _to_bool(value):
+    return value == '1'
+
+
+def _to_choices(value):
+    return tuple(value.split(';')) if value else ()
+
+
+def _to_text(value):
+    return value
+
+
+class Schema(object):
+    """Fields of a table as returned by GetSchema, indexed for fast lookups. fields is
+    the list of field dicts from _parse_schema, by_fid maps fid to field dict, fids
+    maps both the label and the XML name of each field to its fid, and converters maps
+    fid to a function converting that field's values from QuickBase text to Python.
+
+    """
+    # Converters by field_type, falling back to base_type. Dates and timestamps are
+    # milliseconds in UTC since requests are made with msInUTC.
+    field_type_converters = {
+        'checkbox': _to_bool,
+        'date': _to_datetime,
+        'timestamp': _to_datetime,
+        'multitext': _to_choices,
+        'float': _to_float,
+        'currency': _to_float,
+        'percent': _to_float,
+        'rating': _to_float,
+        'recordid': _to_int,
+        'duration': _to_int,
+        'timeofday': _to_int,
+    }
+    base_type_converters = {
+        'bool': _to_bool,
+        'float': _to_float,
+        'int32': _to_int,
+        'int64': _to_int,
+    }
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.by_fid = {}
+        self.fids = {}
+        self.converters = {}
+        for field in fields:
+            fid = field.get('id')
+            if fid is None:
+                continue
+            self.by_fid[fid] = field
+            label = field.get('label')
+            if label:
+                self.fids[to_xml_name(label)] = fid
+                self.fids[label] = fid
+            self.converters[fid] = self.converter(field)
+
+    @classmethod
+    def converter(cls, field):
+        """Return the function converting values of the given field dict."""
+        converter = cls.field_type_converters.get(field.get('field_type'))
+        if converter is None:
+            converter = cls.base_type_converters.get(field.get('base_type'), _to_text)
+        return converter
+
+    def fid(self, name):
+        """Return the fid of the field with the given label or XML name."""
+        try:
+            return self.fids[name]
+        except KeyError:
+            raise KeyError('no field named {0!r}'.format(name))
+
+    def convert(self, record):
+        """Return a copy of record (dict of fid: text value) with typed values."""
+        converters = self.converters
+        return dict((fid, converters[fid](value) if fid in converters else value)
+                    for fid, value in record.items())
+
+
+try:
+    array('q')
+    INT64_TYPECODE = 'q'
+except ValueError:
+    # Python 2 has no 'q'; 'l' is 64-bit on LP64 platforms
+    INT64_TYPECODE = 'l'
+
+
+def _typed_column(values, converter, numpy=False):
+    """Convert a column of text values with converter. Float columns become
+    array('d') with NaN for blanks and int columns array('q') if there are no blanks;
+    with numpy, a NumPy array of the matching dtype.
+
+    >>> _typed_column(['1.5', '', '2'], _to_float)
+    array('d', [1.5, nan, 2.0])
+    >>> _typed_column(['1', '2'], _to_int).typecode == INT64_TYPECODE
+    True
+    """
+    values = [converter(value) if value is not None else None for value in values]
+    if converter is _to_float:
+        values = [value if value is not None else float('nan') for value in values]
+    if numpy:
+        import numpy as np
+        if converter is _to_float:
+            return np.array(values, dtype=np.float64)
+        if converter is _to_int:
+            if None in values:
+                return np.array([value if value is not None else np.nan for value in values],
+                                dtype=np.float64)
+            return np.array(values, dtype=np.int64)
+        if converter is _to_bool:
+            return np.array(values, dtype=np.bool_)
+        if converter is _to_datetime:
+            return np.array(values, dtype='datetime64[ms]')
+        return np.array(values, dtype=object)
+    if converter is _to_float:
+        return array('d', values)
+    if converter is _to_int and None not in values:
+        return array(INT64_TYPECODE, values)
+    return values
+
+
+class Record(object):
+    """Compact query result row. Values are held in a tuple and looked up by fid through
+    an index shared by all the records of a result, so a Record costs far less than a
+    dict. Supports the read-only dict interface.
+
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, fid):
+        return self._values[self._index[fid]]
+
+    def get(self, fid, default=None):
+        i = self._index.get(fid)
+        return self._values[i] if i is not None else default
+
+    def __contains__(self, fid):
+        return fid in self._index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self.keys(), self._values))
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'Record({0!r})'.format(self.to_dict())
+
+
+class RecordView(object):
+    """Lazy query result row wrapping a parsed <record> Element. A field's value is
+    decoded from the Element with parse_field (Client._parse_field) the first time it
+    is read and then memoized, so rows of which only a few fields are read cost
+    little more than the XML parse. Fields can be read by fid or by any name in
+    names, a map of field name to fid. Supports the read-only dict interface, with
+    the same text values as the dicts of do_query.
+
+    The records of a response list their fields in the same order, so the views of
+    one response share positions, a map of fid to the position of its field Element
+    last seen, and a field is normally found without scanning the record.
+
+    """
+    __slots__ = ('_element', '_parse_field', '_names', '_positions', '_values')
+
+    def __init__(self, element, parse_field, names=None, positions=None):
+        self._element = element
+        self._parse_field = parse_field
+        self._names = names or {}
+        self._positions = positions if positions is not None else {}
+        self._values = None
+
+    @staticmethod
+    def _fid(field):
+        return field.get('id') if field.tag == 'f' else field.tag
+
+    def _field(self, fid):
+        """Return the field Element with the given fid, or None."""
+        element = self._element
+        i = self._positions.get(fid)
+        if i is not None and i < len(element):
+            field = element[i]
+            if self._fid(field) == fid:
+                return field
+        for i, field in enumerate(element):
+            if self._fid(field) == fid:
+                self._positions[fid] = i
+                return field
+        return None
+
+    def __getitem__(self, fid):
+        fid = self._names.get(fid, fid)
+        if self._values is None:
+            self._values = {}
+        elif fid in self._values:
+            return self._values[fid]
+        field = self._field(fid)
+        if field is None:
+            raise KeyError(fid)
+        value = self._values[fid] = self._parse_field(field)[1]
+        return value
+
+    def get(self, fid, default=None):
+        try:
+            return self[fid]
+        except KeyError:
+            return default
+
+    def __contains__(self, fid):
+        return self._field(self._names.get(fid, fid)) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._element)
+
+    def keys(self):
+        return [self._fid(field) for field in self._element]
+
+    def values(self):
+        return [self[fid] for fid in self.keys()]
+
+    def items(self):
+        return [(fid, self[fid]) for fid in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'RecordView({0!r})'.format(self.to_dict())
+
+
+class ResponseCache(object):
+    """Bounded LRU cache of parsed responses to read-only API calls, for a Client's
+    cache argument. Entries are keyed by action, dbid and the request fields (other
+    than ticket and apptoken) and expire after the per-action ttls, in seconds;
+    actions without a ttl are not cached. The least recently used entries are evicted
+    to stay within max_entries and max_bytes of response bodies. Writes made through
+    the client invalidate every entry for the table they touch.
+
+    Cached responses are shared between callers and must not be modified.
+
+    """
+    default_ttls = {
+        'DoQuery': 60,
+        'DoQueryCount': 60,
+        'GetSchema': 600,
+        'GetDBPage': 300,
+    }
+    write_actions = frozenset(['AddRecord', 'EditRecord', 'DeleteRecord', 'ImportFromCSV',
+                               'AddReplaceDBPage'])
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttls=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = dict(self.default_ttls)
+        if ttls:
+            self.ttls.update(ttls)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, action):
+        return self.ttls.get(action)
+
+    @classmethod
+    def key(cls, action, database, request):
+        """Return the cache key for a request, independent of field order.
+
+        >>> ResponseCache.key('DoQuery', 'db', {'query': 'q', 'ticket': 't', 'clist': 'a'})
+        ('DoQuery', 'db', (('clist', 'a'), ('query', 'q')))
+        """
+        fields = tuple(sorted((field, _canonical(value)) for field, value in request.items()
+                              if field not in ('ticket', 'apptoken')))
+        return action, database, fields
+
+    def get(self, key):
+        """Return the cached response for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[3]
+
+    def put(self, key, database, response, size):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (time.time() + self.ttl(key[0]), size, database, response)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, database=None):
+        """Drop all entries for the given dbid, or every entry if None."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if database is None or entry[2] == database:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[1]
+
+    def stats(self):
+        """Return a dict of hit/miss counters and current size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+            }
+
+
+def _canonical(value):
+    """Return a hashable form of a request field value."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _canonical(v)) for k, v in value.items()))
+    if isinstance(value, _CSVStream):
+        return id(value)
+    return value
+
+
+class RequestCoalescer(object):
+    """Single-flight bookkeeping for a Client's read-only requests. While a request
+    for some key (as built by ResponseCache.key) is in flight, identical requests
+    wait for it and share its parsed response or exception instead of sending their
+    own. calls counts the requests sent and coalesced those that shared another's.
+
+    """
+    actions = frozenset(['DoQuery', 'DoQueryCount', 'GetDBPage', 'GetSchema', 'GrantedDBs',
+                         'ListDBpages'])
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key, new):
+        """Return (flight, leader): the in-flight call for key, and whether the caller
+        must make it because none was in flight, in which case new() made the flight.
+
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            self.calls += 1
+            flight = self._flights[key] = new()
+            return flight, True
+
+    def end(self, key):
+        with self._lock:
+            del self._flights[key]
+
+    def do(self, key, func):
+        """Return func(), or if a call for key is already in flight, wait for it and
+        return its result or raise its exception.
+
+        """
+        flight, leader = self.begin(key, _Flight)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self.end(key)
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        """Return a dict of the calls sent, calls coalesced and calls in flight."""
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._flights),
+            }
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class RequestEvent(object):
+    """Record of one API call, passed to a Client's hooks. Has the action, dbid, bytes
+    sent and received, the QuickBase errcode (None until a response is read), whether
+    the response came from the cache, how many times it was retried, the error raised
+    if any, elapsed seconds in total, and timings: seconds spent in each phase of the
+    call. The phases are build (serializing the request), connect (until the response
+    headers arrive), transfer (reading the body), decode (choosing its encoding),
+    parse (parsing the XML) and record_parse (turning the XML into records or other
+    results).
+
+    """
+    __slots__ = ('action', 'database', 'bytes_sent', 'bytes_received', 'errcode', 'cached',
+                 'retries', 'error', 'start', 'elapsed', 'timings')
+
+    def __init__(self, action, database):
+        self.action = action
+        self.database = database
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errcode = None
+        self.cached = False
+        self.retries = 0
+        self.error = None
+        self.start = _clock()
+        self.elapsed = None
+        self.timings = {}
+
+    def add(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def sending(self, data):
+        """Count the bytes of a request body, returning it (wrapped, if streamed)."""
+        if isinstance(data, bytes):
+            self.bytes_sent += len(data)
+            return data
+        return self._counted(data)
+
+    def _counted(self, chunks):
+        for chunk in chunks:
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+    def timed(self, phase, chunks):
+        """Yield from chunks, adding the time spent waiting for each one to phase."""
+        chunks = iter(chunks)
+        while True:
+            start = _clock()
+            chunk = next(chunks, None)
+            self.add(phase, _clock() - start)
+            if chunk is None:
+                return
+            yield chunk
+
+    def received(self, size, start):
+        """Record a response body of size bytes read since start; the time not spent
+        in transfer or decode went to parsing it.
+
+        """
+        self.bytes_received += size
+        self.add('parse', _clock() - start - self.timings.get('transfer', 0) -
+                 self.timings.get('decode', 0))
+
+
+class Hook(object):
+    """Base class for a Client's hooks, which override the events they need.
+    before_request is called with the RequestEvent of an API call before it is sent,
+    after_response once its result is parsed, and on_error instead if it raised.
+
+    """
+    def before_request(self, event):
+        pass
+
+    def after_response(self, event):
+        pass
+
+    def on_error(self, event, error):
+        pass
+
+
+class Histogram(object):
+    """Histogram of observations in seconds, counted in buckets with the given upper
+    bounds (and a last one for anything larger), as Prometheus histograms are.
+
+    >>> h = Histogram([0.1, 1])
+    >>> for value in (0.05, 0.2, 0.5, 3):
+    ...     h.observe(value)
+    >>> h.counts, h.percentile(50), h.percentile(99)
+    ([1, 2, 1], 1, inf)
+    """
+    default_bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(bounds or self.default_bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the p-th percentile, or None
+        if there are no observations.
+
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+
+class MetricsCollector(Hook):
+    """Hook that aggregates the RequestEvents of a client in memory. For each action
+    it keeps counts of requests, errors, cache hits and retries, bytes sent and received,
+    counts of each errcode, and a Histogram of total latency and of each phase.
+    Read them with snapshot(), or export them with prometheus().
+
+    """
+    def __init__(self, bounds=None):
+        self.bounds = bounds
+        self.actions = {}
+        self._lock = threading.Lock()
+
+    def after_response(self, event):
+        self._record(event)
+
+    def on_error(self, event, error):
+        self._record(event)
+
+    def _record(self, event):
+        with self._lock:
+            metrics = self.actions.get(event.action)
+            if metrics is None:
+                metrics = self.actions[event.action] = {
+                    'requests': 0, 'errors': 0, 'cached': 0, 'retries': 0, 'bytes_sent': 0,
+                    'bytes_received': 0, 'errcodes': {}, 'latency': Histogram(self.bounds),
+                    'phases': {},
+                }
+            metrics['requests'] += 1
+            metrics['errors'] += event.error is not None
+            metrics['cached'] += event.cached
+            metrics['retries'] += event.retries
+            metrics['bytes_sent'] += event.bytes_sent
+            metrics['bytes_received'] += event.bytes_received
+            if event.errcode is not None:
+                metrics['errcodes'][event.errcode] = metrics['errcodes'].get(event.errcode, 0) + 1
+            metrics['latency'].observe(event.elapsed)
+            for phase, seconds in event.timings.items():
+                if phase not in metrics['phases']:
+                    metrics['phases'][phase] = Histogram(self.bounds)
+                metrics['phases'][phase].observe(seconds)
+
+    def snapshot(self):
+        """Return a dict of action: dict of its counters, plus estimated p50 and p99
+        seconds of total latency and of each phase.
+
+        """
+        def summary(histogram):
+            return {'count': histogram.count, 'sum': histogram.sum,
+                    'p50': histogram.percentile(50), 'p99': histogram.percentile(99)}
+        with self._lock:
+            snapshot = {}
+            for action, metrics in self.actions.items():
+                snapshot[action] = dict(metrics, errcodes=dict(metrics['errcodes']),
+                                        latency=summary(metrics['latency']),
+                                        phases=dict((phase, summary(histogram)) for phase, histogram
+                                                    in metrics['phases'].items()))
+            return snapshot
+
+    def prometheus(self, prefix='quickbase'):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def histogram(name, labels, histogram):
+            total = 0
+            for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                total += count
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, total))
+            lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, histogram.sum))
+            lines.append('{0}_count{{{1}}} {2}'.format(name, labels, histogram.count))
+
+        with self._lock:
+            actions = sorted(self.actions.items())
+            for counter in ('requests', 'errors', 'cached', 'retries', 'bytes_sent',
+                            'bytes_received'):
+                lines.append('# TYPE {0}_{1}_total counter'.format(prefix, counter))
+                for action, metrics in actions:
+                    lines.append('{0}_{1}_total{{action="{2}"}} {3}'.format(
+                        prefix, counter, action, metrics[counter]))
+            lines.append('# TYPE {0}_request_seconds histogram'.format(prefix))
+            for action, metrics in actions:
+                histogram(prefix + '_request_seconds', 'action="{0}"'.format(action),
+                          metrics['latency'])
+            lines.append('# TYPE {0}_phase_seconds histogram'.format(prefix))
+            for action, metrics in actions:
+                for phase, phase_histogram in sorted(metrics['phases'].items()):
+                    histogram(prefix + '_phase_seconds',
+                              'action="{0}",phase="{1}"'.format(action, phase), phase_histogram)
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdHook(Hook):
+    """Hook that sends the metrics of each API call to a statsd server over UDP:
+    counters <prefix>.<action>.requests, .errors, .bytes_sent and .bytes_received,
+    and timers <prefix>.<action>.latency and .<phase> in milliseconds. Sending is best
+    effort; failures are ignored.
+
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='quickbase'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def after_response(self, event):
+        self._send(event)
+
+    def on_error(self, event, error):
+        self._send(event)
+
+    def _send(self, event):
+        name = '{0}.{1}'.format(self.prefix, event.action)
+        lines = ['{0}.requests:1|c'.format(name),
+                 '{0}.bytes_sent:{1}|c'.format(name, event.bytes_sent),
+                 '{0}.bytes_received:{1}|c'.format(name, event.bytes_received),
+                 '{0}.latency:{1:.3f}|ms'.format(name, event.elapsed * 1000)]
+        if event.error is not None:
+            lines.append('{0}.errors:1|c'.format(name))
+        if event.retries:
+            lines.append('{0}.retries:{1}|c'.format(name, event.retries))
+        for phase, seconds in sorted(event.timings.items()):
+            lines.append('{0}.{1}:{2:.3f}|ms'.format(name, phase, seconds * 1000))
+        try:
+            self._socket.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+
+class TokenBucket(object):
+    """Rate limit of rate requests per second, allowing bursts of up to burst
+    requests. reserve() takes a token and returns how long the caller must wait
+    before using it, so waiting callers are served in order.
+
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the seconds to wait until it is available."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class AIMDLimiter(object):
+    """Limit on the number of requests in flight, adapted by additive increase and
+    multiplicative decrease. Each request that completes normally raises the limit by
+    increase / limit (so about increase per round of requests), up to maximum. A
+    request that was throttled, or took longer than latency_target seconds if given,
+    multiplies the limit by decrease, down to minimum and at most once per cooldown
+    seconds so that one burst of failures counts once.
+
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0, decrease=0.5,
+                 latency_target=None, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self):
+        """Take a slot and return True if one is free, otherwise return False."""
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """Wait for a free slot and take it."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False):
+        """Free a slot, adjusting the limit for a request that took latency seconds
+        (None if it failed without a response) and was or was not throttled.
+
+        """
+        with self._condition:
+            self.in_flight -= 1
+            slow = (self.latency_target is not None and latency is not None and
+                    latency > self.latency_target)
+            if throttled or slow:
+                now = time.time()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+
+class Scheduler(object):
+    """Retries, rate limits and concurrency limit for a Client's requests, for its
+    scheduler argument. One Scheduler can be shared by several clients.
+
+    Requests are retried up to max_retries times, after a randomized exponential
+    backoff of up to backoff * 2**attempt seconds (capped at max_backoff, and no less
+    than a Retry-After header asks for). QuickBase throttling (throttle_errcodes, or
+    HTTP throttle_statuses) means the request was refused, so any action is retried.
+    Transient failures (transient_errcodes, HTTP transient_statuses, or no complete
+    response at all) may have been partly processed, so only idempotent_actions are
+    retried unless retry_writes is set. Requests that stream a CSV body from a file
+    object or iterator are never retried, as the body cannot be read again.
+
+    realm_rate and table_rate, if given, limit the requests per second to each realm
+    (base URL) and to each dbid, in bursts of up to burst. limiter is the AIMDLimiter
+    of requests in flight, by default one starting at 4.
+
+    """
+    throttle_errcodes = frozenset(['77'])
+    transient_errcodes = frozenset(['82', '84', '100', '101'])
+    throttle_statuses = frozenset([429, 503])
+    transient_statuses = frozenset([500, 502, 504])
+    idempotent_actions = frozenset(['Authenticate', 'DoQuery', 'DoQueryCount', 'GetDBPage',
+                                    'GetSchema', 'GrantedDBs', 'ListDBpages', 'SignOut'])
+
+    def __init__(self, max_retries=4, backoff=0.5, max_backoff=30, realm_rate=None,
+                 table_rate=None, burst=None, limiter=None, retry_writes=False):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.realm_rate = realm_rate
+        self.table_rate = table_rate
+        self.burst = burst
+        self.limiter = limiter if limiter is not None else AIMDLimiter()
+        self.retry_writes = retry_writes
+        self.retries = 0
+        self.throttled = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, rate):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, self.burst)
+            return bucket
+
+    def delay(self, realm, database):
+        """Reserve a request to database on realm and return the seconds to wait
+        before sending it.
+
+        """
+        wait = 0.0
+        if self.realm_rate:
+            wait = self._bucket(realm, self.realm_rate).reserve()
+        if self.table_rate:
+            wait = max(wait, self._bucket((realm, database), self.table_rate).reserve())
+        return wait
+
+    def acquire(self):
+        self.limiter.acquire()
+
+    def try_acquire(self):
+        return self.limiter.try_acquire()
+
+    def release(self, latency, outcome):
+        """Free the in-flight slot of a request that took latency seconds. outcome is
+        its parsed response, the ConnectionError it raised, or None if it failed
+        otherwise.
+
+        """
+        throttled = self.classify(outcome) == 'throttle'
+        if throttled:
+            with self._lock:
+                self.throttled += 1
+        if outcome is None or (isinstance(outcome, ConnectionError) and outcome.http_response is None):
+            # Failed without a response, which says nothing about the server's load
+            latency = None
+        self.limiter.release(latency, throttled)
+
+    def classify(self, outcome):
+        """Return 'throttle' or 'transient' if a request with the given outcome (as for
+        release) can be retried, otherwise None.
+
+        """
+        if isinstance(outcome, ConnectionError):
+            status = _http_status(outcome.http_response)
+            if status in self.throttle_statuses:
+                return 'throttle'
+            if status is None or status in self.transient_statuses:
+                return 'transient'
+        elif outcome is not None:
+            errcode = outcome.findtext('errcode')
+            if errcode in self.throttle_errcodes:
+                return 'throttle'
+            if errcode in self.transient_errcodes:
+                return 'transient'
+        return None
+
+    def retry_delay(self, action, outcome, attempt):
+        """Return the seconds to wait before retrying action after the given outcome
+        of attempt number attempt (from 0), or None if it should not be retried.
+
+        """
+        kind = self.classify(outcome)
+        if kind is None or attempt >= self.max_retries:
+            return None
+        if kind == 'transient' and not self.retry_writes and action not in self.idempotent_actions:
+            return None
+        with self._lock:
+            self.retries += 1
+        wait = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        headers = getattr(getattr(outcome, 'http_response', None), 'headers', None) or {}
+        try:
+            wait = max(wait, float(headers.get('Retry-After', 0)))
+        except ValueError:
+            pass
+        return wait
+
+    def stats(self):
+        """Return a dict of retry and throttle counters and the concurrency limit."""
+        return {
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'limit': int(self.limiter.limit),
+            'in_flight': self.limiter.in_flight,
+        }
+
+
+def _http_status(response):
+    """Return the HTTP status of a requests or aiohttp response, or None."""
+    if response is None:
+        return None
+    return getattr(response, 'status_code', None) or getattr(response, 'status', None)
+
+
+class Compression(object):
+    """Opt-in HTTP compression for a Client's compression argument. Request bodies of
+    min_size bytes or more, and all streamed bodies (such as ImportFromCSV from a
+    file), are compressed with method, 'gzip' or 'deflate', at the given zlib level
+    and sent with a Content-Encoding header. Responses are requested with
+    Accept-Encoding, and those that arrive compressed are decompressed a chunk at a
+    time as they are fed to the parser.
+
+    stats() reports for each action the bytes before and after compression in each
+    direction, the compression ratios, and an estimate of the seconds saved: the
+    bytes saved at the throughput measured while reading compressed responses, less
+    the time spent compressing and decompressing.
+
+    """
+    wbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+    accept_encoding = 'gzip, deflate'
+
+    def __init__(self, method='gzip', min_size=16 * 1024, level=6):
+        if method not in self.wbits:
+            raise ValueError('unknown compression method {0!r}'.format(method))
+        self.method = method
+        self.min_size = min_size
+        self.level = level
+        self._actions = {}
+        self._lock = threading.Lock()
+
+    def encode(self, action, data):
+        """Return (body, Content-Encoding or None) for a request body given as bytes
+        or an iterable of byte chunks, compressing it if it is streamed or at least
+        min_size bytes.
+
+        """
+        if isinstance(data, bytes):
+            if len(data) < self.min_size:
+                return data, None
+            start = _clock()
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits[self.method])
+            compressed = compressor.compress(data) + compressor.flush()
+            self.record(action, len(data), len(compressed), _clock() - start)
+            return compressed, self.method
+        return self._compressed(action, data), self.method
+
+    def _compressed(self, action, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits[self.method])
+        raw = wire = 0
+        seconds = 0
+        for chunk in chunks:
+            start = _clock()
+            data = compressor.compress(chunk)
+            seconds += _clock() - start
+            raw += len(chunk)
+            wire += len(data)
+            if data:
+                yield data
+        data = compressor.flush()
+        self.record(action, raw, wire + len(data), seconds)
+        yield data
+
+    def decoder(self, action, content_encoding):
+        """Return a _Decoder for a response body with the given Content-Encoding, or
+        None if it is not compressed.
+
+        """
+        encoding = (content_encoding or '').strip().lower()
+        if encoding not in self.wbits:
+            return None
+        return _Decoder(self, action, encoding)
+
+    def record(self, action, raw, wire, seconds, received=False, transfer=0):
+        """Add a body of raw bytes that was wire bytes compressed, taking seconds to
+        compress or decompress, to the stats of action. transfer is the time spent
+        waiting for a received body.
+
+        """
+        prefix = 'received_' if received else 'sent_'
+        with self._lock:
+            counts = self._actions.get(action)
+            if counts is None:
+                counts = self._actions[action] = dict.fromkeys(
+                    ('sent_raw', 'sent_wire', 'received_raw', 'received_wire', 'codec_seconds',
+                     'transfer_seconds'), 0)
+            counts[prefix + 'raw'] += raw
+            counts[prefix + 'wire'] += wire
+            counts['codec_seconds'] += seconds
+            counts['transfer_seconds'] += transfer
+
+    def stats(self):
+        """Return a dict of action: dict of byte counts, sent_ratio and received_ratio
+        (raw over compressed bytes, None until there are some) and seconds_saved (None
+        until a compressed response has been timed).
+
+        """
+        with self._lock:
+            actions = dict((action, dict(counts)) for action, counts in self._actions.items())
+        wire = sum(counts['received_wire'] for counts in actions.values())
+        transfer = sum(counts['transfer_seconds'] for counts in actions.values())
+        throughput = wire / transfer if wire and transfer else None
+        for counts in actions.values():
+            for direction in ('sent', 'received'):
+                raw, wire = counts[direction + '_raw'], counts[direction + '_wire']
+                counts[direction + '_ratio'] = float(raw) / wire if wire else None
+            saved = (counts['sent_raw'] - counts['sent_wire'] + counts['received_raw'] -
+                     counts['received_wire'])
+            counts['seconds_saved'] = (saved / throughput - counts['codec_seconds']
+                                       if throughput else None)
+        return actions
+
+
+class _Decoder(object):
+    """Incremental decompressor for one compressed response body, recording its sizes
+    and timings into a Compression's stats when closed.
+
+    """
+    def __init__(self, compression, action, encoding):
+        self.compression = compression
+        self.action = action
+        self.encoding = encoding
+        # gzip bodies are decoded with zlib header autodetection
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS if encoding == 'gzip'
+                                               else zlib.MAX_WBITS)
+        self.raw = 0
+        self.wire = 0
+        self.seconds = 0
+        self.transfer = 0
+
+    def feed(self, chunk):
+        """Return the decompressed data of the next chunk of the body."""
+        start = _clock()
+        try:
+            data = self.decompressor.decompress(chunk)
+        except zlib.error as e:
+            if self.encoding != 'deflate' or self.wire:
+                raise XMLError(-1, 'bad {0} response: {1}'.format(self.encoding, e))
+            # Some servers send deflate data without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.feed(chunk)
+        self.seconds += _clock() - start
+        self.wire += len(chunk)
+        self.raw += len(data)
+        return data
+
+    def close(self):
+        """Return the rest of the decompressed body and record the stats."""
+        data = self.decompressor.flush()
+        self.raw += len(data)
+        self.compression.record(self.action, self.raw, self.wire, self.seconds, received=True,
+                                transfer=self.transfer)
+        return data
+
+    def decode(self, chunks):
+        """Yield the decompressed body from an iterable of compressed chunks."""
+        chunks = iter(chunks)
+        while True:
+            start = _clock()
+            chunk = next(chunks, None)
+            self.transfer += _clock() - start
+            if chunk is None:
+                break
+            data = self.feed(chunk)
+            if data:
+                yield data
+        data = self.close()
+        if data:
+            yield data
+
+
+class MemoryTicketProvider(object):
+    """Store of authentication tickets shared by the Clients of one process, for their
+    ticket_provider argument. Tickets are kept as (ticket, user_id, expiry time)
+    keyed by (realm, username). Any object with the same lock(), get() and put()
+    methods can be used as a ticket provider.
+
+    """
+    def __init__(self):
+        self._tickets = {}
+        self._lock = threading.RLock()
+
+    def lock(self, key):
+        """Return a context manager holding the store exclusively, so that only one
+        client at a time checks for and renews the ticket of key.
+
+        """
+        return self._lock
+
+    def get(self, key):
+        """Return the (ticket, user_id, expires) stored for key, or None."""
+        with self._lock:
+            return self._tickets.get(key)
+
+    def put(self, key, ticket, user_id, expires):
+        with self._lock:
+            self._tickets[key] = (ticket, user_id, expires)
+
+
+class FileTicketProvider(object):
+    """Ticket provider shared across processes through a JSON file at path, which is
+    only readable by its owner. The store is locked with an advisory lock on
+    path + '.lock' while a client checks for and renews a ticket, so concurrent
+    processes authenticate once between them.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._thread_lock = threading.RLock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def lock(self, key=None):
+        with self._thread_lock:
+            if getattr(self._local, 'file', None) is not None:
+                # Already held by this thread
+                yield
+                return
+            with open(self.lock_path, 'a') as f:
+                _lock_file(f)
+                self._local.file = f
+                try:
+                    yield
+                finally:
+                    self._local.file = None
+                    _unlock_file(f)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self.lock(key):
+            entry = self._read().get('|'.join(key))
+        return tuple(entry) if entry else None
+
+    def put(self, key, ticket, user_id, expires):
+        with self.lock(key):
+            tickets = self._read()
+            now = time.time()
+            tickets = dict((k, v) for k, v in tickets.items() if v[2] > now)
+            tickets['|'.join(key)] = [ticket, user_id, expires]
+            temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(tickets, f)
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class _RecordReader(object):
+    """Incremental parser for a DoQuery response that is fed the body a chunk at a
+    time. Each <record> is parsed with the client's _parse_record as soon as it is
+    complete and then discarded, so memory use does not grow with the response.
+
+    """
+    def __init__(self, client, encoding=None):
+        self.client = client
+        self.root = None
+        self.parser = client.xml.pull_parser(('qdbapi', 'errtext', 'record'), encoding)
+
+    def feed(self, chunk):
+        """Feed the next chunk of the body and return the list of records it
+        completed. Raises ResponseError as soon as a QuickBase error is seen.
+
+        """
+        try:
+            self.parser.feed(chunk)
+        except self.client.xml.error as e:
+            raise XMLError(-1, e)
+        records = []
+        for event, element in self.parser.read_events():
+            if event == 'start':
+                if element.tag == 'qdbapi':
+                    self.root = element
+            elif element.tag == 'errtext':
+                # errcode precedes errtext, so fail before any records
+                self.client._check_response(self.root)
+            elif element.tag == 'record':
+                records.append(self.client._parse_record(element))
+                self.parser.release(element)
+        return records
 
+    def close(self):
+        """Finish parsing and check the response errcode."""
+        try:
+            root = self.parser.close()
+        except self.client.xml.error as e:
+            raise XMLError(-1, e)
+        self.client._check_response(root)
 
-class ConnectionError(Error):
-    pass
 
+_RECORD_START = re.compile(br'<record[\s/>]')
+_RECORD_END = b'</record>'
+_DECLARED_ENCODING = re.compile(br'^<\?xml[^>]*encoding=["\']([A-Za-z0-9._:-]+)')
 
-class ResponseError(Error):
-    pass
 
+def _record_ranges(buf, parts):
+    """Split the records of buf, the bytes (or mmap) of a DoQuery response, into about
+    parts (start, end) byte ranges that start and end at <record> boundaries and
+    together cover every record, in order. Returns [] if there are no records.
 
-class QuickBaseError(Error):
-    pass
+    >>> body = b'<qdbapi><records><record>1</record><record>2</record></records></qdbapi>'
+    >>> _record_ranges(body, 2)
+    [(17, 35), (35, 53)]
+    >>> _record_ranges(body, 1)
+    [(17, 53)]
+    >>> _record_ranges(b'<qdbapi><records/></qdbapi>', 2)
+    []
 
+    """
+    match = _RECORD_START.search(buf)
+    last = buf.rfind(_RECORD_END)
+    if match is None or last < match.start():
+        return []
+    first, end = match.start(), last + len(_RECORD_END)
+    step = max(1, (end - first) // parts)
+    ranges = []
+    start = first
+    while start < end:
+        match = _RECORD_START.search(buf, min(start + step, end), end)
+        stop = match.start() if match is not None else end
+        ranges.append((start, stop))
+        start = stop
+    return ranges
 
-class XMLError(Error):
-    pass
 
+def _parse_record_range(task):
+    """Parse the records in one byte range of a DoQuery response file into a list of
+    dicts with cls._parse_records. Runs in the worker processes of
+    Client._parse_parallel, which pass only the file's path and offsets.
 
-def to_xml_name(name):
-    """Convert field name to tag-like name as used in QuickBase XML.
-    >>> to_xml_name('This is a Field')
-    'this_is_a_field'
-    >>> to_xml_name('800 Number')
-    '_800_number'
-    >>> to_xml_name('A & B')
-    'a___b'
-    >>> to_xml_name('# of Whatevers')
-    '___of_whatevers'
     """
-    xml_name = ''.join((ch if ch.isalnum() else '_') for ch in name.lower())
-    if not xml_name[0].isalpha():
-        xml_name = '_' + xml_name
-    return xml_name
+    cls, backend, path, encoding, start, end = task
+    xml = get_xml_backend(backend)
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            parser = xml.parser(encoding)
+            parser.feed(b'<records>')
+            for offset in range(start, end, cls.chunk_size):
+                parser.feed(buf[offset:min(offset + cls.chunk_size, end)])
+            parser.feed(b'</records>')
+            return cls._parse_records(parser.close())
+        except xml.error as e:
+            # Parser errors do not all survive pickling back to the parent
+            raise XMLError(-1, str(e))
+        finally:
+            buf.close()
 
 
 class Client(object):
     """Client to the QuickBase API."""
 
+    # Size of the blocks response bodies are read and parsed in
+    chunk_size = 64 * 1024
+    # Smallest DoQuery response do_query(processes=...) parses in worker processes
+    parallel_min_bytes = 4 * 1024 * 1024
+
     @classmethod
     def _build_request(cls, **request_fields):
         r"""Build QuickBase request XML with given fields. Fields can be straight
         key=value, or if value is a 2-tuple it represents (attr_dict, value), or if
         value is a list of values or 2-tuples the output will contain multiple entries.
 
-        >>> Client._build_request(a=1, b=({}, 'c'), d=({'f': 1}, 'e'))
-        '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<qdbapi><a>1</a><b>c</b><d f="1">e</d></qdbapi>'
-        >>> Client._build_request(f=['a', 'b'])
-        "<?xml version='1.0' encoding='UTF-8'?>\n<qdbapi><f>a</f><f>b</f></qdbapi>"
-        >>> Client._build_request(f=[({'n': 1}, 't1'), ({'n': 2}, 't2')])
-        '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<qdbapi><f n="1">t1</f><f n="2">t2</f></qdbapi>'
+        >>> print(Client._build_request(a=1, b=({}, 'c'), d=({'f': 1}, 'e')).decode('utf-8'))
+        <?xml version='1.0' encoding='UTF-8'?>
+        <qdbapi><a>1</a><b>c</b><d f="1">e</d></qdbapi>
+        >>> print(Client._build_request(f=['a', 'b']).decode('utf-8'))
+        <?xml version='1.0' encoding='UTF-8'?>
+        <qdbapi><f>a</f><f>b</f></qdbapi>
+        >>> print(Client._build_request(f=[({'n': 1}, 't1'), ({'n': 2}, 't2')]).decode('utf-8'))
+        <?xml version='1.0' encoding='UTF-8'?>
+        <qdbapi><f n="1">t1</f><f n="2">t2</f></qdbapi>
+
+        The XML is written directly by _serialize_fields; fields it cannot handle (odd
+        tag names, or values lxml would reject) go through _build_request_etree, which
+        produces identical output with the default XML backend.
 
         """
-        request = etree.Element('qdbapi')
-        doc = etree.ElementTree(request)
+        body = cls._serialize_fields(request_fields)
+        if body is None:
+            return cls._build_request_etree(**request_fields)
+        return _XML_DECLARATION + b'<qdbapi>' + body + b'</qdbapi>'
 
-        def add_sub_element(field, value):
-            if isinstance(value, tuple):
-                attrib, value = value
-                attrib = dict((k, str(v)) for k, v in attrib.iteritems())
-            else:
-                attrib = {}
-            sub_element = etree.SubElement(request, field, **attrib)
-            if not isinstance(value, basestring):
-                value = str(value)
-            sub_element.text = value
+    @classmethod
+    def _serialize_fields(cls, request_fields):
+        """Serialize request fields to UTF-8 XML elements, escaped as lxml does, or
+        return None if a field needs the lxml path.
 
-        for field, values in request_fields.iteritems():
-            if not isinstance(values, list):
-                values = [values]
-            for value in values:
-                add_sub_element(field, value)
+        >>> Client._serialize_fields({'a': ({'x': 'a"b'}, '<&>\\r\\n')}) == b'<a x="a&quot;b">&lt;&amp;&gt;&#13;\\n</a>'
+        True
+        """
+        parts = []
+        try:
+            for field, values in request_fields.items():
+                if not _XML_NAME.match(field):
+                    return None
+                if not isinstance(values, list):
+                    values = [values]
+                for value in values:
+                    if isinstance(value, tuple):
+                        attrib, value = value
+                        parts.append(u'<' + field)
+                        for name, attr_value in attrib.items():
+                            if not _XML_NAME.match(name):
+                                return None
+                            parts.append(u' {0}="{1}"'.format(name, _xml_escape(_xml_text(str(attr_value)), True)))
+                        parts.append(u'>')
+                    else:
+                        parts.append(u'<' + field + u'>')
+                    if not isinstance(value, basestring):
+                        value = str(value)
+                    parts.append(_xml_escape(_xml_text(value), False))
+                    parts.append(u'</' + field + u'>')
+        except ValueError:
+            return None
+        return u''.join(parts).encode('utf-8')
+
+    @classmethod
+    def _build_request_etree(cls, **request_fields):
+        """Build request XML as _build_request does, with the default XML backend."""
+        return get_xml_backend().build_request(request_fields)
+
+    @classmethod
+    def _stream_request(cls, **request_fields):
+        """Generate request XML in chunks for a request with _CSVStream fields, which
+        are read and written out as CDATA sections a chunk at a time instead of being
+        held in memory. Other fields are built by _build_request.
+
+        """
+        streams = dict((k, v) for k, v in request_fields.items() if isinstance(v, _CSVStream))
+        fields = dict((k, v) for k, v in request_fields.items() if k not in streams)
+        head = cls._build_request(**fields)
+        end = b'</qdbapi>'
+        yield head[:-len(end)]
+        for field, stream in streams.items():
+            yield ('<{0}><![CDATA['.format(field)).encode('ascii')
+            for chunk in _cdata_escape(stream):
+                yield chunk.encode('utf-8')
+            yield (']]></{0}>'.format(field)).encode('ascii')
+        yield end
+
+    @classmethod
+    def _parse_field(cls, fields):
+        """Parse a field Element of a <record> into a (fid, value) pair."""
+        if fields.tag == 'f':
+            fid = fields.get('id')
+        else:
+            fid = fields.tag
+        value = fields.text or ''
+        for child in fields:
+            if child.tag == 'url':
+                value = child.text
+            elif child.tail is not None:
+                value += child.tail
+        return fid, value
 
-        return etree.tostring(doc, xml_declaration=True, encoding="utf-8")
+    @classmethod
+    def _parse_record(cls, row):
+        """Parse a single <record> Element into a dict."""
+        return dict(cls._parse_field(fields) for fields in row)
 
     @classmethod
     def _parse_records(cls, response):
         """Parse records in given XML response into a list of dicts."""
-        records = []
-        r = response.xpath('.//record')
-        for row in r:
-            record = {}
+        return [cls._parse_record(row) for row in response.iter('record')]
+
+    @classmethod
+    def _parse_views(cls, response, names=None):
+        """Return a RecordView of each record in given XML response."""
+        positions = {}
+        return [RecordView(row, cls._parse_field, names, positions)
+                for row in response.iter('record')]
+
+    @classmethod
+    def _parse_columns(cls, response):
+        """Parse records in given XML response into an OrderedDict of fid: list of
+        values, in the order fields first appear. Fields missing from a record are None.
+
+        """
+        columns = collections.OrderedDict()
+        count = 0
+        for row in response.iter('record'):
             for fields in row:
-                if fields.tag == 'f':
-                    fid = fields.get('id')
-                else:
-                    fid = fields.tag
-                if fields.text:
-                    record[fid] = fields.text
-                else:
-                    record[fid] = ''
-                for child in fields:
-                    if child.tag == 'url':
-                        record[fid] = child.text
-                    elif child.tail is not None:
-                        record[fid] += child.tail
-            records.append(record)
-        return records
+                fid, value = cls._parse_field(fields)
+                column = columns.get(fid)
+                if column is None:
+                    column = columns[fid] = [None] * count
+                elif len(column) < count:
+                    column.extend([None] * (count - len(column)))
+                column.append(value)
+            count += 1
+        for column in columns.values():
+            column.extend([None] * (count - len(column)))
+        return columns
+
+    @classmethod
+    def _parse_result(cls, response, result, schema):
+        """Parse a DoQuery response into the given do_query result form, converting
+        each column in one pass with the schema's converters.
+
+        """
+        columns = cls._parse_columns(response)
+        for fid, column in columns.items():
+            converter = schema.converters.get(fid)
+            if converter is not None:
+                columns[fid] = _typed_column(column, converter, numpy=(result == 'numpy'))
+        if result == 'records':
+            index = dict((fid, i) for i, fid in enumerate(columns))
+            return [Record(index, values) for values in zip(*columns.values())]
+        return columns
 
     @classmethod
     def _parse_schema(cls, response):
         """ Parse schema into list of Child DBIDs or Fields
             Returns list of dicts for each field or child table
         """
-        tables = response.xpath('.//chdbid')
-        fields = response.xpath('.//field')
+        tables = list(response.iter('chdbid'))
+        fields = list(response.iter('field'))
         rows = []
         if tables:
             for t in tables:
@@ -141,10 +1871,10 @@ class Client(object):
         elif fields:
             for f in fields:
                 field = {x[0]: x[1] for x in f.items()}
-                for child in f.iterchildren():
+                for child in f:
                     tag = child.tag
                     if tag == 'choices':
-                        choices = tuple(c.text for c in child.iterchildren())
+                        choices = tuple(c.text for c in child)
                         field['choices'] = choices
                     else:
                         field[child.tag] = child.text
@@ -154,16 +1884,18 @@ class Client(object):
     @classmethod
     def _parse_db_page(cls, response):
         """Parse DBPage from QuickBase"""
-        r = response.xpath('.//pagebody/text()')
-        r = ''.join([s.encode('utf-8').rstrip() for s in r if s.strip()])
-        return r
+        r = []
+        for page in response.iter('pagebody'):
+            r.append(page.text)
+            r.extend(child.tail for child in page)
+        r = ''.join([s.rstrip() for s in r if s and s.strip()])
+        return r.encode('utf-8') if PY2 else r
 
     @classmethod
     def _parse_list_pages(cls, response):
         """Parse list of pages with id, type, name"""
         pages = []
-        r = response.xpath('.//page')
-        for row in r:
+        for row in response.iter('page'):
             if row.attrib['id'] != '':
                 pages.append([
                     row.attrib['id'],
@@ -173,72 +1905,80 @@ class Client(object):
         return pages
 
     def __init__(self, username=None, password=None, base_url='https://www.quickbase.com',
-                 timeout=30, authenticate=True, database=None, apptoken=None, realmhost=None, hours=12, ticket=None):
+                 timeout=30, authenticate=True, database=None, apptoken=None, realmhost=None, hours=12, ticket=None,
+                 transport=None, detect_encoding=False, schema_ttl=600, cache=None, hooks=None,
+                 scheduler=None, coalesce=False, ticket_provider=None, xml_backend=None,
+                 compression=None):
 
         """Initialize a Client with given username and password. Authenticate immediately
-        unless authenticate is False.
+        unless authenticate is False. HTTP requests go through transport, by default a
+        pooled keep-alive Transport using the given timeout. Set detect_encoding to
+        guess the encoding of responses that do not declare one with chardet. Table
+        schemas loaded by schema() are cached for schema_ttl seconds. Pass a
+        ResponseCache as cache to cache responses to read-only requests. hooks is a list
+        of Hook objects to call around each API call with its RequestEvent. Pass a
+        Scheduler as scheduler to retry throttled and failed requests and limit their
+        rate and concurrency. Set coalesce to have concurrent identical read-only
+        requests share one HTTP call; see RequestCoalescer.
+
+        With a ticket_provider (such as a MemoryTicketProvider or FileTicketProvider),
+        clients for the same realm and username share one ticket instead of each
+        authenticating, and renew it in the background ticket_renew_margin seconds
+        before it expires. Any client with a username and password authenticates again
+        and retries once when a request fails because its ticket expired, unless the
+        request streamed a CSV body that cannot be read again.
+
+        xml_backend is the XMLBackend used to parse responses, by default lxml if it is
+        installed and the standard library's ElementTree otherwise (see get_xml_backend).
+        Pass a Compression as compression to compress large request bodies and accept
+        compressed responses.
 
         """
         self.username = username
         self.password = password
         self.base_url = base_url
         self.timeout = timeout
+        self.transport = transport if transport is not None else Transport(timeout=timeout)
+        self.xml = xml_backend if xml_backend is not None else get_xml_backend()
+        self.compression = compression
+        self.detect_encoding = detect_encoding
         self.database = database
         self.apptoken = apptoken
         self.realmhost = realmhost
         self.hours = hours
+        self.schema_ttl = schema_ttl
+        self.cache = cache
+        self.hooks = list(hooks) if hooks else []
+        self.scheduler = scheduler
+        self.coalescer = RequestCoalescer() if coalesce else None
+        self.ticket_provider = ticket_provider
+        self.ticket = ticket
+        self.ticket_expires = None
+        self._ticket_lock = threading.Lock()
+        self._renewal = None
+        self._standard_cache = {}
+        self._schemas = {}
         if authenticate:
-            self.authenticate()
-        elif ticket is not None:
-            self.ticket = ticket
+            if ticket_provider is not None:
+                self._load_ticket()
+            else:
+                self.authenticate()
 
-    def request(self, action, database, request, required=None, ticket=True,
-                apptoken=True):
-        """Do a QuickBase request and return the parsed XML response. Raises appropriate
-        Error subclass on HTTP, response or QuickBase error. If fields list given,
-        return dict with all fields in list (raises ResponseError if any not present),
-        otherwise return parsed xml Element.
+    @classmethod
+    def _check_response(cls, parsed, required=None):
+        """Check the errcode of a parsed response and raise ResponseError if it is
+        missing or non-zero. Return dict of the required fields if given, otherwise
+        the parsed Element itself.
 
         """
-        # Do the POST request with additional QuickBase headers
-        url = self.base_url + '/db/' + database
-        if ticket:
-            request['ticket'] = self.ticket
-        if apptoken:
-            request['apptoken'] = self.apptoken
-
-        request['encoding'] = 'UTF-8'
-        request['msInUTC'] = 1
-        if self.realmhost:
-            request['realmhost'] = self.realmhost
-        data = self._build_request(**request)
-        headers = {
-            'Content-Type': 'application/xml',
-            'QUICKBASE-ACTION': 'API_' + action,
-        }
-        response = ""
-        request = requests.post(url, data, headers=headers, stream=True)
-        if request.status_code == 200:
-            for chunk in request.iter_content(2048):
-                encode = chardet.detect(chunk)['encoding']
-                if encode != 'utf-8':
-                    chunk = chunk.decode(encode, 'replace').encode('utf-8')
-                response += chunk
-
-        try:
-            parsed = etree.fromstring(response)
-        except etree.XMLSyntaxError as e:
-            raise XMLError(-1, e, response=response)
-        except etree.DocumentInvalid as e:
-            raise XMLError(-1, e, response=response)
-
         error_code = parsed.findtext('errcode')
         if error_code is None:
-            raise ResponseError(-4, '"errcode" not in response', response=response)
+            raise ResponseError(-4, '"errcode" not in response', response=_xml_bytes(parsed),
+                                parsed=parsed)
         if error_code != '0':
             error_text = parsed.find('errtext')
             error_text = error_text.text if error_text is not None else '[no error text]'
-            raise ResponseError(error_code, error_text, response=response)
+            raise ResponseError(error_code, error_text, response=_xml_bytes(parsed), parsed=parsed)
 
         if required:
             # Build dict of required response fields caller asked for
@@ -247,28 +1987,447 @@ class Client(object):
                 value = parsed.find(field)
                 if value is None:
                     raise ResponseError(-4, '"{0}" not in response'.format(field),
-                                        response=response)
+                                        response=_xml_bytes(parsed), parsed=parsed)
                 values[field] = value.text or ''
             return values
         else:
             # Return parsed XML directly
             return parsed
 
+    def _standard_fields(self, ticket=True, apptoken=True):
+        """Return the ticket, apptoken and other fields sent with every request."""
+        request = {}
+        if ticket:
+            request['ticket'] = self.ticket
+        if apptoken:
+            request['apptoken'] = self.apptoken
+
+        request['encoding'] = 'UTF-8'
+        request['msInUTC'] = 1
+        if self.realmhost:
+            request['realmhost'] = self.realmhost
+        return request
+
+    def _standard_xml(self, ticket=True, apptoken=True):
+        """Return the serialized _standard_fields, cached until they change."""
+        key = (ticket and self.ticket, apptoken and self.apptoken, self.realmhost)
+        xml = self._standard_cache.get(key)
+        if xml is None:
+            xml = self._serialize_fields(self._standard_fields(ticket, apptoken))
+            if len(self._standard_cache) > 8:
+                self._standard_cache.clear()
+            self._standard_cache[key] = xml
+        return xml
+
+    def _prepare(self, action, database, request, ticket=True, apptoken=True):
+        """Return the (url, data, headers) to POST for the given action, adding the
+        ticket, apptoken and other standard fields to the request XML.
+
+        """
+        url = self.base_url + '/db/' + database
+        data = None
+        if any(isinstance(value, _CSVStream) for value in request.values()):
+            request.update(self._standard_fields(ticket, apptoken))
+            data = self._stream_request(**request)
+        else:
+            body = self._serialize_fields(request)
+            standard = self._standard_xml(ticket, apptoken) if body is not None else None
+            if standard is not None:
+                data = _XML_DECLARATION + b'<qdbapi>' + body + standard + b'</qdbapi>'
+            else:
+                request.update(self._standard_fields(ticket, apptoken))
+                data = self.xml.build_request(request)
+        headers = {
+            'Content-Type': 'application/xml',
+            'QUICKBASE-ACTION': 'API_' + action,
+        }
+        if self.compression is not None:
+            headers['Accept-Encoding'] = self.compression.accept_encoding
+            data, content_encoding = self.compression.encode(action, data)
+            if content_encoding is not None:
+                headers['Content-Encoding'] = content_encoding
+        return url, data, headers
+
+    def _send(self, action, database, request, ticket=True, apptoken=True, event=None):
+        """POST the request for the given action and return the streaming HTTP
+        response; the caller must consume or close it. Raises ConnectionError on a
+        non-200 status. Timings and bytes sent are recorded into event if given.
+
+        """
+        if event is not None:
+            start = _clock()
+        url, data, headers = self._prepare(action, database, request, ticket, apptoken)
+        if event is not None:
+            data = event.sending(data)
+            start = self._timed(event, 'build', start)
+        response = self.transport.post(url, data, headers=headers, stream=True)
+        if event is not None:
+            self._timed(event, 'connect', start)
+        if response.status_code != 200:
+            try:
+                body = b''.join(_transfer(response.iter_content(self.chunk_size)))
+            except ConnectionError:
+                body = None
+            finally:
+                response.close()
+            raise ConnectionError(-2, 'HTTP {0}: {1}'.format(response.status_code, response.reason),
+                                  response=body, http_response=response)
+        return response
+
+    def _body(self, response, action=None):
+        """Return an iterator over the body of a streaming HTTP response in chunks. With
+        compression, a compressed body is decompressed here as it arrives, so that its
+        sizes are counted; otherwise requests decompresses it. Raises ConnectionError
+        if the connection fails before the body is complete.
+
+        """
+        decoder = None
+        if self.compression is not None:
+            decoder = self.compression.decoder(action, response.headers.get('content-encoding'))
+        if decoder is None:
+            return _transfer(response.iter_content(self.chunk_size))
+        return _transfer(decoder.decode(response.raw.stream(self.chunk_size, decode_content=False)))
+
+    def _response_encoding(self, response, first_chunk):
+        """Return the encoding to decode a response body with, or None to let the parser
+        use the XML declaration. A charset in the Content-Type header wins; otherwise,
+        if detect_encoding is set, chardet is run once on the first chunk.
+
+        """
+        import email.message
+        content_type = email.message.Message()
+        content_type['content-type'] = response.headers.get('content-type', '')
+        encoding = content_type.get_param('charset')
+        if encoding is None and self.detect_encoding and first_chunk:
+            import chardet
+            encoding = chardet.detect(first_chunk)['encoding']
+        if encoding is None or encoding.lower() in ('ascii', 'utf-8', 'utf8'):
+            # UTF-8 is the XML default and ASCII is a subset of it
+            return None
+        return encoding
+
+    def _parser(self, response, first_chunk, event=None):
+        """Return an XMLParser for the body of response, timing the choice of its
+        encoding into event if given.
+
+        """
+        if event is None:
+            return self.xml.parser(self._response_encoding(response, first_chunk))
+        start = _clock()
+        encoding = self._response_encoding(response, first_chunk)
+        self._timed(event, 'decode', start)
+        return self.xml.parser(encoding)
+
+    @staticmethod
+    def _timed(event, phase, start):
+        """Add the time since start to phase of event and return the current time."""
+        now = _clock()
+        event.add(phase, now - start)
+        return now
+
+    def _read_response(self, response, event=None, action=None):
+        """Feed the body of a streaming HTTP response to action into an incremental
+        parser as it downloads and return (root Element, body size in bytes). Raises
+        XMLError if it does not parse. Timings and bytes received are recorded into
+        event if given.
+
+        """
+        head = _BodyHead()
+        try:
+            chunks = self._body(response, action)
+            if event is not None:
+                chunks = event.timed('transfer', chunks)
+                start = _clock()
+            parser = None
+            size = 0
+            for chunk in chunks:
+                if parser is None:
+                    parser = self._parser(response, chunk, event)
+                head.add(chunk)
+                parser.feed(chunk)
+                size += len(chunk)
+            if parser is None:
+                raise XMLError(-1, 'empty response')
+            root = parser.close()
+            if event is not None:
+                event.received(size, start)
+            return root, size
+        except self.xml.error as e:
+            raise head.attach(XMLError(-1, e))
+        except XMLError as e:
+            head.attach(e)
+            raise
+        finally:
+            # Hand the connection back to the pool
+            response.close()
+
+    def request(self, action, database, request, required=None, ticket=True,
+                apptoken=True, event=None):
+        """Do a QuickBase request and return the parsed XML response. Raises appropriate
+        Error subclass on HTTP, response or QuickBase error. If fields list given,
+        return dict with all fields in list (raises ResponseError if any not present),
+        otherwise return parsed xml Element.
+
+        If the client has a cache, read-only actions are answered from it when
+        possible, and writes invalidate the cached responses for their table.
+
+        If the client coalesces requests, a read-only request identical to one already
+        in flight waits for and shares that one's response.
+
+        If the client has hooks, they are called with a RequestEvent for the request,
+        unless the caller passes its own event to record into and reports it itself.
+
+        """
+        if event is None and self.hooks:
+            return self._call(action, database, request, required=required, ticket=ticket,
+                              apptoken=apptoken)
+        cache_key = self._cache_key(action, database, request)
+        if cache_key is not None:
+            parsed = self.cache.get(cache_key)
+            if parsed is not None:
+                if event is not None:
+                    event.cached = True
+                    event.errcode = parsed.findtext('errcode')
+                return self._check_response(parsed, required)
+        used_ticket = self.ticket
+        parsed, size = self._fetch(action, database, request, ticket, apptoken, event)
+        if ticket and self._ticket_expired(parsed) and self._renew_refused(used_ticket, request):
+            parsed, size = self._fetch(action, database, request, ticket, apptoken, event)
+        if event is not None:
+            event.errcode = parsed.findtext('errcode')
+        result = self._check_response(parsed, required)
+        if cache_key is not None:
+            self.cache.put(cache_key, database, parsed, size)
+        return result
+
+    def _fetch(self, action, database, request, ticket, apptoken, event):
+        """Return the (parsed response, size) of a request, made through the scheduler
+        and coalescer if the client has them.
+
+        """
+        fetch = self._attempt if self.scheduler is None else self._scheduled
+        flight_key = self._flight_key(action, database, request)
+        if flight_key is None:
+            return fetch(action, database, request, ticket, apptoken, event)
+        return self.coalescer.do(
+            flight_key, lambda: fetch(action, database, request, ticket, apptoken, event))
+
+    def _attempt(self, action, database, request, ticket, apptoken, event):
+        """Send a request once and return (parsed response, size) unchecked."""
+        try:
+            response = self._send(action, database, request, ticket=ticket, apptoken=apptoken,
+                                  event=event)
+            return self._read_response(response, event, action)
+        finally:
+            self._invalidate_cache(action, database)
+
+    @staticmethod
+    def _replayable(request):
+        """Return whether request can be sent again, which it cannot if it streams a
+        CSV body that the first attempt used up.
+
+        """
+        return all(value.replayable for value in request.values() if isinstance(value, _CSVStream))
+
+    def _scheduled(self, action, database, request, ticket, apptoken, event):
+        """Make request attempts as the scheduler allows, retrying while it says to,
+        and return the last (parsed response, size). A request whose body cannot be
+        sent again is not retried.
+
+        """
+        scheduler = self.scheduler
+        replayable = self._replayable(request)
+        for attempt in itertools.count():
+            time.sleep(scheduler.delay(self.base_url, database))
+            scheduler.acquire()
+            start = _clock()
+            outcome = None
+            try:
+                parsed, size = self._attempt(action, database, request, ticket, apptoken, event)
+                outcome = parsed
+            except ConnectionError as e:
+                outcome = e
+                wait = scheduler.retry_delay(action, e, attempt) if replayable else None
+                if wait is None:
+                    raise
+            else:
+                wait = scheduler.retry_delay(action, parsed, attempt) if replayable else None
+                if wait is None:
+                    return parsed, size
+            finally:
+                scheduler.release(_clock() - start, outcome)
+            if event is not None:
+                event.retries += 1
+            time.sleep(wait)
+
+    def _flight_key(self, action, database, request):
+        if self.coalescer is None or action not in self.coalescer.actions:
+            return None
+        return ResponseCache.key(action, database, request)
+
+    def _cache_key(self, action, database, request):
+        if self.cache is None or not self.cache.ttl(action):
+            return None
+        return self.cache.key(action, database, request)
+
+    def _invalidate_cache(self, action, database):
+        if self.cache is not None and action in self.cache.write_actions:
+            self.cache.invalidate(database)
+
+    def _call(self, action, database, request, required=None, parse=None, **kwargs):
+        """Do a request and return the response, passed through parse if given. The API
+        methods all go through here, so subclasses can change how calls are made
+        (AsyncClient returns a coroutine instead).
+
+        """
+        if not self.hooks:
+            response = self.request(action, database, request, required=required, **kwargs)
+            return parse(response) if parse else response
+        event = self._start_event(action, database)
+        try:
+            response = self.request(action, database, request, required=required, event=event,
+                                    **kwargs)
+            if parse:
+                start = _clock()
+                response = parse(response)
+                self._timed(event, 'record_parse', start)
+        except Exception as e:
+            self._end_event(event, e)
+            raise
+        self._end_event(event)
+        return response
+
+    def _start_event(self, action, database):
+        """Return a new RequestEvent, after calling the before_request hooks."""
+        event = RequestEvent(action, database)
+        for hook in self.hooks:
+            hook.before_request(event)
+        return event
+
+    def _end_event(self, event, error=None):
+        """Call the after_response hooks with event, or on_error if error given."""
+        event.elapsed = _clock() - event.start
+        if error is None:
+            for hook in self.hooks:
+                hook.after_response(event)
+        else:
+            event.error = error
+            for hook in self.hooks:
+                hook.on_error(event, error)
+
+    def close(self):
+        """Close the transport and any pooled connections it holds."""
+        if self._renewal is not None:
+            self._renewal.cancel()
+        self.transport.close()
+
     def authenticate(self):
         """Authenticate with username and password passed to __init__(). Set the ticket
         and user_id fields.
 
         """
         request = {'username': self.username, 'password': self.password, 'hours': self.hours}
-        response = self.request(
-            'Authenticate', 'main', request,
-            required=['ticket', 'userid'], ticket=False)
+        return self._call('Authenticate', 'main', request, required=['ticket', 'userid'],
+                          parse=self._set_ticket, ticket=False)
+
+    def _set_ticket(self, response):
         self.ticket = response['ticket']
         self.user_id = response['userid']
+        self.ticket_expires = time.time() + self.hours * 3600
+
+    # errcodes of requests refused because the ticket expired or is invalid
+    expired_ticket_errcodes = frozenset(['4', '22'])
+    ticket_renew_margin = 600
+
+    def _ticket_key(self):
+        return self.base_url, self.username
+
+    def _renew_margin(self):
+        """Seconds before expiry to renew a ticket, at most half its lifetime."""
+        return min(self.ticket_renew_margin, self.hours * 3600 / 2.0)
+
+    def _ticket_expired(self, parsed):
+        return (self.username is not None and
+                parsed.findtext('errcode') in self.expired_ticket_errcodes)
+
+    def _ticket_refused(self, error):
+        """Return whether error is QuickBase refusing the ticket of a request."""
+        return (isinstance(error, ResponseError) and error.parsed is not None and
+                self._ticket_expired(error.parsed))
+
+    def _renew_refused(self, stale, request):
+        """Renew the ticket stale after QuickBase refused request, and return whether
+        request can be sent again with the new one.
+
+        """
+        self._renew_ticket(stale)
+        return self._replayable(request)
+
+    def _renewing(self, call, request):
+        """Return call(), which sends request, calling it once more with a new ticket
+        if QuickBase refused the one it was sent with. For requests that bypass
+        request(), such as streamed queries.
+
+        """
+        used_ticket = self.ticket
+        try:
+            return call()
+        except ResponseError as e:
+            if not (self._ticket_refused(e) and self._renew_refused(used_ticket, request)):
+                raise
+        return call()
+
+    def _fresh_ticket(self, entry, stale=None):
+        """Return whether a provider's ticket entry can be used."""
+        return (entry is not None and entry[0] != stale and
+                entry[2] - time.time() > self._renew_margin() + 1)
+
+    def _load_ticket(self, stale=None):
+        """Take the ticket for this realm and user from the ticket provider, first
+        authenticating and storing a new one if there is none fresh (or it is stale),
+        and schedule its renewal.
+
+        """
+        key = self._ticket_key()
+        with self.ticket_provider.lock(key):
+            entry = self.ticket_provider.get(key)
+            if not self._fresh_ticket(entry, stale):
+                self.authenticate()
+                entry = (self.ticket, self.user_id, self.ticket_expires)
+                self.ticket_provider.put(key, *entry)
+        self.ticket, self.user_id, self.ticket_expires = entry
+        self._schedule_renewal()
+
+    def _schedule_renewal(self):
+        if self._renewal is not None:
+            self._renewal.cancel()
+        delay = max(0, self.ticket_expires - self._renew_margin() - time.time())
+        self._renewal = threading.Timer(delay, self._renew_in_background)
+        self._renewal.daemon = True
+        self._renewal.start()
+
+    def _renew_in_background(self):
+        try:
+            self._load_ticket()
+        except Error:
+            # Requests will renew the ticket when it is refused
+            pass
+
+    def _renew_ticket(self, stale):
+        """Replace the ticket stale, which QuickBase refused, unless another thread
+        already has.
+
+        """
+        with self._ticket_lock:
+            if self.ticket != stale:
+                return
+            if self.ticket_provider is not None:
+                self._load_ticket(stale)
+            else:
+                self.authenticate()
 
     def sign_out(self):
-        response = self.request('SignOut', 'main', {}, required=['errcode', 'errtext'])
-        return response
+        return self._call('SignOut', 'main', {}, required=['errcode', 'errtext'])
 
     def delete_record(self, rid=None, key=None, database=None):
         request = {}
@@ -278,97 +2437,342 @@ class Client(object):
             request['rid'] = rid
         if key:
             request['key'] = key
-        return self.request('DeleteRecord', database or self.database, request, required=['rid'])
+        return self._call('DeleteRecord', database or self.database, request, required=['rid'])
+
+    @classmethod
+    def _query_request(cls, query=None, qid=None, qname=None, columns=None, sort=None,
+                       structured=True, num=None, only_new=False, skip=None, ascending=True,
+                       include_rids=False):
+        """Build the request fields for a DoQuery call."""
+        request = {}
+        if len([q for q in (query, qid, qname) if q]) != 1:
+            raise TypeError('must specify one of query, qid, or qname')
+        if query:
+            request['query'] = query
+        elif qid:
+            request['qid'] = qid
+        else:
+            request['qname'] = qname
+
+        if columns:
+            request['clist'] = columns
+        if sort:
+            request['slist'] = '.'.join(str(c) for c in sort)
+        if structured:
+            request['fmt'] = 'structured'
+
+        options = []
+        if num is not None:
+            options.append('num-{0}'.format(num))
+        if only_new:
+            options.append('onlynew')
+        if skip is not None:
+            options.append('skp-{0}'.format(skip))
+        if not ascending:
+            options.append('sortorder-D')
+        if options:
+            request['options'] = '.'.join(options)
+
+        if include_rids:
+            request['includeRids'] = 1
+        return request
+
+    def do_query(self, query=None, qid=None, qname=None, columns=None, sort=None,
+                 structured=True, num=None, only_new=False, skip=None, ascending=True,
+                 include_rids=False, database=None, result=None, processes=None):
+        """Perform query and return results (list of dicts). Other result forms, with
+        values converted to Python types using the table schema, are:
+
+        - 'records': list of Records, tuple-backed rows sharing one fid index
+        - 'columns': OrderedDict of fid: column; numeric columns are arrays
+        - 'numpy': OrderedDict of fid: NumPy array (requires numpy)
+
+        or 'views', a list of RecordViews, which decode text values only as they are
+        read.
+
+        columns is a clist ('a' for all fields, or fids separated by periods) or a
+        list of fids and field labels or XML names, which are resolved to a clist with
+        the table schema so that only those fields are sent. RecordViews can also be
+        read by those names.
+
+        With processes > 1, a list of dicts is returned as usual, but a response of
+        parallel_min_bytes or more is downloaded to a temporary file and its records
+        parsed by that many worker processes; see _parse_parallel. Like iter_query,
+        such a query bypasses the cache, coalescing, the scheduler and hooks.
+
+        """
+        database = database or self.database
+        names = None
+        if isinstance(columns, (list, tuple)):
+            columns, names = self._resolve_columns(columns, database)
+        request = self._query_request(query, qid, qname, columns, sort, structured, num,
+                                      only_new, skip, ascending, include_rids)
+        if processes is not None and processes > 1:
+            if result:
+                raise ValueError('processes cannot be combined with result={0!r}'.format(result))
+            return self._query_parallel(database, request, processes)
+        if not result:
+            return self._call('DoQuery', database, request, parse=self._parse_records)
+        if result == 'views':
+            return self._call('DoQuery', database, request,
+                              parse=lambda response: self._parse_views(response, names))
+        if result not in ('records', 'columns', 'numpy'):
+            raise ValueError('unknown result type {0!r}'.format(result))
+        # The cache is checked first so that AsyncClient can load the schema beforehand
+        schema = self._cached_schema(database) or self.schema(database)
+        return self._call('DoQuery', database, request,
+                          parse=lambda response: self._parse_result(response, result, schema))
+
+    def iter_query(self, query=None, qid=None, qname=None, columns=None, sort=None,
+                   structured=True, num=None, only_new=False, skip=None, ascending=True,
+                   include_rids=False, database=None):
+        """Perform query and yield results (dicts) one at a time as they download.
+        Each <record> is parsed as soon as it is complete and then discarded, so memory
+        use stays flat however large the result is.
+
+        """
+        request = self._query_request(query, qid, qname, columns, sort, structured, num,
+                                      only_new, skip, ascending, include_rids)
+        database = database or self.database
+        used_ticket = self.ticket
+        try:
+            # QuickBase errors arrive before any records, so nothing has been yielded
+            for record in self._iter_records(database, request):
+                yield record
+            return
+        except ResponseError as e:
+            if not (self._ticket_refused(e) and self._renew_refused(used_ticket, request)):
+                raise
+        for record in self._iter_records(database, request):
+            yield record
+
+    def _iter_records(self, database, request):
+        """Send a DoQuery request and yield its records as they download."""
+        response = self._send('DoQuery', database, request)
+        head = _BodyHead()
+        try:
+            reader = None
+            for chunk in self._body(response, 'DoQuery'):
+                if reader is None:
+                    reader = _RecordReader(self, self._response_encoding(response, chunk))
+                head.add(chunk)
+                for record in reader.feed(chunk):
+                    yield record
+            if reader is None:
+                raise XMLError(-1, 'empty response')
+            reader.close()
+        except XMLError as e:
+            head.attach(e)
+            raise
+        finally:
+            response.close()
+
+    def _resolve_columns(self, columns, database):
+        """Return (clist, names) for do_query columns given as a list of fids and field
+        names, where names maps each name to its fid. The table schema is loaded only
+        if there are names to resolve.
+
+        """
+        fids = []
+        names = {}
+        for column in columns:
+            if isinstance(column, int) or column.isdigit():
+                fids.append(str(column))
+            else:
+                # The cache is checked first so that AsyncClient can load the schema beforehand
+                schema = self._cached_schema(database) or self.schema(database)
+                fid = names[column] = schema.fid(column)
+                fids.append(fid)
+        return '.'.join(fids), names
+
+    def _query_parallel(self, database, request, processes):
+        """Download a DoQuery response to a temporary file and parse it with
+        _parse_parallel, renewing the ticket if it was refused.
+
+        """
+        return self._renewing(lambda: self._download_parallel(database, request, processes),
+                              request)
+
+    def _download_parallel(self, database, request, processes):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                encoding = self._download_response(
+                    self._send('DoQuery', database, request), f, 'DoQuery')
+            return self._parse_parallel(path, encoding, processes)
+        finally:
+            os.remove(path)
+
+    def _download_response(self, response, f, action=None):
+        """Write the body of a streaming HTTP response to action to file f and return
+        its encoding, or None if it does not say.
+
+        """
+        encoding = None
+        try:
+            for chunk in self._body(response, action):
+                if encoding is None and chunk:
+                    encoding = self._response_encoding(response, chunk) or ''
+                f.write(chunk)
+        finally:
+            response.close()
+        return encoding or None
+
+    def _parse_parallel(self, path, encoding, processes):
+        """Parse the DoQuery response saved at path into a list of dicts, as
+        _parse_records does. A response of parallel_min_bytes or more is split at
+        <record> boundaries into ranges that a pool of processes workers parse from
+        the memory-mapped file, so the body itself is never pickled; their records
+        are joined in the original order. Raises XMLError or a QuickBase error as
+        request does.
+
+        """
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise XMLError(-1, 'empty response', response=b'')
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ranges = []
+                if len(buf) >= self.parallel_min_bytes:
+                    ranges = _record_ranges(buf, processes * 4)
+                parser = self.xml.parser(encoding)
+                try:
+                    if not ranges:
+                        for offset in range(0, len(buf), self.chunk_size):
+                            parser.feed(buf[offset:offset + self.chunk_size])
+                        response = parser.close()
+                        self._check_response(response)
+                        return self._parse_records(response)
+                    # The response less its records, to check the errcode first
+                    parser.feed(buf[:ranges[0][0]])
+                    parser.feed(buf[ranges[-1][1]:])
+                    self._check_response(parser.close())
+                except self.xml.error as e:
+                    raise XMLError(-1, e, response=buf[:_ERROR_BODY_SIZE])
+                if encoding is None:
+                    match = _DECLARED_ENCODING.match(buf)
+                    encoding = match.group(1).decode('ascii') if match else None
+            finally:
+                buf.close()
+
+        import multiprocessing
+        pool = multiprocessing.Pool(min(processes, len(ranges)))
+        try:
+            tasks = [(type(self), self.xml.name, path, encoding, start, end)
+                     for start, end in ranges]
+            records = []
+            for part in pool.imap(_parse_record_range, tasks):
+                records.extend(part)
+            return records
+        finally:
+            pool.terminate()
+
+    @classmethod
+    def _stable_sort(cls, sort):
+        """Return sort with Record ID# appended as a tiebreaker if it is not there, so
+        that records keep the same order from page to page.
 
-    def do_query(self, query=None, qid=None, qname=None, columns=None, sort=None,
-                 structured=True, num=None, only_new=False, skip=None, ascending=True,
-                 include_rids=False, database=None):
-        """Perform query and return results (list of dicts)."""
-        request = {}
-        if len([q for q in (query, qid, qname) if q]) != 1:
-            raise TypeError('must specify one of query, qid, or qname')
-        if query:
-            request['query'] = query
-        elif qid:
-            request['qid'] = qid
-        else:
-            request['qname'] = qname
+        >>> Client._stable_sort(None)
+        [3]
+        >>> Client._stable_sort(['7'])
+        ['7', 3]
+        >>> Client._stable_sort([3, 7])
+        [3, 7]
+        """
+        sort = list(sort or [])
+        if '3' not in [str(fid) for fid in sort]:
+            sort.append(3)
+        return sort
 
-        if columns:
-            request['clist'] = columns
-        if sort:
-            request['slist'] = '.'.join(str(c) for c in sort)
-        if structured:
-            request['fmt'] = 'structured'
+    def do_query_all(self, query, columns=None, sort=None, structured=True, ascending=True,
+                     include_rids=False, page_size=1000, concurrency=4, database=None):
+        """Perform query over all matching records and yield results (dicts) in order,
+        working around QuickBase's limit on the size of a single response.
 
-        options = []
-        if num is not None:
-            options.append('num-{0}'.format(num))
-        if only_new:
-            options.append('onlynew')
-        if skip is not None:
-            options.append('skp-{0}'.format(skip))
-        if not ascending:
-            options.append('sortorder-D')
-        if options:
-            request['options'] = '.'.join(options)
+        do_query_count plans pages of page_size records, which are fetched by up to
+        concurrency threads at once. Pages are requested with the same sort, with Record
+        ID# appended if it is not in it so that paging is stable, and yielded in sort
+        order. At most concurrency pages are held in memory ahead of the caller.
 
-        if include_rids:
-            request['includeRids'] = 1
+        """
+        database = database or self.database
+        sort = self._stable_sort(sort)
+        total = self.do_query_count(query, database=database)
+        skips = collections.deque(range(0, total, page_size))
+        if not skips:
+            return
 
-        response = self.request('DoQuery', database or self.database, request)
-        return self._parse_records(response)
+        def fetch_page(skip):
+            return self.do_query(query, columns=columns, sort=sort, structured=structured,
+                                 num=page_size, skip=skip, ascending=ascending,
+                                 include_rids=include_rids, database=database)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(concurrency, len(skips)))
+        try:
+            pending = collections.deque()
+            while skips or pending:
+                while skips and len(pending) < concurrency:
+                    pending.append(pool.apply_async(fetch_page, (skips.popleft(),)))
+                for record in pending.popleft().get():
+                    yield record
+        finally:
+            pool.terminate()
 
     def do_query_count(self, query, database=None):
         request = {}
         request['query'] = query
-        response = self.request('DoQueryCount', database or self.database, request, required=['numMatches'])
-        return int(response['numMatches'])
+        return self._call('DoQueryCount', database or self.database, request, required=['numMatches'],
+                          parse=lambda response: int(response['numMatches']))
 
     def edit_record(self, rid, fields, named=False, database=None):
         """Update fields on the given record. "fields" is a dict of name:value pairs
         (if named is True) or fid:value pairs (if named is False). Return the number of
         fields successfully changed.
         """
+        database = database or self.database
+        schema = self._cached_schema(database) if named else None
         request = {}
         request['rid'] = rid
-        attr = 'name' if named else 'fid'
         request['field'] = []
-        for field, value in fields.iteritems():
-            request_field = ({attr: to_xml_name(field) if named else field}, value)
+        for field, value in fields.items():
+            request_field = (self._field_attrib(field, named, schema), value)
             request['field'].append(request_field)
-        response = self.request('EditRecord', database or self.database, request,
-                                required=['num_fields_changed', 'rid'])
-        return response
+        return self._call('EditRecord', database, request,
+                          required=['num_fields_changed', 'rid'])
 
     def add_record(self, fields, named=False, database=None, ignore_error=True, uploads=None):
         """Add new record. "fields" is a dict of name:value pairs
         (if named is True) or fid:value pairs (if named is False). Return the new records RID
         """
+        database = database or self.database
+        schema = self._cached_schema(database) if named else None
         request = {}
         if ignore_error:
             request['ignoreError'] = '1'
-        attr = 'name' if named else 'fid'
         request['field'] = []
-        for field, value in fields.iteritems():
-            request_field = ({attr: to_xml_name(field) if named else field}, value)
+        for field, value in fields.items():
+            request_field = (self._field_attrib(field, named, schema), value)
             request['field'].append(request_field)
         if uploads:
             for upload in uploads:
-                request_field = (
-                    {attr: (to_xml_name(upload['field']) if named else upload['field']),
-                     'filename': upload['filename']}, upload['value'])
-                request['field'].append(request_field)
+                attrib = self._field_attrib(upload['field'], named, schema)
+                attrib['filename'] = upload['filename']
+                request['field'].append((attrib, upload['value']))
 
-        response = self.request('AddRecord', database or self.database, request, required=['rid'])
-        return int(response['rid'])
+        return self._call('AddRecord', database, request, required=['rid'],
+                          parse=lambda response: int(response['rid']))
 
-    def import_from_csv(self, records_csv, clist, clist_output=None, skipfirst=False, database=None, required=None, msInUTC=True):
+    def import_from_csv(self, records_csv=None, clist=None, clist_output=None, skipfirst=False, database=None, required=None, msInUTC=True, path=None):
 
         """
         Imports a CSV file (converted to multi-line string) to QuickBase columns specified in clist.
+        A string given as records_csv is always the CSV itself; to upload a file, pass
+        its path as path or an open file object as records_csv. Files and iterables of
+        rows are streamed into the upload in chunks rather than read into memory.
         kwargs:
-            records_csv - string
+            records_csv - string, file object, or iterable of rows (sequences of values)
+            path - path of a CSV file to upload instead of records_csv
             clist - fields to import to
             clist_output - Specifies which fields should be returned in addition to the record ID and updated ID.
             skipfirst - Number of records to skip at beginning of response
@@ -377,7 +2781,15 @@ class Client(object):
         returns:
             rids of new records or required fields
         """
+        if (records_csv is None) == (path is None):
+            raise TypeError('must specify one of records_csv or path')
+        if clist is None:
+            raise TypeError('must specify clist')
         request = {}
+        if path is not None:
+            records_csv = _CSVStream(path, self.chunk_size)
+        elif not isinstance(records_csv, basestring):
+            records_csv = _CSVStream(records_csv, self.chunk_size)
         request['records_csv'] = records_csv
         if isinstance(clist, list):
             request['clist'] = '.'.join(str(c) for c in clist)
@@ -387,8 +2799,63 @@ class Client(object):
             request['clist_output'] = clist_output
         if skipfirst:
             request['skipfirst'] = skipfirst
-        response = self.request('ImportFromCSV', database or self.database, request, required)
-        return response
+        return self._call('ImportFromCSV', database or self.database, request, required)
+
+    def schema(self, database=None, refresh=False):
+        """Return the Schema of the given table, from the cache if it was loaded less
+        than schema_ttl seconds ago (and refresh is False). Once a table's schema is
+        cached, named add_record and edit_record calls send fids directly.
+
+        """
+        database = database or self.database
+        schema = None if refresh else self._cached_schema(database)
+        if schema is None:
+            schema = self._cache_schema(database, self.get_schema(database=database))
+        return schema
+
+    def _cached_schema(self, database):
+        entry = self._schemas.get(database)
+        if entry is not None and (self.schema_ttl is None or entry[0] > time.time()):
+            return entry[1]
+        return None
+
+    def _cache_schema(self, database, fields):
+        schema = Schema(fields)
+        expires = time.time() + self.schema_ttl if self.schema_ttl is not None else None
+        self._schemas[database] = (expires, schema)
+        return schema
+
+    def invalidate_schema(self, database=None):
+        """Drop the cached schema of the given table, or of all tables if None."""
+        if database is None:
+            self._schemas.clear()
+        else:
+            self._schemas.pop(database, None)
+
+    def _field_attrib(self, field, named, schema):
+        """Return the attributes identifying a field in AddRecord and EditRecord."""
+        if not named:
+            return {'fid': field}
+        if schema is not None:
+            fid = schema.fids.get(field)
+            if fid is not None:
+                return {'fid': fid}
+        return {'name': to_xml_name(field)}
+
+    def export_table(self, database, path, format='csv', compress=None, **kwargs):
+        """Stream every record of a table to path as CSV, JSON Lines or Parquet, a page
+        at a time, and return the number written. See TableExporter for the formats
+        and options.
+
+        """
+        return TableExporter(self, database, **kwargs).export(path, format, compress)
+
+    def bulk_writer(self, database=None, named=False, **kwargs):
+        """Return a BulkWriter that batches record adds and edits on the given table
+        into ImportFromCSV calls. See BulkWriter for the options.
+
+        """
+        return BulkWriter(self, database or self.database, named=named, **kwargs)
 
     def get_db_page(self, page, named=True, database=None):
         #Get DB page from a qbase app
@@ -397,14 +2864,13 @@ class Client(object):
             request['pagename'] = page
         else:
             request['pageID'] = page
-        response = self.request('GetDBPage', database or self.database, request)
-        return self._parse_db_page(response)
+        return self._call('GetDBPage', database or self.database, request, parse=self._parse_db_page)
 
     def get_schema(self, database=None, required=None):
         """Perform query and return results (list of dicts)."""
         request = {}
-        response = self.request('GetSchema', database or self.database, request, required=required)
-        return self._parse_schema(response)
+        return self._call('GetSchema', database or self.database, request, required=required,
+                          parse=self._parse_schema)
 
     def granted_dbs(self, adminOnly=0, excludeparents=0, includeancestors=0, withembeddedtables=0, database='main'):
         """Perform query and return results (list of dicts)."""
@@ -418,13 +2884,12 @@ class Client(object):
         if withembeddedtables:
             request['withembeddedtables'] = withembeddedtables
 
-        response = self.request('GrantedDBs', database or self.database, request)
-        return response
+        return self._call('GrantedDBs', database or self.database, request)
 
     def list_db_pages(self, database=None):
         request = {}
-        response = self.request('ListDBpages', database or self.database, request)
-        return self._parse_list_pages(response)
+        return self._call('ListDBpages', database or self.database, request,
+                          parse=self._parse_list_pages)
 
     def add_replace_db_page(self, pagebody, pagename=None, pageid=None, pagetype=1, database=None):
         """Add replace dbpage - required pagebody, database, pageId(replace) or pageName(add)"""
@@ -439,26 +2904,1148 @@ class Client(object):
             request['pagetype'] = pagetype
         request['pagebody'] = pagebody
 
-        response = self.request('AddReplaceDBPage', database or self.database, request, required=['errcode', 'errtext'])
-        return str(response['errtext'])
+        return self._call('AddReplaceDBPage', database or self.database, request,
+                          required=['errcode', 'errtext'], parse=lambda response: str(response['errtext']))
+
+    def deploy_db_pages(self, pages, manifest_path='.quickbase-pages.json', database=None,
+                        concurrency=4, force=False):
+        """Upload the new and changed pages of pages, a dict of page name: body or
+        (body, pagetype), concurrently. See PageSync.
+
+        """
+        return PageSync(self, database, manifest_path, concurrency).deploy(pages, force)
+
+    def file_url(self, rid, fid, database=None):
+        """Return the download URL of the file attachment in field fid of record rid."""
+        return '{0}/up/{1}/a/r{2}/e{3}/v0'.format(self.base_url, database or self.database, rid, fid)
 
     def get_file(self, fname, folder, rid, fid, database=None):
-        url = self.base_url + '/up/' + database + '/a/r' + rid + '/e' + fid + '/v0'
-        r = requests.get(url)
-        response = r.content
-        if not os.path.isdir(folder):
-            os.makedirs(folder)
-        new_file = os.path.join(os.getcwd(), folder, fname)
-        g = open(new_file, "wb")
-        g.write(response)
-        g.close()
-        return new_file
+        """Download an attachment to folder/fname, streaming it to disk."""
+        result = DownloadManager(self, folder, database=database, concurrency=1).download(
+            [(str(rid), str(fid), fname)])[0]
+        if result.error is not None:
+            raise result.error
+        return os.path.join(os.getcwd(), result.path)
+
+    def download_files(self, files, folder, database=None, concurrency=4):
+        """Download many attachments to folder concurrently. See DownloadManager."""
+        return DownloadManager(self, folder, database=database, concurrency=concurrency).download(files)
 
     def return_file(self, url):
         headers = {'Cookie': 'ticket=%s' % self.ticket }
-        response = requests.get(url, headers=headers)
+        response = self.transport.get(url, headers=headers)
         return os.path.basename(url), response.content
 
+_QUERY_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<clause>\{\s*'?(?P<fid>[^'.{}]+?)'?\s*\.\s*(?P<op>[A-Za-z]+)\s*\.\s*'(?P<value>.*?)'\s*\})
+      | (?P<paren>[()])
+      | (?P<join>AND|OR)\b
+    )""", re.VERBOSE | re.IGNORECASE | re.DOTALL)
+_DATE = re.compile(r'^(\d{1,2})-(\d{1,2})-(\d{4})$')
+_RELATIVE_RANGE = re.compile(r'^(last|past|next)\s+(\d+)\s+days?$', re.IGNORECASE)
+_DAY_MS = 24 * 60 * 60 * 1000
+
+
+def _ms(value):
+    """Return a record or query value as milliseconds since the epoch, or None."""
+    if isinstance(value, datetime.datetime):
+        return int((value - EPOCH).total_seconds() * 1000)
+    if isinstance(value, datetime.date):
+        return (value - EPOCH.date()).days * _DAY_MS
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not isinstance(value, basestring):
+        # Such as the choices of a typed multi-choice value
+        return None
+    match = _DATE.match(value)
+    if match:
+        month, day, year = (int(g) for g in match.groups())
+        return (datetime.date(year, month, day) - EPOCH.date()).days * _DAY_MS
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _number(value):
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _blank(value):
+    """Return whether a record value is empty, as text or as a typed value."""
+    return value is None or value == '' or (isinstance(value, (tuple, list)) and not value)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return '1' if value else ''
+    if isinstance(value, (tuple, list)):
+        return ';'.join(_text(v) for v in value)
+    if isinstance(value, basestring):
+        return value.lower()
+    return str(value).lower()
+
+
+def _day_range(value, now):
+    """Return the (start, end) ms range of days an IR/OAF/OBF value covers."""
+    today = (now - EPOCH).days * _DAY_MS
+    word = value.strip().lower()
+    if word == 'today':
+        return today, today + _DAY_MS
+    if word == 'yesterday':
+        return today - _DAY_MS, today
+    if word == 'tomorrow':
+        return today + _DAY_MS, today + 2 * _DAY_MS
+    match = _RELATIVE_RANGE.match(word)
+    if match:
+        days = int(match.group(2))
+        if match.group(1).lower() == 'next':
+            return today, today + days * _DAY_MS
+        return today - (days - 1) * _DAY_MS, today + _DAY_MS
+    ms = _ms(value)
+    if ms is None:
+        raise ValueError('invalid date {0!r} in query'.format(value))
+    if _DATE.match(value):
+        return ms, ms + _DAY_MS
+    return ms, ms + 1
+
+
+def _compare(record_value, value, test):
+    """Compare numerically if both sides are numbers, else as dates, else as text."""
+    a, b = _number(record_value), _number(value)
+    if a is None or b is None:
+        a, b = _ms(record_value), _ms(value)
+        if a is None or b is None:
+            a, b = _text(record_value), _text(value)
+    return test(a, b)
+
+
+def _clause_test(op, value, now):
+    """Return a function(record value) -> bool for one query clause."""
+    negated = op in ('XEX', 'XCT', 'XSW', 'XTV', 'XIR', 'XHAS')
+    base = op[1:] if negated else op
+    text = _text(value)
+
+    if base == 'EX':
+        # A date matches any time on that day, a datetime the same instant
+        day = _ms(value) if _DATE.match(value) else None
+
+        def test(v):
+            if day is not None:
+                ms = _ms(v)
+                return ms is not None and day <= ms < day + _DAY_MS
+            if isinstance(v, datetime.date):
+                return _ms(v) == _ms(value)
+            a, b = _number(v), _number(value)
+            if a is not None and b is not None:
+                return a == b
+            return _text(v) == text
+    elif base == 'CT':
+        test = lambda v: text in _text(v)
+    elif base == 'SW':
+        test = lambda v: _text(v).startswith(text)
+    elif base == 'HAS':
+        test = lambda v: text in [_text(choice) for choice in
+                                  (v if isinstance(v, (tuple, list)) else _text(v).split(';'))]
+    elif base == 'TV':
+        test = lambda v: _text(v) in ('1', 'true', 'yes', 'y', 'checked')
+    elif base in ('LT', 'LTE', 'GT', 'GTE'):
+        tests = {
+            'LT': lambda a, b: a < b,
+            'LTE': lambda a, b: a <= b,
+            'GT': lambda a, b: a > b,
+            'GTE': lambda a, b: a >= b,
+        }
+        compare = tests[base]
+        test = lambda v: not _blank(v) and _compare(v, value, compare)
+    elif base in ('BF', 'OBF', 'AF', 'OAF', 'IR'):
+        start, end = _day_range(value, now)
+        bounds = {
+            'BF': lambda ms: ms < start,
+            'OBF': lambda ms: ms < end,
+            'AF': lambda ms: ms >= end,
+            'OAF': lambda ms: ms >= start,
+            'IR': lambda ms: start <= ms < end,
+        }
+        bound = bounds[base]
+
+        def test(v):
+            ms = _ms(v)
+            return ms is not None and bound(ms)
+    else:
+        raise ValueError('unsupported query operator {0!r}'.format(op))
+
+    if negated:
+        return lambda v: not test(v)
+    return test
+
+
+def compile_query(query, now=None):
+    """Compile a QuickBase query string into a function(record) -> bool that tests a
+    record (dict of fid: value, or Record) locally. Supports EX, CT, SW, HAS, TV, LT,
+    LTE, GT, GTE, BF, OBF, AF, OAF and IR, the X-prefixed negations of EX, CT, SW, HAS,
+    TV and IR, and clauses joined with AND and OR (AND binds tighter) and grouped with
+    parentheses. Text comparisons are case-insensitive like QuickBase's, and the
+    choices of a multi-choice value compare as their ';'-joined text. A date such as
+    '01-02-2010' matches any time on that day. Relative dates ('today', 'last 7
+    days') are resolved against now, a UTC datetime.
+
+    >>> test = compile_query("{'7'.GT.'100'}AND({6.CT.'acme'}OR{'6'.EX.''})")
+    >>> test({'6': 'ACME Corp', '7': '150'}), test({'6': '', '7': '101'}), test({'6': 'x', '7': '150'})
+    (True, True, False)
+    >>> compile_query("{'3'.XEX.''}")({'3': '12'})
+    True
+    >>> compile_query("{'10'.OAF.'01-02-2010'}")({'10': '1262390400000'})
+    True
+    >>> compile_query("{'10'.EX.'01-02-2010'}")({'10': datetime.datetime(2010, 1, 2, 9, 30)})
+    True
+    """
+    now = now or datetime.datetime.utcnow()
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = _QUERY_TOKEN.match(query, pos)
+        if match is None or match.end() == pos:
+            raise ValueError('invalid query at {0!r}'.format(query[pos:pos + 20]))
+        tokens.append(match)
+        pos = match.end()
+
+    def parse_or(i):
+        test, i = parse_and(i)
+        while i < len(tokens) and (tokens[i].group('join') or '').upper() == 'OR':
+            right, i = parse_and(i + 1)
+            test = (lambda l, r: lambda record: l(record) or r(record))(test, right)
+        return test, i
+
+    def parse_and(i):
+        test, i = parse_term(i)
+        while i < len(tokens) and (tokens[i].group('join') or '').upper() == 'AND':
+            right, i = parse_term(i + 1)
+            test = (lambda l, r: lambda record: l(record) and r(record))(test, right)
+        return test, i
+
+    def parse_term(i):
+        if i >= len(tokens):
+            raise ValueError('query ends unexpectedly')
+        token = tokens[i]
+        if token.group('paren') == '(':
+            test, i = parse_or(i + 1)
+            if i >= len(tokens) or tokens[i].group('paren') != ')':
+                raise ValueError('unbalanced parentheses in query')
+            return test, i + 1
+        if token.group('clause') is None:
+            raise ValueError('expected a {{clause}} in query, got {0!r}'.format(token.group(0)))
+        fid = token.group('fid').strip()
+        value_test = _clause_test(token.group('op').upper(), token.group('value'), now)
+        return (lambda record: value_test(record.get(fid))), i + 1
+
+    if not tokens:
+        return lambda record: True
+    test, i = parse_or(0)
+    if i != len(tokens):
+        raise ValueError('unexpected {0!r} in query'.format(tokens[i].group(0)))
+    return test
+
+
+def _sort_key(value):
+    """Sort key putting blanks first, then numbers and dates, then text."""
+    if _blank(value):
+        return (0, 0)
+    number = _number(value)
+    if number is not None:
+        return (1, number)
+    ms = _ms(value)
+    if ms is not None:
+        return (1, ms)
+    return (2, _text(value))
+
+
+def local_query(records, query=None, columns=None, sort=None, num=None, skip=None,
+                ascending=True, now=None):
+    """Run a query over records already held locally, with the same meaning as the
+    do_query arguments of the same names, and return the matching records as a list
+    of dicts. columns may be a period-delimited string or list of fids, or 'a' for
+    all fields.
+
+    >>> records = [{'3': '1', '7': '5'}, {'3': '2', '7': '50'}, {'3': '3', '7': '500'}]
+    >>> local_query(records, "{'7'.GT.'10'}", columns='3', sort=[7], ascending=False)
+    [{'3': '3'}, {'3': '2'}]
+    """
+    if query:
+        test = compile_query(query, now)
+        records = [record for record in records if test(record)]
+    else:
+        records = list(records)
+    if sort:
+        fids = [str(fid) for fid in sort]
+        records.sort(key=lambda record: [_sort_key(record.get(fid)) for fid in fids],
+                     reverse=not ascending)
+    if skip:
+        records = records[skip:]
+    if num is not None:
+        records = records[:num]
+    if columns and columns != 'a':
+        if isinstance(columns, basestring):
+            columns = columns.split('.')
+        fids = [str(fid) for fid in columns]
+        return [dict((fid, record[fid]) for fid in fids if fid in record) for record in records]
+    return [dict(record.items()) for record in records]
+
+
+class TableMirror(object):
+    """Local SQLite copy of a QuickBase table, kept up to date incrementally.
+
+        mirror = TableMirror(client, dbid, 'mirror.db')
+        mirror.sync()
+
+    The table is stored in the SQLite file as a table named after its dbid, with a
+    column f<fid> for each field in the table schema and Record ID# (fid 3) as the
+    primary key. The first sync() copies every record; later calls only fetch records
+    whose Date Modified (fid 2) is on or after the newest one already stored, and
+    upsert them in batches of batch_size. Records are fetched in (Date Modified,
+    Record ID#) order, page_size at a time, each page starting after the last record
+    of the one before rather than at an offset. A record edited during a sync moves
+    to the end of that order instead of shifting unseen records past a page boundary,
+    so none is missed.
+
+    Deleted records are not reported by Date Modified, so every reconcile_interval
+    seconds sync() also compares the full set of record IDs (one column, paged) with
+    the local copy and deletes rows that are gone. Call reconcile() to do so at once.
+    It pages through record IDs with do_query_all using page_size and concurrency.
+
+    """
+    rid_fid = '3'
+    modified_fid = '2'
+
+    def __init__(self, client, database, path, page_size=1000, concurrency=4,
+                 batch_size=1000, reconcile_interval=24 * 60 * 60):
+        self.client = client
+        self.database = database
+        self.path = path
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.reconcile_interval = reconcile_interval
+        import sqlite3
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS _sync_state '
+                          '(dbid TEXT PRIMARY KEY, watermark INTEGER, reconciled REAL)')
+        self.columns = None
+
+    @property
+    def table(self):
+        return '"{0}"'.format(self.database.replace('"', '""'))
+
+    def close(self):
+        self.conn.close()
+
+    def _state(self):
+        row = self.conn.execute('SELECT watermark, reconciled FROM _sync_state WHERE dbid = ?',
+                                (self.database,)).fetchone()
+        return row or (None, None)
+
+    def _set_state(self, watermark, reconciled):
+        self.conn.execute('INSERT OR REPLACE INTO _sync_state VALUES (?, ?, ?)',
+                          (self.database, watermark, reconciled))
+
+    def _prepare_table(self):
+        """Create the mirror table from the schema, adding columns for new fields."""
+        schema = self.client.schema(self.database, refresh=True)
+        columns = collections.OrderedDict()
+        for fid in sorted(schema.by_fid, key=int):
+            converter = schema.converters[fid]
+            if converter is _to_float:
+                columns[fid] = ('REAL', _to_float)
+            elif converter in (_to_int, _to_bool, _to_datetime):
+                # Dates are kept as milliseconds since the epoch (UTC)
+                columns[fid] = ('INTEGER', _to_int)
+            else:
+                columns[fid] = ('TEXT', _to_text)
+        for fid, label in ((self.rid_fid, 'Record ID#'), (self.modified_fid, 'Date Modified')):
+            if fid not in columns:
+                raise QuickBaseError(-5, 'table {0} has no {1} field'.format(self.database, label))
+
+        existing = set(row[1] for row in self.conn.execute('PRAGMA table_info({0})'.format(self.table)))
+        if not existing:
+            definitions = ['f{0} {1}{2}'.format(fid, sql_type, ' PRIMARY KEY' if fid == self.rid_fid else '')
+                           for fid, (sql_type, _) in columns.items()]
+            self.conn.execute('CREATE TABLE {0} ({1})'.format(self.table, ', '.join(definitions)))
+        else:
+            for fid, (sql_type, _) in columns.items():
+                if 'f' + fid not in existing:
+                    self.conn.execute('ALTER TABLE {0} ADD COLUMN f{1} {2}'.format(
+                        self.table, fid, sql_type))
+        self.columns = columns
+
+    def sync(self):
+        """Bring the mirror up to date and return a dict with the number of records
+        upserted and deleted.
+
+        """
+        self._prepare_table()
+        watermark, reconciled = self._state()
+        fids = list(self.columns)
+        sql = 'INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'.format(
+            self.table, ', '.join('f' + fid for fid in fids), ', '.join('?' * len(fids)))
+        upserted = 0
+        batch = []
+        for record in self._changed_records(watermark, fids):
+            batch.append([self.columns[fid][1](record.get(fid)) for fid in fids])
+            if len(batch) >= self.batch_size:
+                watermark = self._write_batch(sql, batch, fids, watermark, reconciled)
+                upserted += len(batch)
+                batch = []
+        if batch:
+            watermark = self._write_batch(sql, batch, fids, watermark, reconciled)
+            upserted += len(batch)
+
+        deleted = 0
+        if reconciled is None or reconciled + self.reconcile_interval <= time.time():
+            deleted = self.reconcile()
+        return {'upserted': upserted, 'deleted': deleted}
+
+    def _changed_records(self, watermark, fids):
+        """Yield the records modified on or after watermark (every record if it is
+        None) in (Date Modified, Record ID#) order, a page at a time.
+
+        """
+        cursor = None
+        while True:
+            page = self.client.do_query(self._changes_query(watermark, cursor),
+                                        columns='.'.join(fids),
+                                        sort=[self.modified_fid, self.rid_fid],
+                                        num=self.page_size, database=self.database)
+            for record in page:
+                yield record
+            if len(page) < self.page_size:
+                return
+            cursor = page[-1][self.modified_fid], page[-1][self.rid_fid]
+
+    def _changes_query(self, watermark, cursor):
+        """Return the query for the records after cursor, the (Date Modified, Record
+        ID#) of the last record fetched, or from watermark if cursor is None.
+
+        >>> mirror = TableMirror.__new__(TableMirror)
+        >>> mirror._changes_query(None, None)
+        "{'3'.XEX.''}"
+        >>> mirror._changes_query(1000, None)
+        "{'2'.OAF.'1000'}"
+        >>> mirror._changes_query(1000, ('2000', '7'))
+        "{'2'.AF.'2000'} OR ({'2'.OAF.'2000'} AND {'3'.GT.'7'})"
+        """
+        modified, rid = "'" + self.modified_fid + "'", "'" + self.rid_fid + "'"
+        if cursor is None:
+            if watermark is None:
+                return '{' + rid + ".XEX.''}"
+            return '{' + modified + ".OAF.'" + str(watermark) + "'}"
+        after, last = cursor
+        return ('{' + modified + ".AF.'" + after + "'} OR ({" + modified + ".OAF.'" + after +
+                "'} AND {" + rid + ".GT.'" + last + "'})")
+
+    def _write_batch(self, sql, batch, fids, watermark, reconciled):
+        """Upsert a batch of rows and advance the watermark in one transaction."""
+        if self.modified_fid in fids:
+            i = fids.index(self.modified_fid)
+            modified = [row[i] for row in batch if row[i] is not None]
+            if modified:
+                watermark = max([watermark or 0] + modified)
+        with self.conn:
+            self.conn.executemany(sql, batch)
+            self._set_state(watermark, reconciled)
+        return watermark
+
+    def reconcile(self):
+        """Delete local rows whose records no longer exist in QuickBase. Return the
+        number of rows deleted.
+
+        """
+        if self.columns is None:
+            self._prepare_table()
+        query = "{'" + self.rid_fid + "'.XEX.''}"
+        remote = set(int(record[self.rid_fid]) for record in self.client.do_query_all(
+            query, columns=self.rid_fid, page_size=self.page_size, concurrency=self.concurrency,
+            database=self.database))
+        local = set(row[0] for row in self.conn.execute(
+            'SELECT f{0} FROM {1}'.format(self.rid_fid, self.table)))
+        gone = [(rid,) for rid in local - remote]
+        watermark, reconciled = self._state()
+        with self.conn:
+            self.conn.executemany('DELETE FROM {0} WHERE f{1} = ?'.format(self.table, self.rid_fid), gone)
+            self._set_state(watermark, time.time())
+        return len(gone)
+
+
+DownloadResult = collections.namedtuple('DownloadResult', 'url path size skipped error')
+_FILE_URL = re.compile(r'/up/([^/?]+)/a/r(\d+)/e(\d+)/v(\d+)')
+
+
+class TableExporter(object):
+    """Streams a QuickBase table to a file as CSV, JSON Lines or Parquet.
+
+        exporter = TableExporter(client, dbid)
+        exporter.export('table.jsonl.gz', format='jsonl')
+
+    Records matching query (by default all of them) are fetched in Record ID# order
+    with do_query_all, using page_size and concurrency, and written as they arrive.
+    At most concurrency pages are held in memory, plus one row group of batch_size
+    rows for Parquet, however large the table is. The columns are the fields of the
+    table schema, or the given list of fids and field names, in that order, named by
+    their labels:
+
+    - csv: a header row of labels, then the values as QuickBase text
+    - jsonl: one JSON object per record with values typed by the schema converters;
+      dates and timestamps are ISO 8601 strings (UTC) and multiple choice values
+      lists
+    - parquet: typed columns (requires pyarrow)
+
+    CSV and JSON Lines are gzip-compressed if compress is set, or by default if the
+    path ends in .gz. For Parquet, compress names the column compression codec, or is
+    True (or None) for snappy and False for none. The export is written to a .part
+    file and renamed into place once complete.
+
+    """
+    formats = ('csv', 'jsonl', 'parquet')
+    rid_fid = '3'
+
+    def __init__(self, client, database, query=None, columns=None, page_size=1000,
+                 concurrency=4, batch_size=10000):
+        self.client = client
+        self.database = database
+        self.query = query or "{'" + self.rid_fid + "'.XEX.''}"
+        self.columns = columns
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+
+    def _fields(self):
+        """Return a list of (fid, label, converter) for the exported columns."""
+        schema = self.client.schema(self.database)
+        if self.columns is None:
+            fids = sorted(schema.by_fid, key=int)
+        else:
+            fids = [str(column) if isinstance(column, int) or column.isdigit()
+                    else schema.fid(column) for column in self.columns]
+        return [(fid, schema.by_fid.get(fid, {}).get('label') or fid,
+                 schema.converters.get(fid, _to_text)) for fid in fids]
+
+    def _records(self, fields):
+        return self.client.do_query_all(self.query, columns='.'.join(f[0] for f in fields),
+                                        sort=[self.rid_fid], page_size=self.page_size,
+                                        concurrency=self.concurrency, database=self.database)
+
+    def export(self, path, format='csv', compress=None):
+        """Write the table to path in the given format and return the number of
+        records written.
+
+        """
+        if format not in self.formats:
+            raise ValueError('unknown export format {0!r}'.format(format))
+        if compress is None and format != 'parquet':
+            compress = path.endswith('.gz')
+        fields = self._fields()
+        temp_path = path + '.part'
+        try:
+            count = getattr(self, '_write_' + format)(temp_path, fields, self._records(fields),
+                                                      compress)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        return count
+
+    @staticmethod
+    def _open(path, compress):
+        """Open path to write UTF-8 text, gzip-compressed if compress. On Python 2 the
+        file takes encoded bytes.
+
+        """
+        f = gzip.open(path, 'wb') if compress else open(path, 'wb')
+        return f if PY2 else io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+    def _write_csv(self, path, fields, records, compress):
+        count = 0
+        with self._open(path, compress) as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow([_csv_value(label) for _, label, _ in fields])
+            for record in records:
+                writer.writerow([_csv_value(record.get(fid)) for fid, _, _ in fields])
+                count += 1
+        return count
+
+    def _write_jsonl(self, path, fields, records, compress):
+        count = 0
+        with self._open(path, compress) as f:
+            for record in records:
+                row = collections.OrderedDict()
+                for fid, label, converter in fields:
+                    value = record.get(fid)
+                    if value is not None:
+                        value = converter(value)
+                        if isinstance(value, datetime.datetime):
+                            value = value.isoformat()
+                    row[label] = value
+                line = json.dumps(row, ensure_ascii=False) + '\n'
+                f.write(line.encode('utf-8') if PY2 and isinstance(line, unicode) else line)
+                count += 1
+        return count
+
+    @staticmethod
+    def _parquet_codec(compress):
+        """Return the Parquet compression codec named by compress.
+
+        >>> [TableExporter._parquet_codec(c) for c in (None, True, False, 'zstd')]
+        ['snappy', 'snappy', 'none', 'zstd']
+        """
+        if compress is None or compress is True:
+            return 'snappy'
+        if compress is False:
+            return 'none'
+        return compress
+
+    def _write_parquet(self, path, fields, records, compress):
+        import pyarrow
+        import pyarrow.parquet
+        types = {
+            _to_float: pyarrow.float64(),
+            _to_int: pyarrow.int64(),
+            _to_bool: pyarrow.bool_(),
+            _to_datetime: pyarrow.timestamp('ms'),
+            _to_choices: pyarrow.list_(pyarrow.string()),
+        }
+        schema = pyarrow.schema([(label, types.get(converter, pyarrow.string()))
+                                 for _, label, converter in fields])
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression=self._parquet_codec(compress))
+        count = 0
+        try:
+            columns = [[] for _ in fields]
+            for record in itertools.chain(records, [None]):
+                if record is not None:
+                    for column, (fid, _, converter) in zip(columns, fields):
+                        value = record.get(fid)
+                        value = converter(value) if value is not None else None
+                        column.append(list(value) if isinstance(value, tuple) else value)
+                    count += 1
+                if columns[0] and (record is None or len(columns[0]) >= self.batch_size):
+                    arrays = [pyarrow.array(column, type=field.type)
+                              for column, field in zip(columns, schema)]
+                    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+                    columns = [[] for _ in fields]
+        finally:
+            writer.close()
+        return count
+
+
+class DownloadManager(object):
+    """Downloads file attachments into folder, concurrency files at a time, through the
+    client's pooled transport with its ticket. Each file is streamed to disk in
+    chunks, written to a .part file and renamed into place once complete. A .part
+    file left by an interrupted download is resumed with a Range request, and files
+    that already exist with the size the server reports are skipped.
+
+    Attachment URLs do not carry the file's name, so a bare URL is saved as
+    <dbid>_r<rid>_f<fid>_v<version>; pass (url, filename) pairs to choose the names.
+
+    """
+    def __init__(self, client, folder, database=None, concurrency=4):
+        self.client = client
+        self.folder = folder
+        self.database = database or client.database
+        self.concurrency = concurrency
+
+    def _target(self, item):
+        """Return (url, filename) for a (rid, fid, filename) tuple, a (url, filename)
+        tuple or a bare URL as found in query results.
+
+        >>> manager = DownloadManager(Client(authenticate=False), 'files')
+        >>> manager._target('https://example.quickbase.com/up/bq123/a/r7/e11/v0')
+        ('https://example.quickbase.com/up/bq123/a/r7/e11/v0', 'bq123_r7_f11_v0')
+        """
+        if isinstance(item, basestring):
+            match = _FILE_URL.search(item)
+            if match is None:
+                return item, os.path.basename(item.split('?')[0])
+            return item, '{0}_r{1}_f{2}_v{3}'.format(*match.groups())
+        if len(item) == 3:
+            rid, fid, filename = item
+            return self.client.file_url(rid, fid, self.database), filename
+        return tuple(item)
+
+    def _targets(self, files):
+        """Return the (url, filename) of each of files, after checking that no two
+        would be written to the same file, and create the folder.
+
+        """
+        targets = [self._target(item) for item in files]
+        names = [os.path.normcase(filename) for _, filename in targets]
+        if len(set(names)) < len(names):
+            raise ValueError('files would be downloaded to the same filename; '
+                             'pass (url, filename) pairs with distinct names')
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        return targets
+
+    def download(self, files):
+        """Download the given files and return a list of DownloadResults in the same
+        order. Failures are reported in the result's error rather than raised; a
+        ValueError is raised up front if two files would get the same filename.
+
+        """
+        targets = self._targets(files)
+        if self.concurrency <= 1 or len(targets) <= 1:
+            return [self._download(target) for target in targets]
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.concurrency, len(targets)))
+        try:
+            return pool.map(self._download, targets)
+        finally:
+            pool.terminate()
+
+    def _download(self, target):
+        url, filename = target
+        path = os.path.join(self.folder, filename)
+        part = path + '.part'
+        try:
+            # Sizes and Range offsets must count the bytes as stored, not as sent
+            headers = {'Cookie': 'ticket={0}'.format(self.client.ticket),
+                       'Accept-Encoding': 'identity'}
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset:
+                headers['Range'] = 'bytes={0}-'.format(offset)
+            response = self.client.transport.get(url, headers=headers, stream=True)
+            try:
+                if response.status_code == 416:
+                    # The partial file is no good; start over
+                    os.remove(part)
+                    return self._download(target)
+                if response.status_code not in (200, 206):
+                    raise ConnectionError(-2, 'HTTP {0}: {1}'.format(response.status_code, response.reason))
+                length = response.headers.get('content-length')
+                if (response.status_code == 200 and length is not None and os.path.exists(path)
+                        and os.path.getsize(path) == int(length)):
+                    return DownloadResult(url, path, int(length), True, None)
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                with open(part, mode) as f:
+                    for chunk in _transfer(response.iter_content(self.client.chunk_size)):
+                        f.write(chunk)
+            finally:
+                response.close()
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(part, path)
+            return DownloadResult(url, path, os.path.getsize(path), False, None)
+        except (Error, IOError, OSError) as e:
+            return DownloadResult(url, path, None, False, e)
+
+
+PageResult = collections.namedtuple('PageResult', 'name pageid uploaded error')
+
+
+class PageSync(object):
+    """Deploys DB pages to an app, uploading only the pages that are new or have
+    changed since they were last deployed.
+
+        sync = PageSync(client, app_dbid, 'pages.json')
+        sync.deploy({'index.html': html, 'app.js': (js, 1)})
+
+    One ListDBPages call maps the app's page names to pageids. The manifest, a JSON
+    file at manifest_path, keeps the pageid and a SHA-256 hash of the type and body
+    of each page as last uploaded to each app, so unchanged pages are skipped and a
+    deploy with nothing to change makes that one call. New and changed pages are
+    uploaded concurrency at a time, existing ones replaced by pageid. A page is also
+    uploaded if its pageid in the app no longer matches the manifest, as when it was
+    deleted and recreated by hand.
+
+    """
+    def __init__(self, client, database=None, manifest_path='.quickbase-pages.json',
+                 concurrency=4):
+        self.client = client
+        self.database = database or client.database
+        self.manifest_path = manifest_path
+        self.concurrency = concurrency
+
+    @property
+    def _key(self):
+        return self.client.base_url + '/db/' + self.database
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, pages):
+        manifest = self._read_manifest()
+        manifest[self._key] = pages
+        temp_path = '{0}.{1}.tmp'.format(self.manifest_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        os.rename(temp_path, self.manifest_path)
+
+    @staticmethod
+    def digest(body, pagetype):
+        """Return the hash of a page's type and body kept in the manifest."""
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return hashlib.sha256(str(pagetype).encode('ascii') + b'\n' + body).hexdigest()
+
+    def deploy(self, pages, force=False):
+        """Upload the new and changed pages of pages, a dict of page name: body or
+        (body, pagetype), and return a list of PageResults in name order. Every page
+        is uploaded if force is set. Failures are reported in the result's error
+        rather than raised, and are retried by the next deploy.
+
+        """
+        plan = self._plan(pages, self.client.list_db_pages(database=self.database), force)
+        uploads = plan[3]
+        if self.concurrency <= 1 or len(uploads) <= 1:
+            uploaded = [self._upload(upload) for upload in uploads]
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.concurrency, len(uploads)))
+            try:
+                uploaded = pool.map(self._upload, uploads)
+            finally:
+                pool.terminate()
+        return self._finish(pages, plan, uploaded)
+
+    def _plan(self, pages, listed, force):
+        """Compare pages with the app's pages as listed by list_db_pages and the
+        manifest, and return (existing pageids by name, manifest, results so far,
+        uploads to make).
+
+        """
+        existing = dict((name, pageid) for pageid, _, name in listed)
+        manifest = self._read_manifest().get(self._key, {})
+        results = {}
+        uploads = []
+        for name in sorted(pages):
+            body, pagetype = pages[name] if isinstance(pages[name], tuple) else (pages[name], 1)
+            pageid = existing.get(name)
+            digest = self.digest(body, pagetype)
+            entry = manifest.get(name)
+            if not force and pageid is not None and entry == {'id': pageid, 'sha256': digest}:
+                results[name] = PageResult(name, pageid, False, None)
+            else:
+                uploads.append((name, body, pagetype, pageid, digest))
+        return existing, manifest, results, uploads
+
+    def _finish(self, pages, plan, uploaded):
+        """Record the PageResults of the uploads of plan in the manifest and return
+        the results of every page in name order.
+
+        """
+        existing, manifest, results, uploads = plan
+        deployed = dict((name, manifest[name]) for name in results)
+        for (name, _, _, _, digest), result in zip(uploads, uploaded):
+            if result.error is None:
+                deployed[name] = {'id': result.pageid, 'sha256': digest}
+            results[name] = result
+
+        # Pages not deployed this time keep their entries while they still exist
+        for name, entry in manifest.items():
+            if name not in pages and existing.get(name) == entry.get('id'):
+                deployed[name] = entry
+        if deployed != manifest:
+            self._write_manifest(deployed)
+        return [results[name] for name in sorted(results)]
+
+    @staticmethod
+    def _upload_request(upload):
+        name, body, pagetype, pageid, _ = upload
+        request = {'pagetype': pagetype, 'pagebody': body}
+        if pageid is None:
+            request['pagename'] = name
+        else:
+            request['pageid'] = pageid
+        return request
+
+    def _upload(self, upload):
+        name, pageid = upload[0], upload[3]
+        request = self._upload_request(upload)
+        try:
+            response = self.client._call('AddReplaceDBPage', self.database, request,
+                                         required=['pageID'])
+            return PageResult(name, str(response['pageID']), True, None)
+        except Error as e:
+            return PageResult(name, pageid, False, e)
+
+
+class BatchResult(object):
+    """Outcome of one ImportFromCSV batch written by a BulkWriter. rows is the list of
+    (index, fields) pairs sent, rids the record IDs QuickBase returned for them in the
+    same order, and error the Error raised by the call, if any.
+
+    """
+    def __init__(self, clist, rows, rids=None, error=None):
+        self.clist = clist
+        self.rows = rows
+        self.rids = rids or []
+        self.error = error
+
+
+class BulkWriter(object):
+    """Buffers record adds and edits for one table and writes them with
+    API_ImportFromCSV in batches, rather than one AddRecord or EditRecord round trip
+    per record:
+
+        with client.bulk_writer(named=True) as writer:
+            writer.add({'Name': 'Widget', 'Price': 3})
+            writer.edit(rid, {'Price': 4})
+
+    Rows are grouped by the set of fields they set, and a group is written once it
+    reaches batch_rows rows or batch_bytes bytes of UTF-8 encoded CSV, and on flush()
+    or exit.
+    Edits include the record ID column (rid_fid) so QuickBase updates the record.
+    Field names are resolved to fids from the table schema when named is True.
+
+    add() and edit() return the index of the row; after the batch holding it is
+    written, rids maps that index to the record ID QuickBase returned. Each batch is
+    recorded in results as a BatchResult, and failed batches are collected in errors
+    rather than raised.
+
+    With concurrency above 1, batches are written by that many threads at once. When
+    that many are already in flight, the call that fills the next batch waits for the
+    oldest to finish, so the buffer cannot grow without bound.
+
+    """
+    def __init__(self, client, database, named=False, batch_rows=1000, batch_bytes=1024 * 1024,
+                 concurrency=1, rid_fid=3):
+        self.client = client
+        self.database = database
+        self.named = named
+        self.batch_rows = batch_rows
+        self.batch_bytes = batch_bytes
+        self.concurrency = concurrency
+        self.rid_fid = str(rid_fid)
+        self.rids = {}
+        self.results = []
+        self._count = 0
+        self._schema = None
+        self._buffers = {}
+        self._pending = collections.deque()
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(concurrency) if concurrency > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def errors(self):
+        """List of BatchResults whose import failed."""
+        return [result for result in self.results if result.error is not None]
+
+    def _fid(self, field):
+        if not self.named:
+            return str(field)
+        if self._schema is None:
+            self._schema = self.client.schema(self.database)
+        return self._schema.fid(field)
+
+    def add(self, fields):
+        """Buffer a new record with the given fields. Return the row index."""
+        return self._write(fields, {})
+
+    def edit(self, rid, fields):
+        """Buffer an update of the given fields on record rid. Return the row index."""
+        return self._write(fields, {self.rid_fid: rid})
+
+    def _write(self, fields, values):
+        for field, value in fields.items():
+            values[self._fid(field)] = value
+        clist = tuple(sorted(values, key=int))
+        index = self._count
+        self._count += 1
+
+        buf = self._buffers.get(clist)
+        if buf is None:
+            buf = self._buffers[clist] = _CSVBuffer()
+        buf.add(index, fields, [values[fid] for fid in clist])
+        if len(buf.rows) >= self.batch_rows or buf.size >= self.batch_bytes:
+            del self._buffers[clist]
+            self._submit(clist, buf)
+        return index
+
+    def _submit(self, clist, buf):
+        if self._pool is None:
+            self._collect(self._import(clist, buf))
+            return
+        while len(self._pending) >= self.concurrency:
+            self._collect(self._pending.popleft().get())
+        self._pending.append(self._pool.apply_async(self._import, (clist, buf)))
+
+    def _import(self, clist, buf):
+        result = BatchResult(clist, buf.rows)
+        try:
+            response = self.client.import_from_csv(buf.getvalue(), list(clist),
+                                                   database=self.database)
+            result.rids = [int(rid.text) for rid in response.findall('rids/rid')]
+        except Error as e:
+            result.error = e
+        return result
+
+    def _collect(self, result):
+        self.results.append(result)
+        for (index, fields), rid in zip(result.rows, result.rids):
+            self.rids[index] = rid
+
+    def flush(self):
+        """Write all buffered rows and wait for every batch to finish."""
+        buffers, self._buffers = self._buffers, {}
+        for clist, buf in buffers.items():
+            self._submit(clist, buf)
+        while self._pending:
+            self._collect(self._pending.popleft().get())
+
+    def close(self):
+        """Flush the remaining rows and stop the writer threads."""
+        self.flush()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+class _CSVBuffer(object):
+    """Rows of one ImportFromCSV batch, kept as CSV text. size is the length of the
+    text in bytes once UTF-8 encoded, as it is sent.
+
+    """
+    def __init__(self):
+        self.rows = []
+        self.size = 0
+        self.buf = io.BytesIO() if PY2 else io.StringIO()
+        self.writer = csv.writer(self, lineterminator='\n')
+
+    def write(self, text):
+        # File interface for the csv writer; on Python 2 text is already UTF-8
+        self.buf.write(text)
+        self.size += len(text) if PY2 else len(text.encode('utf-8'))
+
+    def add(self, index, fields, values):
+        self.rows.append((index, fields))
+        self.writer.writerow([_csv_value(value) for value in values])
+
+    def clear(self):
+        self.buf.seek(0)
+        self.buf.truncate()
+        self.size = 0
+
+    def getvalue(self):
+        value = self.buf.getvalue()
+        return value.decode('utf-8') if PY2 else value
+
+
+class _CSVStream(object):
+    """CSV to upload, read a chunk at a time from a file path, file object or iterable
+    of rows. Iterating yields the CSV as text chunks.
+
+    """
+    def __init__(self, source, chunk_size):
+        self.source = source
+        self.chunk_size = chunk_size
+
+    @property
+    def replayable(self):
+        """Whether the CSV can be read again to resend it. A path is reopened and a
+        list of rows iterated afresh, but a file object or iterator is used up.
+
+        """
+        return isinstance(self.source, (basestring, list, tuple))
+
+    def __iter__(self):
+        if isinstance(self.source, basestring):
+            with open(self.source, 'rb') as f:
+                for chunk in self._read(f):
+                    yield chunk
+        elif hasattr(self.source, 'read'):
+            for chunk in self._read(self.source):
+                yield chunk
+        else:
+            for chunk in self._rows():
+                yield chunk
+
+    def _read(self, f):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            yield chunk
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    def _rows(self):
+        buf = _CSVBuffer()
+        for row in self.source:
+            if isinstance(row, basestring):
+                buf.write(row.encode('utf-8') if PY2 and isinstance(row, unicode) else row)
+            else:
+                buf.writer.writerow([_csv_value(value) for value in row])
+            if buf.size >= self.chunk_size:
+                yield buf.getvalue()
+                buf.clear()
+        if buf.size:
+            yield buf.getvalue()
+
+
+def _cdata_escape(chunks):
+    """Escape text chunks for use inside a CDATA section, splitting any "]]>" into two
+    sections, including one that straddles chunks.
+
+    >>> print(''.join(_cdata_escape(['a]', ']>b]]', '>c'])))
+    a]]]]><![CDATA[>b]]]]><![CDATA[>c
+
+    """
+    tail = ''
+    for chunk in chunks:
+        data = tail + chunk
+        # Hold back trailing "]"s that might start a "]]>" in the next chunk
+        cut = len(data)
+        while cut and data[cut - 1] == ']':
+            cut -= 1
+        data, tail = data[:cut], data[cut:]
+        if data:
+            yield data.replace(']]>', ']]]]><![CDATA[>')
+    if tail:
+        yield tail
+
+
+def _csv_value(value):
+    """Format a field value for QuickBase CSV."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if PY2 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
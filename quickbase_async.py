@@ -0,0 +1,612 @@
+"""asyncio interface to the QuickBase API, using aiohttp for HTTP.
+
+AsyncClient shares request building and response parsing with quickbase.Client;
+the difference is that every API method returns an awaitable. Requires Python 3.7+.
+
+"""
+import asyncio
+import collections
+import contextlib
+import inspect
+import itertools
+import os
+import tempfile
+import time
+import weakref
+
+import aiohttp
+
+from quickbase import (Client, ConnectionError, DownloadManager, DownloadResult, Error,
+                       PageResult, PageSync, ResponseError, XMLError, _BodyHead, _RecordReader,
+                       _clock)
+
+# asyncio.Locks by event loop and ticket provider. A provider's own lock only keeps
+# threads and processes apart, so the clients of one loop also take one of these.
+_provider_locks = weakref.WeakKeyDictionary()
+
+
+def _provider_lock(provider):
+    """Return the lock that the AsyncClients of the running event loop hold while
+    they load a ticket from provider.
+
+    """
+    locks = _provider_locks.setdefault(asyncio.get_running_loop(), weakref.WeakKeyDictionary())
+    lock = locks.get(provider)
+    if lock is None:
+        lock = locks[provider] = asyncio.Lock()
+    return lock
+
+
+class AioTransport(object):
+    """aiohttp transport for an AsyncClient. Connections are pooled and kept alive in
+    one ClientSession, opening at most pool_size connections in total and
+    limit_per_host (0 for no limit) to any one host. At most concurrency requests are
+    in flight at once; further requests wait their turn. timeout is the read timeout
+    in seconds and connect_timeout defaults to the same value. Compressed responses
+    are decompressed by aiohttp unless auto_decompress is False.
+
+    """
+    def __init__(self, pool_size=100, limit_per_host=0, concurrency=100, timeout=30,
+                 connect_timeout=None, keep_alive=True, auto_decompress=True):
+        self.pool_size = pool_size
+        self.limit_per_host = limit_per_host
+        self.concurrency = concurrency
+        self.keep_alive = keep_alive
+        self.auto_decompress = auto_decompress
+        self.timeout = aiohttp.ClientTimeout(
+            connect=connect_timeout if connect_timeout is not None else timeout,
+            sock_read=timeout)
+        self._session = None
+        self._limit = None
+
+    @property
+    def session(self):
+        # aiohttp sessions must be created inside the running event loop
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             limit_per_host=self.limit_per_host,
+                                             force_close=not self.keep_alive)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                  auto_decompress=self.auto_decompress)
+            self._limit = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, url, data=None, headers=None):
+        """Do an HTTP request and yield the response for its body to be read. Raises
+        ConnectionError on connection failures and timeouts.
+
+        """
+        session = self.session
+        async with self._limit:
+            try:
+                async with session.request(method, url, data=data, headers=headers) as response:
+                    yield response
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise ConnectionError(-2, e)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncClient(Client):
+    """asyncio client to the QuickBase API. Takes the same arguments as Client and has
+    the same API methods, but each must be awaited (iter_query and do_query_all are
+    async generators). export_table and bulk_writer raise TypeError, and TableMirror,
+    TableExporter and BulkWriter need a Client. Used as an async
+    context manager, the client authenticates on entry if it has no ticket and closes
+    its connections on exit:
+
+        async with AsyncClient(username, password, database=dbid) as client:
+            records = await client.do_query("{'3'.XEX.''}")
+
+    HTTP requests go through transport, by default an AioTransport using the given
+    timeout. With a scheduler, requests waiting for a free slot check every
+    acquire_interval seconds. A ticket from a ticket_provider is renewed when a
+    request is made within ticket_renew_margin seconds of its expiry, rather than in
+    the background. With compression, the default transport leaves compressed
+    responses for the client to decompress and count.
+
+    """
+    acquire_interval = 0.005
+
+    def __init__(self, username=None, password=None, base_url='https://www.quickbase.com',
+                 timeout=30, database=None, apptoken=None, realmhost=None, hours=12, ticket=None,
+                 transport=None, detect_encoding=False, schema_ttl=600, cache=None, hooks=None,
+                 scheduler=None, coalesce=False, ticket_provider=None, xml_backend=None,
+                 compression=None):
+        if transport is None:
+            transport = AioTransport(timeout=timeout, auto_decompress=compression is None)
+        super(AsyncClient, self).__init__(
+            username, password, base_url, timeout, authenticate=False, database=database,
+            apptoken=apptoken, realmhost=realmhost, hours=hours, ticket=ticket,
+            transport=transport, detect_encoding=detect_encoding, schema_ttl=schema_ttl,
+            cache=cache, hooks=hooks, scheduler=scheduler, coalesce=coalesce,
+            ticket_provider=ticket_provider, xml_backend=xml_backend, compression=compression)
+        self._async_ticket_lock = None
+
+    async def __aenter__(self):
+        if self.ticket is None and self.username is not None:
+            if self.ticket_provider is not None:
+                await self._load_ticket()
+            else:
+                await self.authenticate()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Close the transport and any pooled connections it holds."""
+        await self.transport.close()
+
+    @contextlib.asynccontextmanager
+    async def _send(self, action, database, request, ticket=True, apptoken=True, event=None):
+        if event is not None:
+            start = _clock()
+        url, data, headers = self._prepare(action, database, request, ticket, apptoken)
+        if event is not None:
+            data = event.sending(data)
+            start = self._timed(event, 'build', start)
+        if inspect.isgenerator(data):
+            data = _aiter(data)
+        async with self.transport.request('POST', url, data=data, headers=headers) as response:
+            if event is not None:
+                self._timed(event, 'connect', start)
+            if response.status != 200:
+                raise ConnectionError(-2, 'HTTP {0}: {1}'.format(response.status, response.reason),
+                                      response=await response.read(), http_response=response)
+            yield response
+
+    def _body(self, response, action=None):
+        """Return an async iterator over the body of response in chunks, decompressed
+        as they arrive if the client has compression and the transport leaves
+        compressed responses to it.
+
+        """
+        chunks = response.content.iter_chunked(self.chunk_size)
+        decoder = None
+        if self.compression is not None and not getattr(self.transport, 'auto_decompress', True):
+            decoder = self.compression.decoder(action, response.headers.get('Content-Encoding'))
+        return chunks if decoder is None else _adecoded(decoder, chunks)
+
+    async def _read_response(self, response, event=None, action=None):
+        chunks = self._body(response, action)
+        if event is not None:
+            chunks = _atimed(event, 'transfer', chunks)
+            start = _clock()
+        parser = None
+        size = 0
+        head = _BodyHead()
+        try:
+            async for chunk in chunks:
+                if parser is None:
+                    parser = self._parser(response, chunk, event)
+                head.add(chunk)
+                parser.feed(chunk)
+                size += len(chunk)
+            if parser is None:
+                raise XMLError(-1, 'empty response')
+            root = parser.close()
+            if event is not None:
+                event.received(size, start)
+            return root, size
+        except self.xml.error as e:
+            raise head.attach(XMLError(-1, e))
+        except XMLError as e:
+            head.attach(e)
+            raise
+
+    async def request(self, action, database, request, required=None, ticket=True,
+                      apptoken=True, event=None):
+        """Do a QuickBase request and return the parsed XML response, as
+        Client.request does, including use of the client's cache, hooks and
+        coalescing.
+
+        """
+        if event is None and self.hooks:
+            return await self._call(action, database, request, required=required,
+                                    ticket=ticket, apptoken=apptoken)
+        cache_key = self._cache_key(action, database, request)
+        if cache_key is not None:
+            parsed = self.cache.get(cache_key)
+            if parsed is not None:
+                if event is not None:
+                    event.cached = True
+                    event.errcode = parsed.findtext('errcode')
+                return self._check_response(parsed, required)
+        if (ticket and self.ticket_provider is not None and self.ticket_expires is not None and
+                self.ticket_expires - time.time() <= self._renew_margin()):
+            await self._renew_ticket(self.ticket)
+        used_ticket = self.ticket
+        parsed, size = await self._fetch(action, database, request, ticket, apptoken, event)
+        if (ticket and self._ticket_expired(parsed) and
+                await self._renew_refused(used_ticket, request)):
+            parsed, size = await self._fetch(action, database, request, ticket, apptoken, event)
+        if event is not None:
+            event.errcode = parsed.findtext('errcode')
+        result = self._check_response(parsed, required)
+        if cache_key is not None:
+            self.cache.put(cache_key, database, parsed, size)
+        return result
+
+    async def _fetch(self, action, database, request, ticket, apptoken, event):
+        fetch = self._attempt if self.scheduler is None else self._scheduled
+        flight_key = self._flight_key(action, database, request)
+        if flight_key is None:
+            return await fetch(action, database, request, ticket, apptoken, event)
+        return await self._coalesced(
+            flight_key, fetch(action, database, request, ticket, apptoken, event))
+
+    async def _load_ticket(self, stale=None):
+        """Take the ticket for this realm and user from the ticket provider, as
+        Client._load_ticket does, but without scheduling a background renewal.
+
+        """
+        key = self._ticket_key()
+        async with _provider_lock(self.ticket_provider):
+            with self.ticket_provider.lock(key):
+                entry = self.ticket_provider.get(key)
+                if not self._fresh_ticket(entry, stale):
+                    await self.authenticate()
+                    entry = (self.ticket, self.user_id, self.ticket_expires)
+                    self.ticket_provider.put(key, *entry)
+        self.ticket, self.user_id, self.ticket_expires = entry
+
+    async def _renew_ticket(self, stale):
+        if self._async_ticket_lock is None:
+            self._async_ticket_lock = asyncio.Lock()
+        # Other coroutines wait here, not on the provider's lock, which would block the loop
+        async with self._async_ticket_lock:
+            if self.ticket != stale:
+                return
+            if self.ticket_provider is not None:
+                await self._load_ticket(stale)
+            else:
+                await self.authenticate()
+
+    async def _renew_refused(self, stale, request):
+        await self._renew_ticket(stale)
+        return self._replayable(request)
+
+    async def _renewing(self, call, request):
+        """Return await call(), which sends request, as Client._renewing does."""
+        used_ticket = self.ticket
+        try:
+            return await call()
+        except ResponseError as e:
+            if not (self._ticket_refused(e) and await self._renew_refused(used_ticket, request)):
+                raise
+        return await call()
+
+    async def _coalesced(self, key, fetch):
+        """Await fetch and return its result, unless a request for key is already in
+        flight, in which case close fetch unstarted and share that one's result.
+
+        """
+        future, leader = self.coalescer.begin(key, asyncio.get_running_loop().create_future)
+        if not leader:
+            fetch.close()
+            # shield, so one waiter being cancelled does not cancel the others
+            return await asyncio.shield(future)
+        try:
+            result = await fetch
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception retrieved in case no other caller was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.coalescer.end(key)
+            if not future.done():
+                future.cancel()
+
+    async def _attempt(self, action, database, request, ticket, apptoken, event):
+        try:
+            async with self._send(action, database, request, ticket, apptoken,
+                                  event) as response:
+                return await self._read_response(response, event, action)
+        finally:
+            self._invalidate_cache(action, database)
+
+    async def _scheduled(self, action, database, request, ticket, apptoken, event):
+        scheduler = self.scheduler
+        replayable = self._replayable(request)
+        for attempt in itertools.count():
+            await asyncio.sleep(scheduler.delay(self.base_url, database))
+            while not scheduler.try_acquire():
+                await asyncio.sleep(self.acquire_interval)
+            start = _clock()
+            outcome = None
+            try:
+                parsed, size = await self._attempt(action, database, request, ticket, apptoken,
+                                                   event)
+                outcome = parsed
+            except ConnectionError as e:
+                outcome = e
+                wait = scheduler.retry_delay(action, e, attempt) if replayable else None
+                if wait is None:
+                    raise
+            else:
+                wait = scheduler.retry_delay(action, parsed, attempt) if replayable else None
+                if wait is None:
+                    return parsed, size
+            finally:
+                scheduler.release(_clock() - start, outcome)
+            if event is not None:
+                event.retries += 1
+            await asyncio.sleep(wait)
+
+    async def _call(self, action, database, request, required=None, parse=None, **kwargs):
+        if not self.hooks:
+            response = await self.request(action, database, request, required=required, **kwargs)
+            return parse(response) if parse else response
+        event = self._start_event(action, database)
+        try:
+            response = await self.request(action, database, request, required=required,
+                                          event=event, **kwargs)
+            if parse:
+                start = _clock()
+                response = parse(response)
+                self._timed(event, 'record_parse', start)
+        except Exception as e:
+            self._end_event(event, e)
+            raise
+        self._end_event(event)
+        return response
+
+    async def schema(self, database=None, refresh=False):
+        """Return the Schema of the given table, from the cache if fresh, as
+        Client.schema does.
+
+        """
+        database = database or self.database
+        schema = None if refresh else self._cached_schema(database)
+        if schema is None:
+            schema = self._cache_schema(database, await self.get_schema(database=database))
+        return schema
+
+    async def do_query(self, *args, **kwargs):
+        """Perform query and return results, as Client.do_query does."""
+        columns = kwargs.get('columns', args[3] if len(args) > 3 else None)
+        named = isinstance(columns, (list, tuple)) and not all(
+            isinstance(column, int) or column.isdigit() for column in columns)
+        if kwargs.get('result') not in (None, 'views') or named:
+            # Load the schema used to convert the result or resolve names into the cache first
+            await self.schema(kwargs.get('database'))
+        return await super(AsyncClient, self).do_query(*args, **kwargs)
+
+    async def _query_parallel(self, database, request, processes):
+        """Download a DoQuery response to a temporary file and parse it with
+        _parse_parallel in the default executor, as Client._query_parallel does.
+
+        """
+        return await self._renewing(
+            lambda: self._download_parallel(database, request, processes), request)
+
+    async def _download_parallel(self, database, request, processes):
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        try:
+            encoding = None
+            with os.fdopen(fd, 'wb') as f:
+                async with self._send('DoQuery', database, request) as response:
+                    async for chunk in self._body(response, 'DoQuery'):
+                        if encoding is None and chunk:
+                            encoding = self._response_encoding(response, chunk) or ''
+                        f.write(chunk)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._parse_parallel, path,
+                                              encoding or None, processes)
+        finally:
+            os.remove(path)
+
+    async def iter_query(self, query=None, qid=None, qname=None, columns=None, sort=None,
+                         structured=True, num=None, only_new=False, skip=None, ascending=True,
+                         include_rids=False, database=None):
+        """Perform query and yield results (dicts) one at a time as they download, as
+        Client.iter_query does.
+
+        """
+        request = self._query_request(query, qid, qname, columns, sort, structured, num,
+                                      only_new, skip, ascending, include_rids)
+        database = database or self.database
+        used_ticket = self.ticket
+        try:
+            async for record in self._iter_records(database, request):
+                yield record
+            return
+        except ResponseError as e:
+            if not (self._ticket_refused(e) and await self._renew_refused(used_ticket, request)):
+                raise
+        async for record in self._iter_records(database, request):
+            yield record
+
+    async def _iter_records(self, database, request):
+        async with self._send('DoQuery', database, request) as response:
+            reader = None
+            head = _BodyHead()
+            try:
+                async for chunk in self._body(response, 'DoQuery'):
+                    if reader is None:
+                        reader = _RecordReader(self, self._response_encoding(response, chunk))
+                    head.add(chunk)
+                    for record in reader.feed(chunk):
+                        yield record
+                if reader is None:
+                    raise XMLError(-1, 'empty response')
+                reader.close()
+            except XMLError as e:
+                head.attach(e)
+                raise
+
+    async def do_query_all(self, query, columns=None, sort=None, structured=True, ascending=True,
+                           include_rids=False, page_size=1000, concurrency=4, database=None):
+        """Perform query over all matching records and yield results (dicts) in order,
+        fetching up to concurrency pages at once, as Client.do_query_all does.
+
+        """
+        database = database or self.database
+        sort = self._stable_sort(sort)
+        total = await self.do_query_count(query, database=database)
+        skips = collections.deque(range(0, total, page_size))
+        pending = collections.deque()
+        try:
+            while skips or pending:
+                while skips and len(pending) < concurrency:
+                    pending.append(asyncio.ensure_future(self.do_query(
+                        query, columns=columns, sort=sort, structured=structured,
+                        num=page_size, skip=skips.popleft(), ascending=ascending,
+                        include_rids=include_rids, database=database)))
+                for record in await pending.popleft():
+                    yield record
+        finally:
+            for page in pending:
+                page.cancel()
+
+    async def get_file(self, fname, folder, rid, fid, database=None):
+        """Download an attachment to folder/fname, streaming it to disk."""
+        result = (await self.download_files([(str(rid), str(fid), fname)], folder,
+                                            database=database, concurrency=1))[0]
+        if result.error is not None:
+            raise result.error
+        return os.path.join(os.getcwd(), result.path)
+
+    async def download_files(self, files, folder, database=None, concurrency=4):
+        """Download many attachments to folder, concurrency at a time, and return a
+        list of DownloadResults, as Client.download_files does (see DownloadManager).
+
+        """
+        manager = DownloadManager(self, folder, database=database, concurrency=concurrency)
+        limit = asyncio.Semaphore(concurrency)
+
+        async def download(target):
+            async with limit:
+                return await self._download(folder, target)
+        return list(await asyncio.gather(*[download(target)
+                                           for target in manager._targets(files)]))
+
+    async def _download(self, folder, target):
+        """Stream one attachment to disk through a .part file, as
+        DownloadManager._download does.
+
+        """
+        url, filename = target
+        path = os.path.join(folder, filename)
+        part = path + '.part'
+        try:
+            # Ask for the file as stored, which the transport may not decompress
+            headers = {'Cookie': 'ticket={0}'.format(self.ticket), 'Accept-Encoding': 'identity'}
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset:
+                headers['Range'] = 'bytes={0}-'.format(offset)
+            async with self.transport.request('GET', url, headers=headers) as response:
+                restart = response.status == 416
+                if restart:
+                    # The partial file is no good; start over once the connection is free
+                    os.remove(part)
+                elif response.status not in (200, 206):
+                    raise ConnectionError(-2, 'HTTP {0}: {1}'.format(response.status, response.reason))
+                else:
+                    length = response.headers.get('Content-Length')
+                    if (response.status == 200 and length is not None and os.path.exists(path)
+                            and os.path.getsize(path) == int(length)):
+                        return DownloadResult(url, path, int(length), True, None)
+                    with open(part, 'ab' if response.status == 206 else 'wb') as f:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            f.write(chunk)
+            if restart:
+                return await self._download(folder, target)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(part, path)
+            return DownloadResult(url, path, os.path.getsize(path), False, None)
+        except (Error, IOError, OSError) as e:
+            return DownloadResult(url, path, None, False, e)
+
+    async def deploy_db_pages(self, pages, manifest_path='.quickbase-pages.json', database=None,
+                              concurrency=4, force=False):
+        """Upload the new and changed pages of pages, concurrency at a time, as
+        Client.deploy_db_pages does (see PageSync).
+
+        """
+        sync = PageSync(self, database, manifest_path, concurrency)
+        plan = sync._plan(pages, await self.list_db_pages(database=sync.database), force)
+        limit = asyncio.Semaphore(concurrency)
+
+        async def upload(item):
+            name, pageid = item[0], item[3]
+            async with limit:
+                try:
+                    response = await self._call('AddReplaceDBPage', sync.database,
+                                                sync._upload_request(item), required=['pageID'])
+                    return PageResult(name, str(response['pageID']), True, None)
+                except Error as e:
+                    return PageResult(name, pageid, False, e)
+        uploaded = await asyncio.gather(*[upload(item) for item in plan[3]])
+        return sync._finish(pages, plan, uploaded)
+
+    def export_table(self, database, path, format='csv', compress=None, **kwargs):
+        raise TypeError('export_table needs a quickbase.Client; TableExporter fetches '
+                        'and writes pages synchronously')
+
+    def bulk_writer(self, database=None, named=False, **kwargs):
+        raise TypeError('bulk_writer needs a quickbase.Client; BulkWriter writes batches '
+                        'synchronously from threads')
+
+    async def return_file(self, url):
+        headers = {'Cookie': 'ticket=%s' % self.ticket}
+        async with self.transport.request('GET', url, headers=headers) as response:
+            return os.path.basename(url), await response.read()
+
+
+async def _atimed(event, phase, chunks):
+    """Yield from an async iterable of chunks, adding the time spent waiting for each
+    one to phase of event.
+
+    """
+    chunks = chunks.__aiter__()
+    while True:
+        start = _clock()
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            event.add(phase, _clock() - start)
+        yield chunk
+
+
+async def _adecoded(decoder, chunks):
+    """Yield the decompressed body from an async iterable of compressed chunks, as
+    _Decoder.decode does.
+
+    """
+    chunks = chunks.__aiter__()
+    while True:
+        start = _clock()
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            break
+        finally:
+            decoder.transfer += _clock() - start
+        data = decoder.feed(chunk)
+        if data:
+            yield data
+    data = decoder.close()
+    if data:
+        yield data
+
+
+async def _aiter(chunks):
+    """Wrap a generator of request body chunks for aiohttp, which streams async
+    iterables.
+
+    """
+    for chunk in chunks:
+        yield chunk
@@ -6,7 +6,7 @@ except ImportError:
 setup(
     name='pyquickbase',
     version='0.2.5',
-    py_modules=['quickbase'],
+    py_modules=['quickbase', 'quickbase_async'],
     packages=find_packages(),
     description='pyQuickBase is a Python interface for the Intuit QuickBase API',
     long_description=open('README.rst').read(),
@@ -14,13 +14,17 @@ setup(
                  'Intended Audience :: Information Technology',
                  'License :: OSI Approved :: MIT License',
                  'Programming Language :: Python :: 2.7',
+                 'Programming Language :: Python :: 3',
                  'Topic :: Software Development :: Libraries :: Python Modules',
                  'Operating System :: OS Independent',
                  'Environment :: Web Environment'
                  ],
     install_requires=[
-        'lxml==3.2.1',
-        'requests>=1.1.0,<2.0',
-        'chardet>= 2.1.1',
+        'requests>=2.4.0',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+        'lxml': ['lxml>=3.3'],
+        'chardet': ['chardet>= 2.1.1'],
+    },
 )
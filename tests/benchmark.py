@@ -0,0 +1,140 @@
+"""Offline benchmarks of Client against a local mock QuickBase server.
+
+Runs each benchmark at each table size and prints operations/sec, MB/sec of XML
+parsed, p50/p99 latency and the process's peak RSS so far:
+
+    python tests/benchmark.py --records 1000,10000,100000 --latency 0.02
+
+Sizes up to 1000000 records work; the largest take a few minutes and some GB of memory.
+
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import quickbase
+from mock_server import MockServer, MockTable
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+MB = 1024.0 * 1024
+
+
+def peak_rss_mb():
+    """Return peak resident set size of this process in MB, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return peak / MB if sys.platform == 'darwin' else peak / 1024.0
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))]
+
+
+def run(name, records, func, iterations, size=0):
+    """Call func iterations times and return a result row. size is the number of
+    bytes of XML each call handles, for MB/sec.
+
+    """
+    timings = []
+    for _ in range(iterations):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    total = sum(timings)
+    return {
+        'name': name,
+        'records': records,
+        'ops': iterations / total if total else float('inf'),
+        'mbs': size * iterations / MB / total if size and total else None,
+        'p50': percentile(timings, 50) * 1000,
+        'p99': percentile(timings, 99) * 1000,
+        'rss': peak_rss_mb(),
+    }
+
+
+def print_row(row):
+    def fmt(value, spec):
+        return '-' if value is None else format(value, spec)
+    print('{0:<16} {1:>9} {2:>11} {3:>9} {4:>10} {5:>10} {6:>9}'.format(
+        row['name'], row['records'], fmt(row['ops'], '.1f'), fmt(row['mbs'], '.2f'),
+        fmt(row['p50'], '.2f'), fmt(row['p99'], '.2f'), fmt(row['rss'], '.0f')))
+
+
+def bench_size(records, args):
+    table = MockTable(size=records)
+    server = MockServer(tables={'bqtable': table}, latency=args.latency, encoding=args.encoding,
+                        compress=args.compress)
+    with server:
+        client = quickbase.Client('user', 'password', base_url=server.url, database='bqtable',
+                                  xml_backend=quickbase.get_xml_backend(args.xml_backend),
+                                  compression=quickbase.Compression() if args.compress else None)
+        query = {'query': "{'3'.XEX.''}", 'clist': 'a', 'fmt': 'structured'}
+        iterations = max(1, min(args.iterations, args.iterations * 10000 // records))
+
+        # Size of the DoQuery response, and parsed copies to time the parsers on
+        with client._send('DoQuery', 'bqtable', query) as response:
+            records_xml, size = client._read_response(response)
+        with client._send('GetSchema', 'bqtable', {}) as response:
+            schema_xml, schema_size = client._read_response(response)
+
+        yield run('request', records, lambda: client.request('DoQuery', 'bqtable', query),
+                  iterations, size)
+        yield run('_parse_records', records, lambda: client._parse_records(records_xml),
+                  iterations, size)
+        yield run('_parse_views', records,
+                  lambda: [view['3'] for view in client._parse_views(records_xml)],
+                  iterations, size)
+        if args.processes > 1:
+            client.parallel_min_bytes = 0
+            yield run('do_query/{0}p'.format(args.processes), records,
+                      lambda: client.do_query(query['query'], columns='a', processes=args.processes),
+                      iterations, size)
+        yield run('_parse_schema', records, lambda: client._parse_schema(schema_xml),
+                  args.iterations, schema_size)
+        fields = dict(('_fid_{0}'.format(fid), 'value {0} & <more>'.format(fid))
+                      for fid, _, _, _ in table.fields)
+        yield run('_build_request', records,
+                  lambda: client._build_request(rid=1, ticket='ticket', **fields),
+                  args.iterations * 10)
+        client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pyquickbase against a mock server.')
+    parser.add_argument('--records', default='1000,10000,100000',
+                        help='comma-separated table sizes (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='calls per benchmark at 10000 records; scaled by size')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds of latency added to each response')
+    parser.add_argument('--encoding', default='utf-8', help='response encoding')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress requests and responses (see quickbase.Compression)')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='also time do_query parsing with this many worker processes')
+    parser.add_argument('--xml-backend', choices=['lxml', 'etree'],
+                        help='XML backend to parse with (default: lxml if installed)')
+    args = parser.parse_args(argv)
+
+    print('{0:<16} {1:>9} {2:>11} {3:>9} {4:>10} {5:>10} {6:>9}'.format(
+        'benchmark', 'records', 'ops/sec', 'MB/sec', 'p50 ms', 'p99 ms', 'RSS MB'))
+    for records in [int(n) for n in args.records.split(',')]:
+        for row in bench_size(records, args):
+            print_row(row)
+
+
+if __name__ == '__main__':
+    main()
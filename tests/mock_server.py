@@ -0,0 +1,557 @@
+"""Local stand-in for the QuickBase HTTP API, for offline tests and benchmarks.
+
+Serves the API_ actions Client uses over synthetic tables whose records are generated
+on demand from their record ID, so tables of millions of records cost no memory
+until records are changed. Start one with:
+
+    server = MockServer(tables={'bqtable': MockTable(size=10000)})
+    server.start()
+    client = quickbase.Client('user', 'password', base_url=server.url, database='bqtable')
+    ...
+    server.stop()
+
+"""
+from __future__ import unicode_literals
+
+import collections
+import csv
+import io
+import random
+import socket
+import sys
+import threading
+import time
+import zlib
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import xml.etree.ElementTree as etree
+
+import quickbase
+
+PY2 = sys.version_info[0] == 2
+
+# (field_type, base_type, label) of the fields generated after the built-in fields
+DEFAULT_FIELDS = [
+    ('text', 'text', 'Name'),
+    ('float', 'float', 'Amount'),
+    ('date', 'int64', 'Due Date'),
+    ('checkbox', 'bool', 'Done'),
+    ('multitext', 'text', 'Tags'),
+    ('file', 'text', 'Attachment'),
+]
+BUILTIN_FIELDS = [
+    ('1', 'timestamp', 'int64', 'Date Created'),
+    ('2', 'timestamp', 'int64', 'Date Modified'),
+    ('3', 'recordid', 'int64', 'Record ID#'),
+]
+BASE_MS = 1262304000000
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class MockTable(object):
+    """Synthetic table of size records with the given field mix (list of
+    (field_type, base_type, label) tuples), numbered from fid 6 after the built-in
+    Date Created, Date Modified and Record ID# fields. Records are generated from their
+    rid; adds, edits and deletes are kept as overrides.
+
+    """
+    def __init__(self, size=1000, fields=None):
+        self.size = size
+        self.fields = list(BUILTIN_FIELDS)
+        for i, (field_type, base_type, label) in enumerate(fields or DEFAULT_FIELDS):
+            self.fields.append((str(6 + i), field_type, base_type, label))
+        self.by_fid = dict((f[0], f) for f in self.fields)
+        self.by_name = dict((quickbase.to_xml_name(f[3]), f[0]) for f in self.fields)
+        self.changed = {}
+        self.deleted = set()
+        self.next_rid = size + 1
+        self.lock = threading.Lock()
+
+    def generate(self, rid):
+        """Return the generated record (dict of fid: text) for rid."""
+        record = {}
+        for fid, field_type, base_type, label in self.fields:
+            if fid == '3':
+                value = str(rid)
+            elif fid in ('1', '2'):
+                value = str(BASE_MS + rid * 1000)
+            elif field_type == 'checkbox':
+                value = '1' if rid % 2 else '0'
+            elif field_type in ('date', 'timestamp'):
+                value = str(BASE_MS + (rid % 3650) * DAY_MS)
+            elif base_type in ('float', 'int64', 'int32'):
+                value = str((rid * 7 + int(fid)) % 100000 / 4.0)
+            elif field_type == 'multitext':
+                value = ('red;blue', 'green', '')[rid % 3]
+            elif field_type == 'file':
+                value = 'file{0}.txt'.format(rid)
+            else:
+                value = '{0} {1} caf\xe9 & co'.format(label, rid)
+            record[fid] = value
+        return record
+
+    def record(self, rid):
+        record = self.generate(rid) if rid <= self.size else {}
+        record.update(self.changed.get(rid, {}))
+        return record
+
+    def rids(self):
+        for rid in range(1, self.size + 1):
+            if rid not in self.deleted:
+                yield rid
+        for rid in sorted(self.changed):
+            if rid > self.size and rid not in self.deleted:
+                yield rid
+
+    def records(self, query=None):
+        """Yield records matching query, in rid order."""
+        test = None
+        if query and query.replace(' ', '') != "{'3'.XEX.''}":
+            test = quickbase.compile_query(query)
+        for rid in self.rids():
+            record = self.record(rid)
+            if test is None or test(record):
+                yield record
+
+    def fid(self, field):
+        return self.by_name.get(field, field)
+
+    def write(self, rid, values):
+        """Set values (dict of fid: text) on record rid, adding it if rid is None.
+        Return the rid.
+
+        """
+        with self.lock:
+            if rid is None:
+                rid = self.next_rid
+                self.next_rid += 1
+                values = dict(values, **{'1': str(int(time.time() * 1000))})
+            elif rid in self.deleted or (rid > self.size and rid not in self.changed):
+                raise KeyError(rid)
+            values = dict(values, **{'2': str(int(time.time() * 1000)), '3': str(rid)})
+            self.changed.setdefault(rid, {}).update(values)
+            return rid
+
+    def delete(self, rid):
+        with self.lock:
+            if rid in self.deleted or (rid > self.size and rid not in self.changed):
+                raise KeyError(rid)
+            self.deleted.add(rid)
+
+
+class MockQuickBase(object):
+    """State of a mock realm: tables by dbid, DB pages, and issued tickets. latency is
+    the delay in seconds added to each response, plus up to jitter more at random.
+    Responses are encoded with encoding. Beyond rate_limit requests in any second,
+    requests fail with errcode 77 (API request limit exceeded), and error_rate is the
+    fraction of requests answered with HTTP 503. The next truncate responses are cut
+    off partway through their body by closing the connection. Tickets expire after
+    ticket_lifetime seconds if given, otherwise after the hours requested. With
+    compress, API responses are gzip or deflate compressed, and whole attachments
+    gzip compressed, if the request's Accept-Encoding allows it. Compressed request
+    bodies are always accepted.
+
+    """
+    def __init__(self, tables=None, latency=0, jitter=0, encoding='utf-8', rate_limit=None,
+                 error_rate=0, truncate=0, ticket_lifetime=None, compress=False):
+        self.tables = tables if tables is not None else {'bqtable': MockTable()}
+        self.latency = latency
+        self.jitter = jitter
+        self.encoding = encoding
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.truncate = truncate
+        self.compress = compress
+        self.pages = {}
+        self.ticket_lifetime = ticket_lifetime
+        self.tickets = {}
+        self.authentications = 0
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self._window = collections.deque()
+
+    def throttle(self):
+        """Count a request against rate_limit and return True if it exceeds it."""
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = time.time()
+            while self._window and self._window[0] <= now - 1:
+                self._window.popleft()
+            if len(self._window) >= self.rate_limit:
+                self.throttled += 1
+                return True
+            self._window.append(now)
+            return False
+
+    def truncating(self):
+        """Return True if the current response is to be cut off, counting it."""
+        with self.lock:
+            if self.truncate <= 0:
+                return False
+            self.truncate -= 1
+            return True
+
+    def handle(self, action, dbid, fields):
+        """Handle an API call and return (errcode, errtext, body), where body is an
+        iterable of text chunks to add to the response.
+
+        """
+        with self.lock:
+            self.requests += 1
+        if self.throttle():
+            return 77, 'API request limit exceeded', []
+        if action == 'Authenticate':
+            ticket = 'ticket{0}'.format(random.getrandbits(64))
+            lifetime = self.ticket_lifetime or float(fields.get('hours') or 12) * 3600
+            with self.lock:
+                self.authentications += 1
+                self.tickets[ticket] = time.time() + lifetime
+            return 0, 'No error', ['<ticket>{0}</ticket><userid>1.abc</userid>'.format(ticket)]
+        if self.tickets.get(fields.get('ticket'), 0) < time.time():
+            return 4, 'User not authorized', []
+        handler = getattr(self, 'do_' + action.lower(), None)
+        if handler is None:
+            return 5, 'Unimplemented operation', []
+        if action not in ('SignOut', 'GrantedDBs') and dbid not in self.tables:
+            return 32, 'No such database', []
+        try:
+            return handler(self.tables.get(dbid), fields)
+        except KeyError as e:
+            return 30, 'No such record {0}'.format(e), []
+        except ValueError as e:
+            return 2, 'Invalid input: {0}'.format(e), []
+
+    def do_signout(self, table, fields):
+        self.tickets.pop(fields['ticket'], None)
+        return 0, 'No error', []
+
+    def do_granteddbs(self, table, fields):
+        databases = ''.join('<dbinfo><dbname>{0}</dbname><dbid>{0}</dbid></dbinfo>'.format(dbid)
+                            for dbid in sorted(self.tables))
+        return 0, 'No error', ['<databases>' + databases + '</databases>']
+
+    def do_getschema(self, table, fields):
+        parts = ['<table><fields>']
+        for fid, field_type, base_type, label in table.fields:
+            parts.append('<field id="{0}" field_type="{1}" base_type="{2}"><label>{3}</label></field>'.format(
+                fid, field_type, base_type, _escape(label)))
+        parts.append('</fields></table>')
+        return 0, 'No error', parts
+
+    def _query(self, table, fields):
+        records = table.records(fields.get('query'))
+        options = dict(option.split('-', 1) for option in (fields.get('options') or '').split('.')
+                       if '-' in option)
+        if fields.get('slist') and fields['slist'] != '3':
+            records = quickbase.local_query(list(records), sort=fields['slist'].split('.'),
+                                            ascending=options.get('sortorder') != 'D')
+        elif options.get('sortorder') == 'D':
+            records = list(records)[::-1]
+        skip = int(options.get('skp', 0))
+        num = int(options['num']) if 'num' in options else None
+        for i, record in enumerate(records):
+            if i < skip:
+                continue
+            if num is not None and i >= skip + num:
+                break
+            yield record
+
+    def do_doquerycount(self, table, fields):
+        count = sum(1 for _ in table.records(fields.get('query')))
+        return 0, 'No error', ['<numMatches>{0}</numMatches>'.format(count)]
+
+    def do_doquery(self, table, fields):
+        clist = fields.get('clist')
+        if clist and clist != 'a':
+            fids = clist.split('.')
+        else:
+            fids = [f[0] for f in table.fields]
+        structured = fields.get('fmt') == 'structured'
+        names = dict((f[0], quickbase.to_xml_name(f[3])) for f in table.fields)
+        dbid = fields['_dbid']
+
+        def render():
+            yield '<table><records>' if structured else ''
+            batch = []
+            for record in self._query(table, fields):
+                parts = ['<record>']
+                for fid in fids:
+                    if fid not in record:
+                        continue
+                    value = _escape(record[fid])
+                    if table.by_fid[fid][1] == 'file' and value:
+                        value += '<url>{0}/up/{1}/a/r{2}/e{3}/v0</url>'.format(
+                            fields['_url'], dbid, record['3'], fid)
+                    if structured:
+                        parts.append('<f id="{0}">{1}</f>'.format(fid, value))
+                    else:
+                        parts.append('<{0}>{1}</{0}>'.format(names[fid], value))
+                parts.append('</record>')
+                batch.append(''.join(parts))
+                if len(batch) >= 500:
+                    yield ''.join(batch)
+                    batch = []
+            yield ''.join(batch)
+            yield '</records></table>' if structured else ''
+        return 0, 'No error', render()
+
+    def _values(self, table, fields):
+        values = {}
+        for attrib, value in fields.get('field', []):
+            fid = attrib.get('fid') or table.fid(attrib.get('name'))
+            if fid not in table.by_fid:
+                raise ValueError('no field {0}'.format(fid))
+            values[fid] = value or ''
+        return values
+
+    def do_addrecord(self, table, fields):
+        rid = table.write(None, self._values(table, fields))
+        return 0, 'No error', ['<rid>{0}</rid><update_id>1</update_id>'.format(rid)]
+
+    def do_editrecord(self, table, fields):
+        values = self._values(table, fields)
+        rid = table.write(int(fields['rid']), values)
+        return 0, 'No error', ['<rid>{0}</rid><num_fields_changed>{1}</num_fields_changed>'
+                               '<update_id>1</update_id>'.format(rid, len(values))]
+
+    def do_deleterecord(self, table, fields):
+        table.delete(int(fields['rid']))
+        return 0, 'No error', ['<rid>{0}</rid>'.format(fields['rid'])]
+
+    def do_importfromcsv(self, table, fields):
+        clist = (fields.get('clist') or '').split('.')
+        text = fields.get('records_csv') or ''
+        if PY2:
+            rows = [[cell.decode('utf-8') for cell in row]
+                    for row in csv.reader(io.BytesIO(text.encode('utf-8')))]
+        else:
+            rows = list(csv.reader(io.StringIO(text)))
+        if fields.get('skipfirst') == '1':
+            rows = rows[1:]
+        rids = []
+        added = updated = 0
+        for row in rows:
+            values = dict(zip(clist, row))
+            rid = values.pop('3', None)
+            if rid:
+                table.write(int(rid), values)
+                updated += 1
+            else:
+                rid = table.write(None, values)
+                added += 1
+            rids.append('<rid update_id="1">{0}</rid>'.format(rid))
+        return 0, 'No error', ['<num_recs_input>{0}</num_recs_input><num_recs_added>{1}</num_recs_added>'
+                               '<num_recs_updated>{2}</num_recs_updated><rids>{3}</rids>'.format(
+                                   len(rows), added, updated, ''.join(rids))]
+
+    def _page(self, fields):
+        pageid = fields.get('pageID') or fields.get('pageid')
+        if pageid:
+            return int(pageid)
+        for pageid, (name, pagetype, body) in self.pages.items():
+            if name == fields.get('pagename'):
+                return pageid
+        return None
+
+    def do_getdbpage(self, table, fields):
+        pageid = self._page(fields)
+        if pageid not in self.pages:
+            return 24, 'No such page', []
+        return 0, 'No error', ['<pagebody>' + _escape(self.pages[pageid][2]) + '</pagebody>']
+
+    def do_listdbpages(self, table, fields):
+        pages = ''.join('<page id="{0}" type="{1}">{2}</page>'.format(pageid, pagetype, _escape(name))
+                        for pageid, (name, pagetype, body) in sorted(self.pages.items()))
+        return 0, 'No error', ['<pages>' + pages + '</pages>']
+
+    def do_addreplacedbpage(self, table, fields):
+        with self.lock:
+            pageid = self._page(fields)
+            if pageid is None:
+                pageid = max(self.pages or [0]) + 1
+                name = fields['pagename']
+            else:
+                name = self.pages[pageid][0]
+            self.pages[pageid] = (name, fields.get('pagetype', '1'), fields.get('pagebody') or '')
+        return 0, 'No error', ['<pageID>{0}</pageID>'.format(pageid)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if self.headers.get('content-encoding', '').lower() in ('gzip', 'deflate'):
+            body = zlib.decompress(body, 32 + zlib.MAX_WBITS)
+        return body
+
+    def _delay(self):
+        realm = self.server.realm
+        if realm.latency or realm.jitter:
+            time.sleep(realm.latency + random.random() * realm.jitter)
+
+    def do_POST(self):
+        realm = self.server.realm
+        action = self.headers.get('QUICKBASE-ACTION', '')[len('API_'):]
+        dbid = self.path.rsplit('/', 1)[-1]
+        request = etree.fromstring(self._body())
+        fields = {'_dbid': dbid, '_url': 'http://{0}:{1}'.format(*self.server.server_address)}
+        for element in request:
+            if element.tag == 'field':
+                fields.setdefault('field', []).append((dict(element.attrib), element.text))
+            else:
+                fields[element.tag] = element.text
+        self._delay()
+        if realm.error_rate and random.random() < realm.error_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        errcode, errtext, body = realm.handle(action, dbid, fields)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml; charset={0}'.format(realm.encoding))
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.compressor = None
+        if realm.compress:
+            accepted = [e.split(';')[0].strip().lower()
+                        for e in self.headers.get('accept-encoding', '').split(',')]
+            for method, wbits in (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)):
+                if method in accepted:
+                    self.compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+                    self.send_header('Content-Encoding', method)
+                    break
+        self.end_headers()
+        head = u'<?xml version="1.0" encoding="{0}"?>\n<qdbapi><action>API_{1}</action>' \
+               u'<errcode>{2}</errcode><errtext>{3}</errtext>'.format(realm.encoding, action, errcode, errtext)
+        self._chunk(head)
+        if realm.truncating():
+            # Promise a chunk longer than what follows, then hang up
+            self.wfile.write(b'1000\r\n<record>')
+            self.close_connection = True
+            return
+        for chunk in ([] if errcode else body):
+            self._chunk(chunk)
+        self._chunk(u'</qdbapi>')
+        if self.compressor is not None:
+            self._write(self.compressor.flush())
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _chunk(self, text):
+        if not text:
+            return
+        data = text.encode(self.server.realm.encoding, 'xmlcharrefreplace')
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._write(data)
+
+    def _write(self, data):
+        if not data:
+            return
+        self.wfile.write('{0:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+    def do_GET(self):
+        self._delay()
+        data = ('attachment ' + self.path + '\n').encode('utf-8') * 100
+        start = 0
+        if self.headers.get('range'):
+            start = int(self.headers['range'].split('=')[1].rstrip('-'))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+            accepted = [e.split(';')[0].strip().lower()
+                        for e in self.headers.get('accept-encoding', '').split(',')]
+            if self.server.realm.compress and 'gzip' in accepted:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                data = compressor.compress(data) + compressor.flush()
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop connections whose responses they do not need, as when a download is skipped
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class MockServer(object):
+    """Runs a MockQuickBase realm on a local port in a background thread. Keyword
+    arguments are passed to MockQuickBase.
+
+    """
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        self.realm = MockQuickBase(**kwargs)
+        self.httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.realm = self.realm
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.httpd.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a mock QuickBase API server.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--encoding', default='utf-8')
+    parser.add_argument('--compress', action='store_true', help='compress responses')
+    args = parser.parse_args()
+    server = MockServer(port=args.port, tables={'bqtable': MockTable(size=args.records)},
+                        latency=args.latency, encoding=args.encoding, compress=args.compress)
+    print('Serving table bqtable with {0} records at {1}'.format(args.records, server.url))
+    server.httpd.serve_forever()
@@ -0,0 +1,920 @@
+"""Offline tests of Client and AsyncClient against the local mock QuickBase server.
+
+Unlike tests.py these need no QuickBase account or network access:
+
+    python -m unittest discover -s tests -p 'test_*.py'
+
+"""
+from __future__ import unicode_literals
+
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import quickbase
+from mock_server import MockServer, MockTable
+
+try:
+    import asyncio
+    import quickbase_async
+except (ImportError, SyntaxError):
+    quickbase_async = None
+
+PY2 = sys.version_info[0] == 2
+ALL = "{'3'.XEX.''}"
+
+
+class CountingTransport(quickbase.Transport):
+    """Transport that counts the requests it makes."""
+    def __init__(self, *args, **kwargs):
+        super(CountingTransport, self).__init__(*args, **kwargs)
+        self.requests = 0
+
+    def request(self, *args, **kwargs):
+        self.requests += 1
+        return super(CountingTransport, self).request(*args, **kwargs)
+
+
+class StubResponse(object):
+    """HTTP response with the given body chunks, for feeding a Client directly."""
+    headers = {'content-type': 'application/xml'}
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+    def close(self):
+        pass
+
+
+class MockServerTestCase(unittest.TestCase):
+    """Runs a mock realm with a bqtable of size records for each test."""
+    size = 50
+    server_options = {}
+
+    def setUp(self):
+        self.table = MockTable(size=self.size)
+        self.server = MockServer(tables={'bqtable': self.table}, **self.server_options).start()
+        self.realm = self.server.realm
+        self.folder = tempfile.mkdtemp()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def client(self, **kwargs):
+        client = quickbase.Client('user', 'password', base_url=self.server.url,
+                                  database='bqtable', **kwargs)
+        self.clients.append(client)
+        return client
+
+
+class TransportTests(MockServerTestCase):
+    def test_calls_reuse_pooled_session(self):
+        transport = CountingTransport(pool_maxsize=2)
+        client = self.client(transport=transport)
+        self.assertEqual(client.do_query_count(ALL), self.size)
+        self.assertEqual(len(client.do_query(ALL, columns='a')), self.size)
+        self.assertEqual(transport.requests, 3)
+        adapter = transport.session.get_adapter(self.server.url)
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+
+    def test_connection_failure_raises_connection_error(self):
+        client = self.client()
+        client.base_url = 'http://127.0.0.1:1'
+        self.assertRaises(quickbase.ConnectionError, client.do_query_count, ALL)
+
+    def test_truncated_body_raises_connection_error(self):
+        client = self.client()
+        client.parallel_min_bytes = 0
+        self.realm.truncate = 3
+        self.assertRaises(quickbase.ConnectionError, client.do_query, ALL, columns='a')
+        self.assertRaises(quickbase.ConnectionError, list, client.iter_query(ALL, columns='a'))
+        self.assertRaises(quickbase.ConnectionError, client.do_query, ALL, columns='a', processes=2)
+        self.assertEqual(len(client.do_query(ALL, columns='a')), self.size)
+
+
+class ResponseParsingTests(MockServerTestCase):
+    server_options = {'encoding': 'iso-8859-1'}
+
+    def test_declared_encoding_is_decoded(self):
+        records = self.client().do_query("{'3'.EX.'5'}", columns='a')
+        self.assertEqual(records[0]['6'], 'Name 5 caf\xe9 & co')
+
+    def test_streamed_parse_matches_whole_body(self):
+        client = self.client(detect_encoding=True)
+        request = {'query': ALL, 'clist': 'a', 'fmt': 'structured'}
+        parsed = client.request('DoQuery', 'bqtable', request)
+        self.assertEqual(client._parse_records(parsed), client.do_query(ALL, columns='a'))
+
+    def test_error_response_raises(self):
+        client = self.client()
+        with self.assertRaises(quickbase.ResponseError) as raised:
+            client.do_query(ALL, database='nosuchtable')
+        self.assertEqual(raised.exception.code, '32')
+        self.assertIn(b'<errcode>32</errcode>', raised.exception.response)
+        self.assertEqual(raised.exception.parsed.findtext('errtext'), 'No such database')
+
+    def test_malformed_body_kept(self):
+        body = [b'<qdbapi><errcode>0</errcode>', b'<records></qdbapi>']
+        with self.assertRaises(quickbase.XMLError) as raised:
+            self.client()._read_response(StubResponse(body))
+        self.assertEqual(raised.exception.response, b''.join(body))
+
+    def test_http_error_status_raises(self):
+        client = self.client()
+        self.realm.error_rate = 1
+        with self.assertRaises(quickbase.ConnectionError) as raised:
+            client.do_query_count(ALL)
+        self.assertEqual(raised.exception.http_response.status_code, 503)
+        self.assertEqual(raised.exception.response, b'')
+
+
+class QueryTests(MockServerTestCase):
+    def test_iter_query_matches_do_query(self):
+        client = self.client()
+        self.assertEqual(list(client.iter_query(ALL, columns='a')), client.do_query(ALL, columns='a'))
+
+    def test_iter_query_raises_quickbase_error(self):
+        iterator = self.client().iter_query(ALL, database='nosuchtable')
+        self.assertRaises(quickbase.ResponseError, list, iterator)
+
+    def test_do_query_all_pages_in_order(self):
+        client = self.client()
+        records = list(client.do_query_all(ALL, columns='3', page_size=7, concurrency=3))
+        self.assertEqual([int(r['3']) for r in records], list(range(1, self.size + 1)))
+
+    def test_do_query_all_breaks_sort_ties_by_rid(self):
+        client = self.client()
+        records = list(client.do_query_all(ALL, columns='3.9', sort=[9], page_size=4))
+        self.assertEqual(sorted(int(r['3']) for r in records), list(range(1, self.size + 1)))
+        self.assertEqual(records, client.do_query(ALL, columns='3.9', sort=[9, 3]))
+
+    def test_records_and_columns(self):
+        client = self.client()
+        records = client.do_query(ALL, columns='a', result='records')
+        columns = client.do_query(ALL, columns='a', result='columns')
+        self.assertEqual([r['3'] for r in records], list(columns['3']))
+        self.assertEqual(records[0]['3'], 1)
+        self.assertIsInstance(columns['7'][0], float)
+
+    def test_views(self):
+        client = self.client()
+        records = client.do_query(ALL, columns='a')
+        views = client.do_query(ALL, columns='a', result='views')
+        self.assertEqual([view.to_dict() for view in views], records)
+        views = client.do_query(ALL, columns=['Record ID#', 'Name'], result='views')
+        self.assertEqual(len(views[0]), 2)
+        self.assertEqual(views[0]['Name'], views[0]['6'])
+
+    def test_processes_match_do_query(self):
+        client = self.client()
+        client.parallel_min_bytes = 0
+        self.assertEqual(client.do_query(ALL, columns='a', processes=2),
+                         client.do_query(ALL, columns='a'))
+
+
+class LocalQueryTests(unittest.TestCase):
+    # Name, Amount, Due Date (01-02-2010, 01-03-2010 or blank) and Tags
+    rows = [
+        {'3': '1', '6': 'Apple', '7': '5', '9': '1262390400000', '10': 'red;blue'},
+        {'3': '2', '6': 'banana', '7': '50', '9': '1262476800000', '10': 'green'},
+        {'3': '3', '6': 'Cherry', '7': '', '9': '', '10': ''},
+        {'3': '4', '6': 'apple pie', '7': '500', '9': '1262394000000', '10': 'blue'},
+    ]
+    schema = quickbase.Schema([
+        {'id': '3', 'field_type': 'recordid'}, {'id': '6', 'field_type': 'text'},
+        {'id': '7', 'field_type': 'float'}, {'id': '9', 'field_type': 'date'},
+        {'id': '10', 'field_type': 'multitext'},
+    ])
+
+    def record_sets(self):
+        """Return the rows as text dicts and as typed Records."""
+        fids = ['3', '6', '7', '9', '10']
+        index = dict((fid, i) for i, fid in enumerate(fids))
+        typed = [self.schema.convert(row) for row in self.rows]
+        return [self.rows, [quickbase.Record(index, tuple(row[fid] for fid in fids)) for row in typed]]
+
+    def rids(self, records, query=None, **kwargs):
+        return [int(r['3']) for r in quickbase.local_query(records, query, columns='3', **kwargs)]
+
+    def test_operators(self):
+        cases = [
+            ("{'7'.GT.'10'}", [2, 4]),
+            ("{'7'.LT.'10'}", [1]),
+            ("{'6'.CT.'apple'}", [1, 4]),
+            ("{'6'.SW.'b'}", [2]),
+            ("{'6'.XSW.'b'}", [1, 3, 4]),
+            ("{'10'.HAS.'blue'}", [1, 4]),
+            ("{'10'.GT.'g'}", [1, 2]),
+            ("{'10'.LT.'c'}", [4]),
+            ("{'10'.EX.'red;blue'}", [1]),
+            ("({'3'.LT.'3'} AND {'10'.HAS.'red'}) OR {'3'.EX.'3'}", [1, 3]),
+        ]
+        for records in self.record_sets():
+            for query, expected in cases:
+                self.assertEqual(self.rids(records, query), expected, query)
+
+    def test_dates(self):
+        cases = [
+            ("{'9'.EX.'01-02-2010'}", [1, 4]),
+            ("{'9'.XEX.'01-02-2010'}", [2, 3]),
+            ("{'9'.EX.'1262390400000'}", [1]),
+            ("{'9'.GT.'1262390400000'}", [2, 4]),
+            ("{'9'.AF.'01-02-2010'}", [2]),
+            ("{'9'.OBF.'01-02-2010'}", [1, 4]),
+            ("{'9'.IR.'01-03-2010'}", [2]),
+        ]
+        for records in self.record_sets():
+            for query, expected in cases:
+                self.assertEqual(self.rids(records, query), expected, query)
+
+    def test_sort(self):
+        for records in self.record_sets():
+            self.assertEqual(self.rids(records, sort=[7]), [3, 1, 2, 4])
+            self.assertEqual(self.rids(records, sort=[10, 3]), [3, 4, 2, 1])
+            self.assertEqual(self.rids(records, sort=[9, 3], ascending=False), [2, 4, 1, 3])
+            self.assertEqual(self.rids(records, sort=[6], num=2, skip=1), [4, 2])
+
+    def test_compile_query_rejects_bad_syntax(self):
+        self.assertRaises(ValueError, quickbase.compile_query, "{'3'.EX.'1'} AND")
+
+
+class SchemaTests(MockServerTestCase):
+    def test_schema_cached_until_invalidated(self):
+        client = self.client()
+        schema = client.schema()
+        self.assertIs(client.schema(), schema)
+        self.assertEqual(schema.fid('Record ID#'), '3')
+        self.assertEqual(schema.fid('record_id_'), '3')
+        client.invalidate_schema()
+        self.assertIsNot(client.schema(), schema)
+
+    def test_named_writes_send_fids(self):
+        client = self.client()
+        client.schema()
+        rid = client.add_record({'Name': 'widget', 'Amount': '2.5'}, named=True)
+        self.assertEqual(client.do_query("{'3'.EX.'%d'}" % rid, columns='6.7'),
+                         [{'6': 'widget', '7': '2.5'}])
+
+
+class SerializerTests(unittest.TestCase):
+    def test_fast_serializer_matches_etree(self):
+        fields = {
+            'a': 1,
+            'b': 'caf\xe9 <&> "quoted"\r\n\ttab',
+            'field': [({'fid': '6'}, 'x]]>y'), ({'name': 'a"b\n'}, '')],
+        }
+        self.assertEqual(quickbase.Client._build_request(**fields),
+                         quickbase.Client._build_request_etree(**fields))
+
+    def test_invalid_characters_fall_back(self):
+        self.assertIsNone(quickbase.Client._serialize_fields({'a': '\x00'}))
+        self.assertIsNone(quickbase.Client._serialize_fields({'1bad': 'x'}))
+
+
+class XMLBackendTests(MockServerTestCase):
+    def test_backends_parse_alike(self):
+        results = []
+        for name in ('lxml', 'etree'):
+            try:
+                backend = quickbase.get_xml_backend(name)
+                backend.etree
+            except ImportError:
+                continue
+            client = self.client(xml_backend=backend)
+            results.append((client.do_query(ALL, columns='a'),
+                            list(client.iter_query(ALL, columns='a')),
+                            client.get_schema()))
+        self.assertTrue(results)
+        self.assertTrue(all(result == results[0] for result in results))
+
+    def test_import_is_lazy(self):
+        code = ('import sys, quickbase; print(sorted(set(sys.modules) & '
+                'set(["chardet", "lxml", "requests", "sqlite3"])))')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(os.path.abspath(quickbase.__file__)))
+        self.assertEqual(output.strip(), b'[]')
+
+
+class CacheTests(MockServerTestCase):
+    def test_reads_cached_and_writes_invalidate(self):
+        cache = quickbase.ResponseCache()
+        client = self.client(cache=cache)
+        requests = self.realm.requests
+        first = client.do_query(ALL, columns='a')
+        self.assertEqual(client.do_query(ALL, columns='a'), first)
+        self.assertEqual(self.realm.requests, requests + 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        client.edit_record(1, {'6': 'changed'})
+        self.assertEqual(client.do_query("{'3'.EX.'1'}", columns='6'), [{'6': 'changed'}])
+
+    def test_bounded_by_entries(self):
+        cache = quickbase.ResponseCache(max_entries=2)
+        client = self.client(cache=cache)
+        for rid in range(1, 5):
+            client.do_query("{'3'.EX.'%d'}" % rid, columns='3')
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+
+class HookTests(MockServerTestCase):
+    def test_metrics_collected(self):
+        metrics = quickbase.MetricsCollector()
+        client = self.client(hooks=[metrics])
+        client.do_query(ALL, columns='a')
+        self.assertRaises(quickbase.ResponseError, client.do_query, ALL, database='nosuchtable')
+        stats = metrics.snapshot()['DoQuery']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errcodes'], {'0': 1, '32': 1})
+        self.assertGreater(stats['bytes_received'], 0)
+        self.assertEqual(sorted(stats['phases']),
+                         ['build', 'connect', 'decode', 'parse', 'record_parse', 'transfer'])
+        self.assertIn('quickbase_requests_total', metrics.prometheus())
+
+
+class SchedulerTests(MockServerTestCase):
+    server_options = {'rate_limit': 10}
+
+    def test_throttled_requests_retried(self):
+        scheduler = quickbase.Scheduler(max_retries=30, backoff=0.1, max_backoff=1)
+        client = self.client(scheduler=scheduler)
+        pool = ThreadPool(4)
+        try:
+            counts = pool.map(lambda i: client.do_query_count("{'3'.LT.'%d'}" % (i + 2)), range(20))
+        finally:
+            pool.terminate()
+        self.assertEqual(counts, list(range(1, 21)))
+        self.assertGreater(self.realm.throttled, 0)
+        self.assertGreater(scheduler.stats()['retries'], 0)
+
+    def test_gives_up_after_max_retries(self):
+        scheduler = quickbase.Scheduler(max_retries=0)
+        client = self.client(scheduler=scheduler)
+        self.realm.rate_limit = 1
+        with self.assertRaises(quickbase.ResponseError) as raised:
+            for _ in range(5):
+                client.do_query_count(ALL)
+        self.assertEqual(raised.exception.code, '77')
+
+    def test_truncated_body_retried(self):
+        scheduler = quickbase.Scheduler(max_retries=3, backoff=0.01)
+        client = self.client(scheduler=scheduler)
+        self.realm.truncate = 2
+        self.assertEqual(client.do_query_count(ALL), self.size)
+        self.assertEqual(scheduler.stats()['retries'], 2)
+        self.realm.truncate = 1
+        self.assertRaises(quickbase.ConnectionError, client.add_record, {'6': 'x'})
+        self.assertEqual(scheduler.stats()['retries'], 2)
+
+    def test_used_up_body_not_retried(self):
+        scheduler = quickbase.Scheduler(max_retries=30, backoff=0.1, max_backoff=1)
+        client = self.client(scheduler=scheduler)
+        self.realm.rate_limit = 1
+        rows = (('row {0}'.format(i), i) for i in range(3))
+        with self.assertRaises(quickbase.ResponseError) as raised:
+            for _ in range(2):
+                client.import_from_csv(rows, clist=[6, 7])
+        self.assertEqual(raised.exception.code, '77')
+        self.assertEqual(scheduler.stats()['retries'], 0)
+
+        path = os.path.join(self.folder, 'rows.csv')
+        with open(path, 'w') as f:
+            f.write('a,1\nb,2\n')
+        for _ in range(2):
+            response = client.import_from_csv(path=path, clist=[6, 7])
+            self.assertEqual(response.findtext('num_recs_added'), '2')
+        self.assertGreater(scheduler.stats()['retries'], 0)
+        self.assertEqual(self.table.next_rid, self.size + 5)
+
+
+class CoalescerTests(MockServerTestCase):
+    server_options = {'latency': 0.2}
+
+    def test_identical_reads_share_one_call(self):
+        client = self.client(coalesce=True)
+        requests = self.realm.requests
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(lambda i: client.do_query(ALL, columns='a'), range(8))
+        finally:
+            pool.terminate()
+        self.assertTrue(all(result == results[0] for result in results))
+        stats = client.coalescer.stats()
+        self.assertEqual(stats['calls'] + stats['coalesced'], 8)
+        self.assertEqual(self.realm.requests - requests, stats['calls'])
+        self.assertEqual(stats['in_flight'], 0)
+
+
+class TicketTests(MockServerTestCase):
+    def test_provider_shares_ticket(self):
+        provider = quickbase.MemoryTicketProvider()
+        first = self.client(ticket_provider=provider)
+        second = self.client(ticket_provider=provider)
+        self.assertEqual(first.ticket, second.ticket)
+        self.assertEqual(self.realm.authentications, 1)
+
+    def test_file_provider_shares_ticket(self):
+        path = os.path.join(self.folder, 'tickets.json')
+        first = self.client(ticket_provider=quickbase.FileTicketProvider(path))
+        second = self.client(ticket_provider=quickbase.FileTicketProvider(path))
+        self.assertEqual(first.ticket, second.ticket)
+        self.assertEqual(self.realm.authentications, 1)
+
+    def test_expired_ticket_renewed(self):
+        client = self.client()
+        client.ticket = 'expired'
+        self.assertEqual(client.do_query_count(ALL), self.size)
+        self.assertNotEqual(client.ticket, 'expired')
+        self.assertEqual(self.realm.authentications, 2)
+
+    def test_streamed_queries_renew_ticket(self):
+        client = self.client()
+        client.parallel_min_bytes = 0
+        expected = client.do_query(ALL, columns='a')
+        client.ticket = 'expired'
+        self.assertEqual(list(client.iter_query(ALL, columns='a')), expected)
+        client.ticket = 'expired'
+        self.assertEqual(client.do_query(ALL, columns='a', processes=2), expected)
+        self.assertEqual(self.realm.authentications, 3)
+
+    def test_used_up_body_not_replayed(self):
+        client = self.client()
+        client.ticket = 'expired'
+        with self.assertRaises(quickbase.ResponseError) as raised:
+            client.import_from_csv(iter(['a,1\n']), clist=[6, 7])
+        self.assertEqual(raised.exception.code, '4')
+        self.assertNotEqual(client.ticket, 'expired')
+        self.assertEqual(self.table.next_rid, self.size + 1)
+        response = client.import_from_csv(iter(['a,1\n']), clist=[6, 7])
+        self.assertEqual(response.findtext('num_recs_added'), '1')
+
+
+class CompressionTests(MockServerTestCase):
+    server_options = {'compress': True}
+
+    def test_compressed_round_trip(self):
+        compression = quickbase.Compression(min_size=0)
+        client = self.client(compression=compression)
+        records = client.do_query(ALL, columns='a')
+        self.assertEqual(records, self.client().do_query(ALL, columns='a'))
+        client.import_from_csv('imported,1\n', clist=[6, 7])
+        stats = compression.stats()
+        self.assertGreater(stats['DoQuery']['received_raw'], stats['DoQuery']['received_wire'])
+        self.assertIn('ImportFromCSV', stats)
+
+
+class ImportTests(MockServerTestCase):
+    def test_import_string(self):
+        response = self.client().import_from_csv('a,1\nb,2\n', clist=[6, 7])
+        self.assertEqual(response.findtext('num_recs_added'), '2')
+
+    def test_import_streams_file_and_rows(self):
+        client = self.client()
+        client.chunk_size = 16
+        path = os.path.join(self.folder, 'rows.csv')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(''.join('caf\xe9 {0},{0}\n'.format(i) for i in range(100)))
+        with open(path, 'rb') as f:
+            response = client.import_from_csv(f, clist=[6, 7])
+        self.assertEqual(response.findtext('num_recs_added'), '100')
+        response = client.import_from_csv(path=path, clist=[6, 7])
+        self.assertEqual(response.findtext('num_recs_added'), '100')
+        rows = (('row {0}'.format(i), i) for i in range(30))
+        response = client.import_from_csv(rows, clist='6.7')
+        self.assertEqual(response.findtext('num_recs_added'), '30')
+        self.assertEqual(client.do_query("{'6'.EX.'caf\xe9 99'}", columns='7'),
+                         [{'7': '99'}, {'7': '99'}])
+
+    def test_import_non_ascii_rows(self):
+        client = self.client()
+        client.chunk_size = 8
+        rows = [('caf\xe9 row', 1), 'na\xefve row,2\n', ('\u20ac row', None)]
+        response = client.import_from_csv(iter(rows), clist=[6, 7])
+        self.assertEqual(response.findtext('num_recs_added'), '3')
+        self.assertEqual(client.do_query("{'6'.CT.' row'}", columns='6.7', sort=[3]),
+                         [{'6': 'caf\xe9 row', '7': '1'}, {'6': 'na\xefve row', '7': '2'},
+                          {'6': '\u20ac row', '7': ''}])
+
+    def test_string_is_never_a_path(self):
+        client = self.client()
+        path = os.path.join(self.folder, 'rows.csv')
+        with open(path, 'w') as f:
+            f.write('from file,1\n')
+        response = client.import_from_csv(path, clist=[6])
+        self.assertEqual(response.findtext('num_recs_added'), '1')
+        self.assertEqual(client.do_query("{'6'.EX.'%s'}" % path, columns='3'),
+                         [{'3': str(self.size + 1)}])
+        self.assertRaises(TypeError, client.import_from_csv, 'a\n', clist=[6], path=path)
+        self.assertRaises(TypeError, client.import_from_csv, clist=[6])
+
+
+class BulkWriterTests(MockServerTestCase):
+    def test_adds_in_batches(self):
+        client = self.client()
+        with client.bulk_writer(batch_rows=2) as writer:
+            for value in ('1', '2', '3'):
+                writer.add({'7': value})
+        self.assertEqual(writer.errors, [])
+        self.assertEqual(len(writer.results), 2)
+        self.assertEqual(sorted(writer.rids), [0, 1, 2])
+        self.assertEqual(client.do_query_count(ALL), self.size + 3)
+
+    def test_named_edits_concurrently(self):
+        client = self.client()
+        with client.bulk_writer(named=True, batch_rows=3, concurrency=2) as writer:
+            for rid in range(1, 11):
+                writer.edit(rid, {'Name': 'edited {0}'.format(rid)})
+        self.assertEqual(writer.errors, [])
+        self.assertEqual([writer.rids[i] for i in range(10)], list(range(1, 11)))
+        self.assertEqual(client.do_query("{'6'.SW.'edited'}", columns='3', sort=[3])[-1], {'3': '10'})
+
+    def test_failed_batch_collected(self):
+        with self.client().bulk_writer() as writer:
+            writer.edit(self.size + 100, {'6': 'missing'})
+        self.assertEqual(len(writer.errors), 1)
+
+    def test_batch_bytes_counts_encoded_size(self):
+        # Each row is 101 characters but 201 bytes of UTF-8
+        with self.client().bulk_writer(batch_bytes=500) as writer:
+            for _ in range(5):
+                writer.add({'6': '\xe9' * 100})
+        self.assertEqual([len(result.rows) for result in writer.results], [3, 2])
+
+    @unittest.skipIf(quickbase_async is None, 'needs Python 3.7+ and aiohttp')
+    def test_async_client_refused(self):
+        client = quickbase_async.AsyncClient('user', 'password', base_url=self.server.url)
+        self.assertRaises(TypeError, client.bulk_writer)
+
+
+class EditDuringSync(quickbase.Hook):
+    """Hook that makes the given edits, one after each DoQuery response."""
+    def __init__(self, editor, edits):
+        self.editor = editor
+        self.edits = list(edits)
+
+    def after_response(self, event):
+        if event.action == 'DoQuery' and self.edits:
+            rid, values = self.edits.pop(0)
+            self.editor.edit_record(rid, values)
+
+
+class FixedTableClient(object):
+    """Stand-in client serving fixed rows of (Date Modified, Record ID#, Name) to a
+    TableMirror. It reads only the queries TableMirror is expected to send, by their
+    QuickBase meaning, so a wrong keyset query fails rather than being evaluated by
+    compile_query. edits maps a page number (from 1) to the {rid: (modified, name)}
+    changes made right after that page is served.
+
+    """
+    keyset = re.compile(r"^\{'2'\.AF\.'(\d+)'\} OR \(\{'2'\.OAF\.'\1'\} AND \{'3'\.GT\.'(\d+)'\}\)$")
+
+    def __init__(self, rows, edits=None):
+        self.rows = dict((rid, (modified, name)) for modified, rid, name in rows)
+        self.edits = edits or {}
+        self.pages = 0
+        self.fetched = []
+
+    def schema(self, database=None, refresh=False):
+        return quickbase.Schema([{'id': '2', 'field_type': 'timestamp'},
+                                 {'id': '3', 'field_type': 'recordid'},
+                                 {'id': '6', 'field_type': 'text'}])
+
+    def do_query(self, query, columns, sort, num, database):
+        assert (columns, sort) == ('2.3.6', ['2', '3']), (columns, sort)
+        keys = sorted((modified, rid) for rid, (modified, _) in self.rows.items())
+        match = self.keyset.match(query)
+        if query == "{'3'.XEX.''}":
+            pass
+        elif match:
+            after = int(match.group(1)), int(match.group(2))
+            keys = [key for key in keys if key > after]
+        else:
+            raise AssertionError('unexpected query {0!r}'.format(query))
+        page = [{'2': str(modified), '3': str(rid), '6': self.rows[rid][1]}
+                for modified, rid in keys[:num]]
+        self.fetched.extend(rid for _, rid in keys[:num])
+        self.pages += 1
+        self.rows.update(self.edits.get(self.pages, {}))
+        return page
+
+    def do_query_all(self, query, columns, page_size, concurrency, database):
+        return [{'3': str(rid)} for rid in sorted(self.rows)]
+
+
+class TableMirrorTests(MockServerTestCase):
+    def test_sync_and_reconcile(self):
+        client = self.client()
+        mirror = quickbase.TableMirror(client, 'bqtable', ':memory:', page_size=7)
+        self.assertEqual(mirror.sync(), {'upserted': self.size, 'deleted': 0})
+        client.edit_record(5, {'6': 'changed'})
+        client.delete_record(6)
+        self.assertLessEqual(mirror.sync()['upserted'], 2)
+        self.assertEqual(mirror.reconcile(), 1)
+        rows = mirror.conn.execute('SELECT f3, f6 FROM {0} ORDER BY f3'.format(mirror.table)).fetchall()
+        self.assertEqual(len(rows), self.size - 1)
+        self.assertEqual(rows[4], (5, 'changed'))
+        mirror.close()
+
+    def test_rows_edited_during_sync_not_lost(self):
+        # Each edit moves an already fetched record to the end of the Date Modified
+        # order, which shifts the records after it back by one
+        hook = EditDuringSync(self.client(), [(3, {'6': 'first'}), (10, {'6': 'second'})])
+        mirror = quickbase.TableMirror(self.client(hooks=[hook]), 'bqtable', ':memory:',
+                                       page_size=7, batch_size=5)
+        mirror.sync()
+        rows = dict(mirror.conn.execute('SELECT f3, f6 FROM {0}'.format(mirror.table)))
+        self.assertEqual(sorted(rows), list(range(1, self.size + 1)))
+        self.assertEqual((rows[3], rows[10]), ('first', 'second'))
+
+        # An edit made after the last page is fetched is picked up by the next sync
+        hook.edits = [(20, {'6': 'third'})]
+        self.client().edit_record(40, {'6': 'fourth'})
+        mirror.sync()
+        mirror.sync()
+        rows = dict(mirror.conn.execute('SELECT f3, f6 FROM {0}'.format(mirror.table)))
+        self.assertEqual(len(rows), self.size)
+        self.assertEqual((rows[20], rows[40]), ('third', 'fourth'))
+        mirror.close()
+
+    def test_keyset_pages_across_equal_modified_times(self):
+        rows = [(1000, 1, 'a'), (1000, 2, 'b'), (1000, 3, 'c'), (2000, 4, 'd'),
+                (2000, 5, 'e'), (2000, 6, 'f'), (3000, 7, 'g')]
+        client = FixedTableClient(rows)
+        mirror = quickbase.TableMirror(client, 'bqtable', ':memory:', page_size=2)
+        self.assertEqual(mirror.sync()['upserted'], 7)
+        self.assertEqual(client.fetched, [1, 2, 3, 4, 5, 6, 7])
+
+        # Record 1 is edited after it was fetched and record 5 before it is
+        client = FixedTableClient(rows, {1: {1: (4000, 'A')}, 2: {5: (5000, 'E')}})
+        mirror = quickbase.TableMirror(client, 'bqtable', ':memory:', page_size=2)
+        mirror.sync()
+        self.assertEqual(client.fetched, [1, 2, 3, 4, 6, 7, 1, 5])
+        rows = mirror.conn.execute('SELECT f6 FROM {0} ORDER BY f3'.format(mirror.table))
+        self.assertEqual([row[0] for row in rows], ['A', 'b', 'c', 'd', 'E', 'f', 'g'])
+        mirror.close()
+
+
+class DownloadTests(MockServerTestCase):
+    def test_download_resume_and_skip(self):
+        client = self.client()
+        files = [(rid, 11, 'file{0}.txt'.format(rid)) for rid in range(1, 6)]
+        results = client.download_files(files, self.folder, concurrency=3)
+        self.assertEqual([r.error for r in results], [None] * 5)
+        with open(results[0].path, 'rb') as f:
+            body = f.read()
+        self.assertTrue(body.startswith(b'attachment /up/bqtable/a/r1/e11/v0'))
+        self.assertFalse([name for name in os.listdir(self.folder) if name.endswith('.part')])
+
+        os.remove(results[1].path)
+        with open(results[1].path + '.part', 'wb') as f:
+            f.write(body[:10])
+        results = client.download_files(files, self.folder)
+        self.assertEqual([r.skipped for r in results], [True, False, True, True, True])
+        with open(results[1].path, 'rb') as f:
+            self.assertEqual(f.read(), body.replace(b'r1/', b'r2/'))
+
+    def test_compressing_server_resume_and_skip(self):
+        self.realm.compress = True
+        client = self.client()
+        files = [(rid, 11, 'file{0}.txt'.format(rid)) for rid in range(1, 3)]
+        results = client.download_files(files, self.folder)
+        with open(results[0].path, 'rb') as f:
+            body = f.read()
+        os.remove(results[0].path)
+        with open(results[0].path + '.part', 'wb') as f:
+            f.write(body[:10])
+        results = client.download_files(files, self.folder)
+        self.assertEqual([r.skipped for r in results], [False, True])
+        with open(results[0].path, 'rb') as f:
+            self.assertEqual(f.read(), body)
+
+    def test_get_file(self):
+        path = self.client().get_file('one.txt', self.folder, 1, 11)
+        self.assertEqual(os.path.basename(path), 'one.txt')
+        self.assertGreater(os.path.getsize(path), 0)
+
+    def test_bare_urls_get_distinct_names(self):
+        client = self.client()
+        urls = [record['11'] for record in client.do_query("{'3'.LTE.'4'}", columns='11')]
+        results = client.download_files(urls, self.folder, concurrency=4)
+        self.assertEqual([r.error for r in results], [None] * 4)
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ['bqtable_r{0}_f11_v0'.format(rid) for rid in range(1, 5)])
+        with open(results[2].path, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'attachment /up/bqtable/a/r3/e11/v0'))
+
+    def test_same_names_rejected(self):
+        client = self.client()
+        files = [(1, 11, 'same.txt'), (2, 11, 'same.txt')]
+        self.assertRaises(ValueError, client.download_files, files, self.folder)
+        self.assertEqual(os.listdir(self.folder), [])
+
+
+class ExportTests(MockServerTestCase):
+    def test_export_csv_and_jsonl(self):
+        client = self.client()
+        path = os.path.join(self.folder, 'table.csv')
+        self.assertEqual(client.export_table('bqtable', path, page_size=7), self.size)
+        with (open(path, 'rb') if PY2 else io.open(path, newline='', encoding='utf-8')) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(len(rows), self.size + 1)
+        self.assertEqual(rows[0][:3], ['Date Created', 'Date Modified', 'Record ID#'])
+        name = rows[1][rows[0].index('Name')]
+        self.assertEqual(name.decode('utf-8') if PY2 else name, 'Name 1 caf\xe9 & co')
+
+        path = os.path.join(self.folder, 'table.jsonl.gz')
+        self.assertEqual(client.export_table('bqtable', path, format='jsonl',
+                                             columns=['Record ID#', 'Amount', 'Tags']), self.size)
+        with gzip.open(path) as f:
+            rows = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual(sorted(rows[0]), ['Amount', 'Record ID#', 'Tags'])
+        self.assertEqual(rows[0]['Record ID#'], 1)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+    @unittest.skipIf(quickbase_async is None, 'needs Python 3.7+ and aiohttp')
+    def test_async_client_refused(self):
+        client = quickbase_async.AsyncClient('user', 'password', base_url=self.server.url)
+        self.assertRaises(TypeError, client.export_table, 'bqtable', 'table.csv')
+
+
+class PageSyncTests(MockServerTestCase):
+    def test_deploy_uploads_only_changes(self):
+        client = self.client()
+        manifest = os.path.join(self.folder, 'pages.json')
+        pages = {'a.html': '<p>a</p>', 'b.js': ('var b;', 1)}
+        results = client.deploy_db_pages(pages, manifest)
+        self.assertEqual([(r.name, r.uploaded, r.error) for r in results],
+                         [('a.html', True, None), ('b.js', True, None)])
+        pages['a.html'] = '<p>changed</p>'
+        results = client.deploy_db_pages(pages, manifest)
+        self.assertEqual([r.uploaded for r in results], [True, False])
+        self.assertEqual(client.get_db_page('a.html'), '<p>changed</p>')
+        self.assertEqual(len(self.realm.pages), 2)
+
+
+class MockServerTests(MockServerTestCase):
+    server_options = {'ticket_lifetime': 60}
+
+    def test_unknown_ticket_refused(self):
+        client = self.client()
+        client.ticket = 'bogus'
+        client.username = None
+        with self.assertRaises(quickbase.ResponseError) as raised:
+            client.do_query_count(ALL)
+        self.assertEqual(raised.exception.code, '4')
+
+    def test_writes_update_date_modified(self):
+        client = self.client()
+        before = client.do_query("{'3'.EX.'3'}", columns='2')[0]['2']
+        client.edit_record(3, {'6': 'x'})
+        after = client.do_query("{'3'.EX.'3'}", columns='2')[0]['2']
+        self.assertGreater(int(after), int(before))
+
+    def test_benchmark_runs(self):
+        import benchmark
+        out = sys.stdout
+        sys.stdout = io.BytesIO() if PY2 else io.StringIO()
+        try:
+            benchmark.main(['--records', '20', '--iterations', '1'])
+        finally:
+            sys.stdout = out
+
+
+@unittest.skipIf(quickbase_async is None, 'needs Python 3.7+ and aiohttp')
+class AsyncClientTests(MockServerTestCase):
+    # Driven from a private event loop without async syntax, so this module still
+    # compiles on Python 2
+
+    def setUp(self):
+        super(AsyncClientTests, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.async_client = quickbase_async.AsyncClient(
+            'user', 'password', base_url=self.server.url, database='bqtable')
+        self.wait(self.async_client.__aenter__())
+
+    def tearDown(self):
+        self.wait(self.async_client.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(AsyncClientTests, self).tearDown()
+
+    def wait(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def collect(self, iterator):
+        """Return the items of an async iterator as a list."""
+        items = []
+        while True:
+            try:
+                items.append(self.wait(iterator.__anext__()))
+            except StopAsyncIteration:
+                return items
+
+    def run_query(self):
+        return self.wait(self.async_client.do_query(ALL, columns='a'))
+
+    def test_queries_match_client(self):
+        client = self.async_client
+        expected = self.client().do_query(ALL, columns='a')
+        self.assertEqual(self.wait(client.do_query(ALL, columns='a')), expected)
+        self.assertEqual(self.collect(client.iter_query(ALL, columns='a')), expected)
+        self.assertEqual(self.collect(client.do_query_all(ALL, columns='a', page_size=7)), expected)
+
+    def test_used_up_body_not_retried(self):
+        scheduler = quickbase.Scheduler(max_retries=30, backoff=0.1, max_backoff=1)
+        client = quickbase_async.AsyncClient('user', 'password', base_url=self.server.url,
+                                             database='bqtable', scheduler=scheduler)
+        self.wait(client.__aenter__())
+        self.realm.rate_limit = 1
+        try:
+            with self.assertRaises(quickbase.ResponseError) as raised:
+                for _ in range(2):
+                    self.wait(client.import_from_csv(iter(['a,1\n']), clist=[6, 7]))
+        finally:
+            self.wait(client.close())
+        self.assertEqual(raised.exception.code, '77')
+        self.assertEqual(scheduler.stats()['retries'], 0)
+
+    def test_streamed_queries_renew_ticket(self):
+        client = self.async_client
+        expected = self.run_query()
+        client.ticket = 'expired'
+        self.assertEqual(self.collect(client.iter_query(ALL, columns='a')), expected)
+        client.parallel_min_bytes = 0
+        client.ticket = 'expired'
+        self.assertEqual(self.wait(client.do_query(ALL, columns='a', processes=2)), expected)
+        client.ticket = 'expired'
+        with self.assertRaises(quickbase.ResponseError) as raised:
+            self.wait(client.import_from_csv(iter(['a,1\n']), clist=[6, 7]))
+        self.assertEqual(raised.exception.code, '4')
+        self.assertEqual(self.table.next_rid, self.size + 1)
+        self.assertEqual(self.realm.authentications, 4)
+
+    def test_clients_sharing_provider_authenticate_once(self):
+        provider = quickbase.MemoryTicketProvider()
+        clients = [quickbase_async.AsyncClient('user', 'password', base_url=self.server.url,
+                                               ticket_provider=provider) for _ in range(5)]
+        authentications = self.realm.authentications
+        self.wait(asyncio.gather(*[client.__aenter__() for client in clients]))
+        self.assertEqual(self.realm.authentications, authentications + 1)
+        self.assertEqual(len(set(client.ticket for client in clients)), 1)
+        for client in clients:
+            self.wait(client.close())
+
+    def test_download_files(self):
+        client = self.async_client
+        files = [(rid, 11, 'file{0}.txt'.format(rid)) for rid in range(1, 4)]
+        expected = self.client().download_files(files, os.path.join(self.folder, 'sync'))
+        results = self.wait(client.download_files(files, self.folder, concurrency=2))
+        self.assertEqual([(r.size, r.skipped, r.error) for r in results],
+                         [(r.size, False, None) for r in expected])
+        with open(results[0].path, 'rb') as f:
+            body = f.read()
+        os.remove(results[0].path)
+        with open(results[0].path + '.part', 'wb') as f:
+            f.write(body[:10])
+        results = self.wait(client.download_files(files, self.folder))
+        self.assertEqual([r.skipped for r in results], [False, True, True])
+        with open(results[0].path, 'rb') as f:
+            self.assertEqual(f.read(), body)
+        path = self.wait(client.get_file('one.txt', self.folder, 1, 11))
+        self.assertEqual(os.path.getsize(path), len(body))
+
+    def test_deploy_db_pages(self):
+        manifest = os.path.join(self.folder, 'pages.json')
+        pages = {'a.html': '<p>a</p>', 'b.html': '<p>b</p>', 'c.js': ('var c;', 1)}
+        results = self.wait(self.async_client.deploy_db_pages(pages, manifest, concurrency=2))
+        self.assertEqual([(r.name, r.uploaded, r.error) for r in results],
+                         [(name, True, None) for name in sorted(pages)])
+        pages['b.html'] = '<p>changed</p>'
+        results = self.client().deploy_db_pages(pages, manifest)
+        self.assertEqual([r.uploaded for r in results], [False, True, False])
+        self.assertEqual(len(self.realm.pages), 3)
+
+    def test_concurrent_writes(self):
+        adds = [self.async_client.add_record({'6': str(i)}) for i in range(10)]
+        rids = self.wait(asyncio.gather(*adds))
+        self.assertEqual(sorted(rids), list(range(self.size + 1, self.size + 11)))
+
+
+if __name__ == '__main__':
+    unittest.main()